@@ -1,19 +1,23 @@
-import time
+import datetime
+import logging
+import tempfile
+import threading
+import typing
 
 from telebot import types
-from telebot.types import Message
+from telebot.types import Message, CallbackQuery
 
 from database import (
-    take_users, take_messages,
-    take_user_telegram_id, delete_invalid_user
+    take_users_page, take_messages_page, iter_messages,
+    create_broadcast_draft, get_broadcast_draft,
+    start_broadcast, finish_broadcast, set_next_step,
+    search_messages, set_search, get_search,
     )
 from bot_instance import bot
-from utils import split_text
 from balance import checking_balance
-from const import ADMIN_IDS
-
-
-MAILING_TEXT = {}
+from broadcast import launch_broadcast
+from archive import write_jsonl_gz
+from const import ADMIN_IDS, ADMIN_HISTORY_PAGE_SIZE, ADMIN_USERS_PAGE_SIZE
 
 
 def admin_menu(message: Message) -> None:
@@ -49,26 +53,55 @@ def admin_menu(message: Message) -> None:
 
     bot.send_message(
         chat_id=message.chat.id,
-        text="🔐 Админ-панель:",
+        text="🔐 Админ-панель:\n/history id — история одного пользователя",
         reply_markup=markup
     )
 
 
-def show_users(message: Message) -> None:
-    menu_markup = types.InlineKeyboardMarkup()
-    menu_admin = types.InlineKeyboardButton(
+def menu_admin_button() -> types.InlineKeyboardButton:
+    return types.InlineKeyboardButton(
         text='Главное меню', callback_data='menu_admin',
     )
-    menu_markup.add(menu_admin)
 
-    users = take_users()
 
-    split_users = split_text(users)
+def users_page(
+        after_id: int | None = None, before_id: int | None = None,
+) -> tuple[str, types.InlineKeyboardMarkup]:
+    rows, has_more = take_users_page(
+        after_id, before_id, limit=ADMIN_USERS_PAGE_SIZE,
+    )
+    if rows:
+        text = ''.join(
+            f'{user[0]}. id: {user[1]}, username: @{user[2]}\n'
+            for user in rows
+        )
+    else:
+        text = 'Пока нет зарегистрированных пользователей'
+
+    has_prev = has_more if before_id is not None else after_id is not None
+    has_next = has_more if before_id is None else True
+    markup = types.InlineKeyboardMarkup()
+    nav = []
+    if rows and has_prev:
+        nav.append(types.InlineKeyboardButton(
+            text='⬅️ Назад', callback_data=f'users:p:{rows[0][0]}',
+        ))
+    if rows and has_next:
+        nav.append(types.InlineKeyboardButton(
+            text='Далее ➡️', callback_data=f'users:n:{rows[-1][0]}',
+        ))
+    if nav:
+        markup.row(*nav)
+    markup.add(menu_admin_button())
+    return text, markup
+
 
+def show_users(message: Message) -> None:
+    text, markup = users_page()
     bot.send_message(
         chat_id=message.chat.id,
-        text=split_users,
-        reply_markup=menu_markup,
+        text=text,
+        reply_markup=markup,
     )
 
 
@@ -86,22 +119,235 @@ def show_balance(message: Message) -> None:
     )
 
 
-def show_message(message: Message) -> None:
-    menu_markup = types.InlineKeyboardMarkup()
-    menu_admin = types.InlineKeyboardButton(
-        text='Главное меню', callback_data='menu_admin',
+def history_page(
+        user_id: int | None = None,
+        older_than: int | None = None,
+        newer_than: int | None = None,
+) -> tuple[str, types.InlineKeyboardMarkup]:
+    rows, has_more = take_messages_page(
+        user_id, older_than, newer_than, limit=ADMIN_HISTORY_PAGE_SIZE,
+    )
+    header = f'История пользователя {user_id}:\n\n' if user_id else ''
+    if rows:
+        text = header + ''.join(
+            f'id: {row[1]}\nВремя: {row[2]}\nСообщение:\n'
+            f'{shorten(row[4])}\n\n'
+            for row in rows
+        )
+    else:
+        text = header + 'Пока никто ничего не спрашивал...'
+
+    has_newer = has_more if newer_than is not None else older_than is not None
+    has_older = has_more if newer_than is None else True
+    uid = user_id or 0
+    markup = types.InlineKeyboardMarkup()
+    nav = []
+    if rows and has_newer:
+        nav.append(types.InlineKeyboardButton(
+            text='⬅️ Новее', callback_data=f'hist:n:{rows[0][0]}:{uid}',
+        ))
+    if rows and has_older:
+        nav.append(types.InlineKeyboardButton(
+            text='Старее ➡️', callback_data=f'hist:o:{rows[-1][0]}:{uid}',
+        ))
+    if nav:
+        markup.row(*nav)
+    markup.add(types.InlineKeyboardButton(
+        text='📄 Выгрузить всё', callback_data=f'hist:e:0:{uid}',
+    ))
+    markup.add(menu_admin_button())
+    return text, markup
+
+
+def shorten(text: str, limit: int = 300) -> str:
+    return text if len(text) <= limit else text[:limit] + '…'
+
+
+def show_message(message: Message, user_id: int | None = None) -> None:
+    text, markup = history_page(user_id)
+    bot.send_message(
+        chat_id=message.chat.id,
+        text=text,
+        reply_markup=markup
     )
-    menu_markup.add(menu_admin)
 
-    messages = take_messages()
 
-    split_messages = split_text(messages)
+def history_command(message: Message) -> None:
+    """/history [user_id] — история всех или одного пользователя"""
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    args = message.text.split()[1:]
+    if args and not args[0].lstrip('-').isdigit():
+        bot.send_message(message.chat.id, 'Использование: /history [id]')
+        return
+    show_message(message, int(args[0]) if args else None)
 
-    bot.send_message(
-        chat_id=message.chat.id,
-        text=split_messages,
-        reply_markup=menu_markup
+
+SEARCH_USAGE = (
+    'Использование: /search слова [user:id] [from:ГГГГ-ММ-ДД] '
+    '[to:ГГГГ-ММ-ДД]\n'
+    'Слова ищутся с учётом словоформ, "фраза" ищется целиком, '
+    '-слово исключает сообщения с ним.'
+)
+
+
+def parse_search(text: str) -> dict | None:
+    """
+    '/search дроби user:42 from:2025-01-01' -> параметры поиска.
+    Даты хранятся строками: поиск лежит в state между страницами.
+    """
+    search: dict = {'query': [], 'user_id': None, 'since': None, 'until': None}
+    for word in text.split()[1:]:
+        name, _, value = word.partition(':')
+        try:
+            if name == 'user' and value:
+                search['user_id'] = int(value)
+            elif name == 'from' and value:
+                search['since'] = datetime.date.fromisoformat(value).isoformat()
+            elif name == 'to' and value:
+                until = datetime.date.fromisoformat(value)
+                search['until'] = (until + datetime.timedelta(days=1)).isoformat()
+            else:
+                search['query'].append(word)
+        except ValueError:
+            return None
+    search['query'] = ' '.join(search['query'])
+    return search if search['query'] else None
+
+
+def search_page(
+        search: dict, offset: int = 0,
+) -> tuple[str, types.InlineKeyboardMarkup]:
+    rows, has_more = search_messages(
+        search['query'],
+        search['user_id'],
+        search['since'] and datetime.date.fromisoformat(search['since']),
+        search['until'] and datetime.date.fromisoformat(search['until']),
+        offset=offset,
+        limit=ADMIN_HISTORY_PAGE_SIZE,
+    )
+    header = f'Поиск «{search["query"]}»:\n\n'
+    if rows:
+        text = header + ''.join(
+            f'{offset + i}. id: {row[1]} ({row[3]})\nВремя: {row[2]}\n'
+            f'{shorten(row[4])}\n\n'
+            for i, row in enumerate(rows, 1)
+        )
+    else:
+        text = header + 'Ничего не найдено'
+
+    markup = types.InlineKeyboardMarkup()
+    nav = []
+    if offset:
+        nav.append(types.InlineKeyboardButton(
+            text='⬅️ Назад',
+            callback_data=f'find:{max(0, offset - ADMIN_HISTORY_PAGE_SIZE)}',
+        ))
+    if has_more:
+        nav.append(types.InlineKeyboardButton(
+            text='Далее ➡️',
+            callback_data=f'find:{offset + ADMIN_HISTORY_PAGE_SIZE}',
+        ))
+    if nav:
+        markup.row(*nav)
+    markup.add(menu_admin_button())
+    return text, markup
+
+
+def search_command(message: Message) -> None:
+    """/search — полнотекстовый поиск по истории"""
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    search = parse_search(message.text)
+    if search is None:
+        bot.send_message(message.chat.id, SEARCH_USAGE)
+        return
+    set_search(message.chat.id, search)
+    text, markup = search_page(search)
+    bot.send_message(message.chat.id, text, reply_markup=markup)
+
+
+def handle_search_page(call: CallbackQuery) -> None:
+    if call.from_user.id not in ADMIN_IDS:
+        bot.answer_callback_query(call.id, '⛔ Нет прав администратора')
+        return
+    search = get_search(call.message.chat.id)
+    if search is None:
+        bot.answer_callback_query(call.id, 'Поиск устарел, повторите /search')
+        return
+    text, markup = search_page(search, int(call.data.split(':')[1]))
+    bot.edit_message_text(
+        text,
+        chat_id=call.message.chat.id,
+        message_id=call.message.message_id,
+        reply_markup=markup,
+    )
+    bot.answer_callback_query(call.id)
+
+
+def write_history_export(
+        file: typing.BinaryIO, user_id: int | None = None) -> int:
+    """Пишет историю в gzip JSONL построчно, возвращает число сообщений"""
+    count = write_jsonl_gz(file, iter_messages(user_id))
+    file.seek(0)
+    return count
+
+
+def export_history(chat_id: int, user_id: int | None = None) -> None:
+    try:
+        with tempfile.TemporaryFile() as file:
+            count = write_history_export(file, user_id)
+            name = f'history_{user_id}.jsonl.gz' if user_id else 'history.jsonl.gz'
+            bot.send_document(
+                chat_id,
+                types.InputFile(file, file_name=name),
+                caption=f'Выгружено сообщений: {count}',
+            )
+    except Exception as e:
+        logging.exception('Ошибка выгрузки истории: %s', e)
+        bot.send_message(chat_id, f'❌ Ошибка выгрузки истории: {e}')
+
+
+def parse_page_callback(data: str) -> tuple[str, str, int, int | None]:
+    """'hist:o:123:456' -> ('hist', 'o', 123, 456)"""
+    kind, direction, cursor, *rest = data.split(':')
+    user_id = int(rest[0]) if rest and rest[0] != '0' else None
+    return kind, direction, int(cursor), user_id
+
+
+def admin_page(data: str) -> tuple[str, types.InlineKeyboardMarkup]:
+    kind, direction, cursor, user_id = parse_page_callback(data)
+    if kind == 'users':
+        if direction == 'p':
+            return users_page(before_id=cursor)
+        return users_page(after_id=cursor)
+    if direction == 'n':
+        return history_page(user_id, newer_than=cursor)
+    return history_page(user_id, older_than=cursor)
+
+
+def handle_admin_page(call: CallbackQuery) -> None:
+    """Листание истории и пользователей без пересылки сообщения"""
+    if call.from_user.id not in ADMIN_IDS:
+        bot.answer_callback_query(call.id, '⛔ Нет прав администратора')
+        return
+    kind, direction, _, user_id = parse_page_callback(call.data)
+    if kind == 'hist' and direction == 'e':
+        bot.answer_callback_query(call.id, 'Готовим выгрузку...')
+        threading.Thread(
+            target=export_history,
+            args=(call.message.chat.id, user_id),
+            daemon=True,
+        ).start()
+        return
+    text, markup = admin_page(call.data)
+    bot.edit_message_text(
+        text,
+        chat_id=call.message.chat.id,
+        message_id=call.message.message_id,
+        reply_markup=markup,
     )
+    bot.answer_callback_query(call.id)
 
 
 def write_mailing_message(message: Message) -> None:
@@ -109,13 +355,11 @@ def write_mailing_message(message: Message) -> None:
         chat_id=message.chat.id,
         text='Введите сообщение для рассылки всем пользователям',
     )
-    bot.register_next_step_handler(message, check_mailing_message)
+    set_next_step(message.chat.id, 'mailing_message')
 
 
 def check_mailing_message(message: Message) -> None:
-    print('Попал в check_mailing')
-    # user_telegram_id = message.from_user.id
-    MAILING_TEXT[7900146404] = message.text
+    create_broadcast_draft(message.chat.id, message.text)
     markup = types.InlineKeyboardMarkup()
     accept_mailing_message = types.InlineKeyboardButton(
         text='Отправить', callback_data='accept_mailing_message'
@@ -137,96 +381,24 @@ def check_mailing_message(message: Message) -> None:
 
 
 def mailing(message: Message) -> None:
-    print(MAILING_TEXT)
-    user_telegram_id = message.from_user.id
-    text = MAILING_TEXT.get(user_telegram_id)
-    print(text)
-    if user_telegram_id not in MAILING_TEXT:
+    draft = get_broadcast_draft(message.chat.id)
+    if not draft:
         bot.send_message(message.chat.id, "❌ Ошибка: текст рассылки не найден")
         return
+    job_id, text = draft
 
-    users = take_user_telegram_id()
-    total = len(users)
-    success = 0
-    errors = 0
-    error_log = []
-
-    bot.send_message(
-        message.chat.id, f"🚀 Начало рассылки для {total} пользователей..."
+    progress = bot.send_message(
+        message.chat.id, f"🚀 Рассылка #{job_id} запускается..."
     )
-
-    for chat_id, in users:  # Извлекаем chat_id из кортежа
-        try:
-            bot.send_chat_action(chat_id, 'typing')
-            bot.send_message(chat_id, text)
-            success += 1
-            time.sleep(0.3)
-        except Exception as e:
-            errors += 1
-            error_log.append(f"{chat_id}: {str(e)}")
-            delete_invalid_user(chat_id)
-
-    # Формируем отчет
-    report = (
-        f"📊 Результаты рассылки:\n"
-        f"✅ Успешно: {success}\n"
-        f"❌ Ошибок: {errors}\n"
-        f"➖➖➖➖➖➖➖➖➖\n"
-        f"Лог ошибок:\n" + '\n'.join(error_log[:5])
-    )
-    bot.send_message(message.chat.id, report)
-    del MAILING_TEXT[user_telegram_id]
-    # users = take_user_telegram_id()
-    # msg = MAILING_TEXT.get(user_telegram_id)
-
-    # if not users:
-    #     bot.send_message(message.chat.id, "❌ Нет пользователей для рассылки")
-    #     return
-    # success = 0
-    # errors = 0
-    # error_details = []
-    # if not
-    # for user in users:
-    #     chat_id = user[0]
-    #     try:
-    #         # Проверка валидности chat_id
-    #         if not isinstance(chat_id, int):
-    #             errors += 1
-    #             error_details.append(f"Invalid ID: {chat_id}")
-    #             continue
-
-    #         # Отправка с задержкой 0.5 сек для избежания лимитов API
-    #         bot.send_message(chat_id=chat_id, text=msg)
-    #         success += 1
-    #         time.sleep(0.5)
-
-    #     except Exception as e:
-    #         errors += 1
-    #         error_details.append(f"{chat_id}: {str(e)}")
-    #         # Удаляем невалидного пользователя из БД
-    #         delete_invalid_user(chat_id)
-
-    # # Формируем отчет
-    # report = (
-    #     f"📊 Результат рассылки:\n"
-    #     f"✅ Успешно: {success}\n"
-    #     f"❌ Ошибок: {errors}\n"
-    #     f"⚙ Детали ошибок:\n" + "\n".join(error_details[:5])
-    # )
-
-    # # Отправляем отчет администратору
-    # bot.send_message(
-    #     chat_id=ADMIN_IDS[0],
-    #     text=report[:4000]  # Обрезаем до лимита Telegram
-    # )
-    # try:
-    #     for user in users:
-    #         bot.send_message(
-    #             chat_id=user[0],
-    #             text=msg
-    #         )
-    # except Exception as e:
-    #     bot.send_message(
-    #         chat_id=ADMIN_IDS[0],
-    #         text=f'Ошибка при отправке рассылки: {e}'
-    #     )
+    total = start_broadcast(job_id, progress.message_id)
+    if total is None:
+        return
+    if not total:
+        bot.edit_message_text(
+            "❌ Нет пользователей для рассылки",
+            chat_id=message.chat.id,
+            message_id=progress.message_id,
+        )
+        finish_broadcast(job_id)
+        return
+    launch_broadcast(job_id, message.chat.id, text, progress.message_id)
@@ -0,0 +1,247 @@
+"""
+Кэш ответов ассистента на повторяющиеся вопросы.
+
+Ответы хранятся в Postgres (answer_cache) отдельно для каждой пары
+ассистент + версия инструкций (для движка chat — ещё и для модели и
+системного промпта), устаревают через ANSWER_CACHE_TTL и
+вытесняются по давности использования сверх ANSWER_CACHE_SIZE.
+
+Точное совпадение ищется по нормализованному тексту вопроса. Похожие
+формулировки находятся в памяти по косинусной близости TF-IDF векторов
+символьных триграмм (хэшированных в DIM корзин). Чтобы «2x+3=7» не
+совпал с «2x+5=7», похожим считается только вопрос с теми же числами,
+переменными и знаками — меняться может лишь русский текст.
+"""
+import hashlib
+import logging
+import re
+import threading
+import time
+
+import numpy as np
+
+from const import (ANSWER_CACHE_SIZE, ANSWER_CACHE_TTL,
+                   ANSWER_CACHE_SIMILARITY, ANSWER_CACHE_MIN_LENGTH,
+                   ANSWER_CACHE_VERSION, ASSISTAND_ID, CONVERSATION_ENGINE,
+                   CHAT_MODEL, CHAT_SYSTEM_PROMPT,
+                   )
+from utils import normalize, question_key
+from database import (take_cached_questions, get_cached_answer,
+                      save_cached_answer, evict_cached_answers,
+                      )
+
+
+DIM = 2048
+NGRAM = 3
+# Через сколько новых вопросов пересчитывать IDF и всю матрицу
+REBUILD_EVERY = 0.1
+EVICT_EVERY = 100
+
+_SKELETON_DROP_RE = re.compile(r'[а-яё\s.,!?…:;«»"\'-]+')
+
+
+def math_skeleton(normalized: str) -> str:
+    """Числа, латинские переменные и знаки вопроса без русского текста"""
+    return _SKELETON_DROP_RE.sub('', normalized)
+
+
+def term_vector(normalized: str) -> np.ndarray:
+    """Хэшированные частоты триграмм с логарифмическим сглаживанием"""
+    padded = f' {normalized} '
+    buckets = [
+        hash(padded[i:i + NGRAM]) % DIM
+        for i in range(len(padded) - NGRAM + 1)
+    ]
+    counts = np.bincount(buckets, minlength=DIM).astype(np.float32)
+    return np.log1p(counts, out=counts)
+
+
+class NgramIndex:
+    """
+    Матрица TF-IDF векторов вопросов: ближайший вопрос ищется одним
+    умножением матрицы на вектор. Строки выделяются с запасом, а IDF
+    пересчитывается не на каждое добавление, а когда индекс вырос
+    на REBUILD_EVERY.
+    """
+
+    def __init__(self, capacity: int = 256) -> None:
+        self.keys: list[str] = []
+        self.skeletons: list[str] = []
+        self._positions: dict[str, int] = {}
+        self._terms = np.zeros((capacity, DIM), dtype=np.float32)
+        self._matrix = np.zeros((capacity, DIM), dtype=np.float32)
+        self._df = np.zeros(DIM, dtype=np.float32)
+        self._idf = np.ones(DIM, dtype=np.float32)
+        self._built_size = 0
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._positions
+
+    def add(self, key: str, normalized: str, rebuild: bool = True) -> None:
+        if key in self._positions:
+            return
+        row = len(self.keys)
+        if row == len(self._terms):
+            self._grow()
+        terms = term_vector(normalized)
+        self._terms[row] = terms
+        self._df += terms > 0
+        self._positions[key] = row
+        self.keys.append(key)
+        self.skeletons.append(math_skeleton(normalized))
+        if not rebuild:
+            return
+        if len(self.keys) > self._built_size * (1 + REBUILD_EVERY):
+            self.rebuild()
+        else:
+            self._matrix[row] = self._weigh(terms)
+
+    def remove(self, keys: list[str]) -> None:
+        drop = {self._positions[key] for key in keys if key in self._positions}
+        if not drop:
+            return
+        keep = [i for i in range(len(self.keys)) if i not in drop]
+        size = len(keep)
+        self._df -= (self._terms[sorted(drop)] > 0).sum(axis=0)
+        self._terms[:size] = self._terms[keep]
+        self._terms[size:] = 0
+        self.keys = [self.keys[i] for i in keep]
+        self.skeletons = [self.skeletons[i] for i in keep]
+        self._positions = {key: i for i, key in enumerate(self.keys)}
+        self.rebuild()
+
+    def rebuild(self) -> None:
+        size = len(self.keys)
+        self._idf = np.log((1 + size) / (1 + self._df)) + 1
+        self._matrix[:size] = self._weigh(self._terms[:size])
+        self._built_size = size
+
+    def nearest(self, normalized: str, threshold: float) -> str | None:
+        """Самый близкий вопрос с тем же «математическим скелетом»"""
+        size = len(self.keys)
+        if not size:
+            return None
+        scores = self._matrix[:size] @ self._weigh(term_vector(normalized))
+        candidates = np.flatnonzero(scores >= threshold)
+        skeleton = math_skeleton(normalized)
+        for i in candidates[np.argsort(scores[candidates])[::-1]]:
+            if self.skeletons[i] == skeleton:
+                return self.keys[i]
+        return None
+
+    def _grow(self) -> None:
+        capacity = len(self._terms) * 2
+        for name in ('_terms', '_matrix'):
+            grown = np.zeros((capacity, DIM), dtype=np.float32)
+            grown[:len(self.keys)] = getattr(self, name)[:len(self.keys)]
+            setattr(self, name, grown)
+
+    def _weigh(self, terms: np.ndarray) -> np.ndarray:
+        weighted = terms * self._idf
+        norms = np.linalg.norm(weighted, axis=-1, keepdims=True)
+        return weighted / np.maximum(norms, 1e-9)
+
+
+class AnswerCache:
+    """Кэш ответов одного ассистента с одной версией инструкций"""
+
+    def __init__(
+            self,
+            namespace: str,
+            max_size: int = ANSWER_CACHE_SIZE,
+            ttl: float = ANSWER_CACHE_TTL,
+            similarity: float = ANSWER_CACHE_SIMILARITY,
+            min_length: int = ANSWER_CACHE_MIN_LENGTH) -> None:
+        self.namespace = namespace
+        self.max_size = max_size
+        self.ttl = ttl
+        self.similarity = similarity
+        self.min_length = min_length
+        self.hits = 0
+        self.misses = 0
+        self._index = NgramIndex()
+        self._loaded = False
+        self._saved = 0
+        self._lock = threading.Lock()
+
+    def cacheable(self, question: str) -> bool:
+        """Короткие реплики вроде «а почему?» зависят от контекста диалога"""
+        return len(normalize(question)) >= self.min_length
+
+    def lookup(self, question: str) -> str | None:
+        """Ответ на тот же или почти тот же вопрос; ошибки кэша — промах"""
+        if not self.cacheable(question):
+            return None
+        started = time.perf_counter()
+        normalized = normalize(question)
+        key = question_key(normalized)
+        try:
+            with self._lock:
+                self._load()
+                if key not in self._index:
+                    key = self._index.nearest(normalized, self.similarity)
+            answer = key and get_cached_answer(self.namespace, key, self.ttl)
+        except Exception as e:
+            logging.exception("Ошибка чтения кэша ответов: %s", e)
+            answer = None
+        if not answer:
+            self.misses += 1
+            return None
+        self.hits += 1
+        logging.info(
+            "Ответ из кэша за %.1f мс", (time.perf_counter() - started) * 1000,
+        )
+        return answer
+
+    def store(self, question: str, answer: str) -> None:
+        if not answer or not self.cacheable(question):
+            return
+        normalized = normalize(question)
+        key = question_key(normalized)
+        try:
+            save_cached_answer(self.namespace, key, question, answer)
+            with self._lock:
+                self._load()
+                self._index.add(key, normalized)
+                self._saved += 1
+                if self._saved % EVICT_EVERY == 0:
+                    self._evict()
+        except Exception as e:
+            logging.exception("Ошибка записи в кэш ответов: %s", e)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            'size': len(self._index), 'hits': self.hits, 'misses': self.misses,
+        }
+
+    def _load(self) -> None:
+        if self._loaded:
+            return
+        for key, question in take_cached_questions(
+                self.namespace, self.max_size, self.ttl):
+            self._index.add(key, normalize(question), rebuild=False)
+        self._index.rebuild()
+        self._loaded = True
+        logging.info(
+            "Кэш ответов %s: загружено %s вопросов",
+            self.namespace, len(self._index),
+        )
+
+    def _evict(self) -> None:
+        evicted = evict_cached_answers(self.namespace, self.max_size, self.ttl)
+        if evicted:
+            self._index.remove(evicted)
+
+
+def cache_namespace() -> str:
+    namespace = f'{ASSISTAND_ID}:{ANSWER_CACHE_VERSION}'
+    if CONVERSATION_ENGINE != 'chat':
+        return namespace
+    prompt = hashlib.sha1((CHAT_SYSTEM_PROMPT or '').encode()).hexdigest()
+    return f'{namespace}:chat:{CHAT_MODEL or ""}:{prompt[:12]}'
+
+
+answer_cache = AnswerCache(cache_namespace())
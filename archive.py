@@ -0,0 +1,129 @@
+"""
+Хранение истории: партиции messages старше MESSAGE_RETENTION_MONTHS
+выгружаются в ARCHIVE_DIR/messages_ГГГГ_ММ.jsonl.gz и удаляются из БД.
+Архивация включается явно: без MESSAGE_RETENTION_MONTHS история не
+удаляется, а без абсолютного ARCHIVE_DIR архивация не запускается.
+
+Фоновая задача раз в ARCHIVE_INTERVAL секунд создаёт партиции на
+следующие месяцы и архивирует устаревшие. Удаление партиции целиком
+не оставляет мёртвых строк, поэтому таблице не нужен тяжёлый VACUUM
+после чистки. Если экземпляров бота несколько, одну партицию
+архивирует только один из них (advisory lock).
+"""
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+import typing
+
+from database import get_connection
+from partitions import (add_months, current_month, ensure_partitions,
+                        list_partitions,
+                        )
+from const import MESSAGE_RETENTION_MONTHS, ARCHIVE_DIR, ARCHIVE_INTERVAL
+
+
+ARCHIVE_LOCK_ID = 7_201_505
+# Не ждать дольше, если таблицу держат долгие запросы: повторим позже
+ARCHIVE_LOCK_TIMEOUT = '5s'
+
+
+def message_record(row: tuple) -> dict[str, typing.Any]:
+    """Строка (id, user_id, thread_id, role, content, timestamp) для JSONL"""
+    return {
+        'id': row[0],
+        'user_id': row[1],
+        'thread_id': row[2],
+        'role': row[3],
+        'content': row[4],
+        'timestamp': row[5].isoformat() if row[5] else None,
+    }
+
+
+def write_jsonl_gz(file: typing.BinaryIO, rows: typing.Iterable[tuple]) -> int:
+    """Пишет сообщения в gzip JSONL построчно, возвращает их число"""
+    count = 0
+    with gzip.GzipFile(fileobj=file, mode='wb') as archive:
+        for row in rows:
+            archive.write((
+                json.dumps(message_record(row), ensure_ascii=False) + '\n'
+            ).encode())
+            count += 1
+    return count
+
+
+def archive_partition(name: str) -> bool:
+    """
+    Выгружает партицию в файл и удаляет её в одной транзакции: если
+    удалить не вышло, партиция остаётся и выгрузится заново.
+    """
+    path = os.path.join(ARCHIVE_DIR, f'{name}.jsonl.gz')
+    with get_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                'SELECT pg_try_advisory_xact_lock(%s, hashtext(%s))',
+                (ARCHIVE_LOCK_ID, name),
+            )
+            if not cursor.fetchone()[0]:
+                return False
+        with conn.cursor(name=f'archive_{name}') as cursor:
+            cursor.itersize = 5000
+            cursor.execute(f'''
+                SELECT id, user_id, thread_id, role, content, timestamp
+                FROM {name} ORDER BY timestamp, id
+            ''')
+            os.makedirs(ARCHIVE_DIR, exist_ok=True)
+            with open(path + '.tmp', 'wb') as file:
+                count = write_jsonl_gz(file, cursor)
+                file.flush()
+                os.fsync(file.fileno())
+        os.replace(path + '.tmp', path)
+        with conn.cursor() as cursor:
+            cursor.execute(f"SET LOCAL lock_timeout = '{ARCHIVE_LOCK_TIMEOUT}'")
+            cursor.execute(f'ALTER TABLE messages DETACH PARTITION {name}')
+            cursor.execute(f'DROP TABLE {name}')
+    logging.info("Партиция %s: %s сообщений выгружено в %s", name, count, path)
+    return True
+
+
+def maintain_messages() -> None:
+    """Создаёт партиции впереди и архивирует устаревшие"""
+    try:
+        with get_connection() as conn, conn.cursor() as cursor:
+            ensure_partitions(cursor)
+    except Exception as e:
+        # Например, в messages_default уже есть строки этого месяца
+        logging.exception("Не удалось создать партиции messages: %s", e)
+    if not MESSAGE_RETENTION_MONTHS:
+        return
+    if not ARCHIVE_DIR or not os.path.isabs(ARCHIVE_DIR):
+        logging.error(
+            "MESSAGE_RETENTION_MONTHS задан, но ARCHIVE_DIR не задан "
+            "абсолютным путём: история не архивируется"
+        )
+        return
+    with get_connection() as conn, conn.cursor() as cursor:
+        cutoff = add_months(current_month(cursor), -MESSAGE_RETENTION_MONTHS)
+        partitions = list_partitions(cursor)
+    for month, name in sorted(partitions.items()):
+        if month >= cutoff:
+            break
+        try:
+            archive_partition(name)
+        except Exception as e:
+            logging.exception("Не удалось архивировать %s: %s", name, e)
+
+
+def run_archiver() -> None:
+    while True:
+        try:
+            maintain_messages()
+        except Exception as e:
+            logging.exception("Ошибка обслуживания истории: %s", e)
+        time.sleep(ARCHIVE_INTERVAL)
+
+
+def start_archiver() -> None:
+    threading.Thread(target=run_archiver, name='archiver', daemon=True).start()
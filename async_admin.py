@@ -0,0 +1,238 @@
+import asyncio
+import logging
+import tempfile
+
+from telebot import types
+from telebot.types import Message, CallbackQuery
+
+from database import (create_broadcast_draft, get_broadcast_draft,
+                      start_broadcast, finish_broadcast, set_search,
+                      get_search,
+                      )
+from async_bot_instance import bot, Steps
+from admin import (users_page, history_page, admin_page,
+                   parse_page_callback, write_history_export,
+                   parse_search, search_page, SEARCH_USAGE,
+                   )
+from balance import checking_balance
+from broadcast import launch_broadcast
+from const import ADMIN_IDS
+
+
+def menu_admin_markup() -> types.InlineKeyboardMarkup:
+    menu_markup = types.InlineKeyboardMarkup()
+    menu_admin = types.InlineKeyboardButton(
+        text='Главное меню', callback_data='menu_admin',
+    )
+    menu_markup.add(menu_admin)
+    return menu_markup
+
+
+async def admin_menu(message: Message) -> None:
+
+    if message.from_user.id not in ADMIN_IDS:
+        await bot.send_message(
+            chat_id=message.chat.id,
+            text="⛔ У вас нет прав администратора!")
+        return
+
+    markup = types.InlineKeyboardMarkup()
+    show_users = types.InlineKeyboardButton(
+        text='Показать пользователей',
+        callback_data='show_users'
+    )
+
+    show_balance = types.InlineKeyboardButton(
+        text='Показать баланс',
+        callback_data='show_balance',
+    )
+
+    show_history = types.InlineKeyboardButton(
+        'История сообщений', callback_data='show_history',
+    )
+    setup_mailing = types.InlineKeyboardButton(
+        text='Запустить рассылку', callback_data='take_mailing_message',
+    )
+
+    markup.add(show_users)
+    markup.add(show_history)
+    markup.add(show_balance)
+    markup.add(setup_mailing)
+
+    await bot.send_message(
+        chat_id=message.chat.id,
+        text="🔐 Админ-панель:\n/history id — история одного пользователя",
+        reply_markup=markup
+    )
+
+
+async def show_users(message: Message) -> None:
+    text, markup = await asyncio.to_thread(users_page)
+    await bot.send_message(
+        chat_id=message.chat.id,
+        text=text,
+        reply_markup=markup,
+    )
+
+
+async def show_balance(message: Message) -> None:
+    await bot.send_message(
+        text=await asyncio.to_thread(checking_balance),
+        chat_id=message.chat.id,
+        reply_markup=menu_admin_markup(),
+    )
+
+
+async def show_message(message: Message, user_id: int | None = None) -> None:
+    text, markup = await asyncio.to_thread(history_page, user_id)
+    await bot.send_message(
+        chat_id=message.chat.id,
+        text=text,
+        reply_markup=markup
+    )
+
+
+async def history_command(message: Message) -> None:
+    """/history [user_id] — история всех или одного пользователя"""
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    args = message.text.split()[1:]
+    if args and not args[0].lstrip('-').isdigit():
+        await bot.send_message(message.chat.id, 'Использование: /history [id]')
+        return
+    await show_message(message, int(args[0]) if args else None)
+
+
+async def export_history(chat_id: int, user_id: int | None = None) -> None:
+    try:
+        with tempfile.TemporaryFile() as file:
+            count = await asyncio.to_thread(
+                write_history_export, file, user_id,
+            )
+            name = f'history_{user_id}.jsonl.gz' if user_id else 'history.jsonl.gz'
+            await bot.send_document(
+                chat_id,
+                types.InputFile(file, file_name=name),
+                caption=f'Выгружено сообщений: {count}',
+            )
+    except Exception as e:
+        logging.exception('Ошибка выгрузки истории: %s', e)
+        await bot.send_message(chat_id, f'❌ Ошибка выгрузки истории: {e}')
+
+
+async def handle_admin_page(call: CallbackQuery) -> None:
+    """Листание истории и пользователей без пересылки сообщения"""
+    if call.from_user.id not in ADMIN_IDS:
+        await bot.answer_callback_query(call.id, '⛔ Нет прав администратора')
+        return
+    kind, direction, _, user_id = parse_page_callback(call.data)
+    if kind == 'hist' and direction == 'e':
+        await bot.answer_callback_query(call.id, 'Готовим выгрузку...')
+        await export_history(call.message.chat.id, user_id)
+        return
+    text, markup = await asyncio.to_thread(admin_page, call.data)
+    await bot.edit_message_text(
+        text,
+        chat_id=call.message.chat.id,
+        message_id=call.message.message_id,
+        reply_markup=markup,
+    )
+    await bot.answer_callback_query(call.id)
+
+
+async def search_command(message: Message) -> None:
+    """/search — полнотекстовый поиск по истории"""
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    search = parse_search(message.text)
+    if search is None:
+        await bot.send_message(message.chat.id, SEARCH_USAGE)
+        return
+    await asyncio.to_thread(set_search, message.chat.id, search)
+    text, markup = await asyncio.to_thread(search_page, search)
+    await bot.send_message(message.chat.id, text, reply_markup=markup)
+
+
+async def handle_search_page(call: CallbackQuery) -> None:
+    if call.from_user.id not in ADMIN_IDS:
+        await bot.answer_callback_query(call.id, '⛔ Нет прав администратора')
+        return
+    search = await asyncio.to_thread(get_search, call.message.chat.id)
+    if search is None:
+        await bot.answer_callback_query(
+            call.id, 'Поиск устарел, повторите /search',
+        )
+        return
+    text, markup = await asyncio.to_thread(
+        search_page, search, int(call.data.split(':')[1]),
+    )
+    await bot.edit_message_text(
+        text,
+        chat_id=call.message.chat.id,
+        message_id=call.message.message_id,
+        reply_markup=markup,
+    )
+    await bot.answer_callback_query(call.id)
+
+
+async def write_mailing_message(message: Message) -> None:
+    await bot.send_message(
+        chat_id=message.chat.id,
+        text='Введите сообщение для рассылки всем пользователям',
+    )
+    await bot.set_state(
+        message.chat.id, Steps.mailing_message, message.chat.id,
+    )
+
+
+async def check_mailing_message(message: Message) -> None:
+    await bot.delete_state(message.chat.id, message.chat.id)
+    await asyncio.to_thread(
+        create_broadcast_draft, message.chat.id, message.text,
+    )
+    markup = types.InlineKeyboardMarkup()
+    accept_mailing_message = types.InlineKeyboardButton(
+        text='Отправить', callback_data='accept_mailing_message'
+    )
+    rewrite_mailing_message = types.InlineKeyboardButton(
+        text='Переписать', callback_data='rewrite_mailing_message'
+    )
+    menu_admin = types.InlineKeyboardButton(
+        text='Меню администратора', callback_data='menu_admin'
+    )
+    markup.add(accept_mailing_message)
+    markup.add(rewrite_mailing_message)
+    markup.add(menu_admin)
+    await bot.send_message(
+        chat_id=message.chat.id,
+        text=f'Проверьте сообщения перед отправкой:\n\n{message.text}',
+        reply_markup=markup
+    )
+
+
+async def mailing(message: Message) -> None:
+    draft = await asyncio.to_thread(get_broadcast_draft, message.chat.id)
+    if not draft:
+        await bot.send_message(
+            message.chat.id, "❌ Ошибка: текст рассылки не найден",
+        )
+        return
+    job_id, text = draft
+
+    progress = await bot.send_message(
+        message.chat.id, f"🚀 Рассылка #{job_id} запускается..."
+    )
+    total = await asyncio.to_thread(
+        start_broadcast, job_id, progress.message_id,
+    )
+    if total is None:
+        return
+    if not total:
+        await bot.edit_message_text(
+            "❌ Нет пользователей для рассылки",
+            chat_id=message.chat.id,
+            message_id=progress.message_id,
+        )
+        await asyncio.to_thread(finish_broadcast, job_id)
+        return
+    launch_broadcast(job_id, message.chat.id, text, progress.message_id)
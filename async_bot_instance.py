@@ -0,0 +1,21 @@
+from telebot import asyncio_filters
+from telebot.async_telebot import AsyncTeleBot
+from telebot.states import State, StatesGroup
+
+from const import TEST_TELEGRAM_TOKEN, STEP_TTL
+from database import state
+from state_store import StoreStateStorage
+
+
+bot = AsyncTeleBot(
+    token=TEST_TELEGRAM_TOKEN,
+    state_storage=StoreStateStorage(state, STEP_TTL),
+)
+bot.add_custom_filter(asyncio_filters.StateFilter(bot))
+
+
+class Steps(StatesGroup):
+    """Аналог register_next_step_handler для асинхронного бота"""
+    image_prompt = State()
+    fix_bot = State()
+    mailing_message = State()
@@ -0,0 +1,67 @@
+"""
+Корутинные обёртки над database.py для асинхронного бота.
+
+psycopg2 блокирующий, поэтому запросы выполняются в потоках
+asyncio.to_thread поверх общего пула соединений, а event loop
+продолжает обслуживать остальные диалоги.
+"""
+import asyncio
+
+import database
+
+
+async def setup_database() -> None:
+    await asyncio.to_thread(database.setup_database)
+
+
+async def add_member_to_db(
+        user_telegram_id: int, telegram_username: str) -> None:
+    await asyncio.to_thread(
+        database.add_member_to_db, user_telegram_id, telegram_username,
+    )
+
+
+async def set_user_active_status(user_id: int, is_active: bool) -> None:
+    await asyncio.to_thread(
+        database.set_user_active_status, user_id, is_active,
+    )
+
+
+async def is_user_active(user_id: int) -> bool:
+    return await asyncio.to_thread(database.is_user_active, user_id)
+
+
+async def get_thread_id(user_id: int) -> str:
+    return await asyncio.to_thread(database.get_thread_id, user_id)
+
+
+async def set_thread_id(user_id: int, thread_id: str) -> None:
+    await asyncio.to_thread(database.set_thread_id, user_id, thread_id)
+
+
+async def save_message(
+        user_id: int, thread_id: str, role: str, content: str) -> None:
+    await asyncio.to_thread(
+        database.save_message, user_id, thread_id, role, content,
+    )
+
+
+async def add_thread_files(
+        user_id: int, thread_id: str, file_ids: list[str]) -> None:
+    await asyncio.to_thread(
+        database.add_thread_files, user_id, thread_id, file_ids,
+    )
+
+
+async def delete_user_history(user_id: int) -> bool:
+    return await asyncio.to_thread(database.delete_user_history, user_id)
+
+
+async def get_cached_image(prompt_key: str) -> str | None:
+    return await asyncio.to_thread(database.get_cached_image, prompt_key)
+
+
+async def save_cached_image(prompt_key: str, prompt: str, file_id: str) -> None:
+    await asyncio.to_thread(
+        database.save_cached_image, prompt_key, prompt, file_id,
+    )
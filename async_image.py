@@ -0,0 +1,147 @@
+import logging
+
+from telebot import types
+from telebot.types import Message
+
+from async_bot_instance import bot, Steps
+from openai_client import async_client
+from const import ADMIN_IDS, IMAGE_CACHE
+from async_database import get_cached_image, save_cached_image
+from image import IMAGE_MODEL, IMAGE_SIZE, prompt_key
+from media import AsyncMediaWorkers
+
+
+# Ключ промпта -> чаты, которые ждут уже идущую генерацию
+_in_progress: dict[str, list[int]] = {}
+
+
+async def take_image_prompt_from_user(message: Message) -> None:
+    markup = types.ReplyKeyboardMarkup(
+        resize_keyboard=True, one_time_keyboard=True
+    )
+    end_button = types.KeyboardButton('Закончить ответ')
+    markup.add(end_button)
+    await bot.send_message(
+        chat_id=message.chat.id,
+        text='Опишите, что именно вы хотите изобразить на картинке',
+        reply_markup=markup
+    )
+    await bot.set_state(message.chat.id, Steps.image_prompt, message.chat.id)
+
+
+async def handle_image_prompt(
+        message: Message, image_workers: AsyncMediaWorkers) -> None:
+    await bot.delete_state(message.chat.id, message.chat.id)
+    try:
+        if message.text == 'Закончить ответ':
+            await bot.send_message(
+                chat_id=message.chat.id,
+                text="Генерация изображения отменена.",
+                reply_markup=types.ReplyKeyboardRemove()
+            )
+            return
+        if not message.text:
+            await bot.send_message(
+                chat_id=message.chat.id,
+                text="Опишите картинку текстом.",
+                reply_markup=types.ReplyKeyboardRemove()
+            )
+            return
+
+        key = prompt_key(message.text)
+        if IMAGE_CACHE and await send_cached_image(message.chat.id, key):
+            return
+
+        if key in _in_progress:
+            _in_progress[key].append(message.chat.id)
+            await bot.send_message(
+                chat_id=message.chat.id,
+                text="🎨 Такую картинку уже рисуем, пришлём, как будет готова.",
+                reply_markup=types.ReplyKeyboardRemove()
+            )
+            return
+        _in_progress[key] = []
+
+        position = image_workers.submit(
+            generate_image, message.chat.id, key, message.text,
+        )
+        if position:
+            await bot.send_message(
+                chat_id=message.chat.id,
+                text=f"🎨 Вы {position}-й в очереди на генерацию картинки.",
+                reply_markup=types.ReplyKeyboardRemove()
+            )
+        else:
+            await bot.send_chat_action(message.chat.id, 'upload_photo')
+
+    except Exception as e:
+        await bot.send_message(
+            chat_id=message.chat.id,
+            text=f"Произошла ошибка: {str(e)}"
+        )
+
+
+async def send_cached_image(chat_id: int, key: str) -> bool:
+    try:
+        file_id = await get_cached_image(key)
+    except Exception as e:
+        logging.exception("Ошибка чтения кэша картинок: %s", e)
+        return False
+    if not file_id:
+        return False
+    await bot.send_photo(
+        chat_id=chat_id,
+        photo=file_id,
+        reply_markup=types.ReplyKeyboardRemove()
+    )
+    # Копия администратору уходит только с новой генерации
+    return True
+
+
+async def generate_image(chat_id: int, key: str, prompt: str) -> None:
+    file_id = None
+    try:
+        await bot.send_chat_action(chat_id, 'upload_photo')
+        sent = await bot.send_photo(
+            chat_id=chat_id,
+            photo=await create_image(prompt),
+            reply_markup=types.ReplyKeyboardRemove()
+        )
+        file_id = sent.photo[-1].file_id
+        if IMAGE_CACHE:
+            await save_cached_image(key, prompt, file_id)
+    except Exception as e:
+        logging.exception("Ошибка генерации картинки: %s", e)
+        if not file_id:
+            await bot.send_message(
+                chat_id=chat_id, text=f"Произошла ошибка: {str(e)}",
+            )
+    finally:
+        waiters = _in_progress.pop(key, [])
+
+    if not file_id:
+        for waiter in waiters:
+            await bot.send_message(
+                chat_id=waiter,
+                text="Не удалось нарисовать картинку, попробуйте ещё раз.",
+            )
+        return
+
+    for recipient in [*waiters, ADMIN_IDS[0]]:
+        try:
+            await bot.send_photo(chat_id=recipient, photo=file_id)
+        except Exception as e:
+            logging.exception(
+                "Не удалось отправить картинку %s: %s", recipient, e,
+            )
+
+
+async def create_image(prompt: str) -> str:
+    response = await async_client.images.generate(
+        model=IMAGE_MODEL,
+        prompt=prompt,
+        size=IMAGE_SIZE,
+        quality="standard",
+        n=1,
+    )
+    return response.data[0].url
@@ -0,0 +1,671 @@
+"""
+Асинхронная точка входа бота: AsyncTeleBot + AsyncOpenAI.
+
+Поведение совпадает с main.py, но обработчики, запросы к OpenAI,
+отправка в Telegram и работа с БД — корутины, поэтому ожидание ответа
+ассистента не занимает отдельный поток на каждый диалог.
+
+Запуск: python async_main.py
+"""
+import asyncio
+import io
+import logging
+import time
+import typing
+
+import openai
+from openai.types.beta.threads import Run
+from telebot import types
+from telebot.types import Message, CallbackQuery
+
+from async_bot_instance import bot, Steps
+from openai_client import async_client
+from async_database import (setup_database, get_thread_id,
+                            save_message, add_member_to_db,
+                            set_user_active_status, is_user_active,
+                            delete_user_history, set_thread_id,
+                            add_thread_files,
+                            )
+from utils import format_reply
+from async_admin import (admin_menu, show_users,
+                         show_balance, show_message,
+                         mailing, write_mailing_message,
+                         check_mailing_message,
+                         history_command, handle_admin_page,
+                         search_command, handle_search_page,
+                         )
+from conversation_queue import AsyncConversationQueue, merge_contents
+from context import (run_params, should_compact, compact_thread,
+                     drop_thread_files,
+                     )
+from run_manager import (RUN_FINAL_STATUSES, RUN_POLL_MIN, RUN_POLL_MAX,
+                         RUN_POLL_BACKOFF, RUN_CANCEL_GRACE,
+                         )
+from answer_cache import answer_cache
+from chat_engine import new_thread_id, conversation_context, complete
+from media import (AsyncMediaWorkers, MediaTooLargeError,
+                   voice_limit_error, voice_too_large_text,
+                   photo_content, photo_history_text, choose_photo_size,
+                   preprocess_photo, image_url_part, image_file_part,
+                   uploaded_file_ids, delete_uploaded_files,
+                   )
+from async_image import take_image_prompt_from_user, handle_image_prompt
+from broadcast import resume_broadcasts
+from archive import start_archiver
+from async_webhook import run_webhook, run_polling
+from const import (ADMIN_IDS, ASSISTAND_ID, INFO_ABOUT_BOT, ANSWER_CACHE,
+                   CONVERSATION_ENGINE, VOICE_WORKERS, VOICE_MAX_SIZE,
+                   PHOTO_WORKERS, PHOTO_MAX_SIZE, IMAGE_WORKERS, BOT_MODE,
+                   RUN_TIMEOUT,
+                   )
+
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s [%(levelname)s] %(message)s",
+    handlers=[
+        logging.FileHandler("bot.log"),
+        logging.StreamHandler()
+    ]
+)
+
+background_tasks = set()
+
+
+def spawn(coro: typing.Coroutine) -> None:
+    """Запускает корутину в фоне и держит ссылку до её завершения"""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+
+async def get_or_create_thread_id(user_id: int) -> typing.Optional[str]:
+    thread_id = await get_thread_id(user_id)
+    if thread_id:
+        return thread_id
+    if CONVERSATION_ENGINE == 'chat':
+        thread_id = new_thread_id()
+        await set_thread_id(user_id, thread_id)
+        return thread_id
+    try:
+        thread = await async_client.beta.threads.create()
+    except Exception as e:
+        logging.exception("Ошибка создания потока: %s", e)
+        return None
+    await set_thread_id(user_id, thread.id)
+    return thread.id
+
+
+@bot.message_handler(commands=["start"])
+async def start(message: Message) -> None:
+    markup = types.InlineKeyboardMarkup()
+    buttom = types.InlineKeyboardButton(
+        text='Хочу общаться',
+        callback_data='ai',
+    )
+    create_image = types.InlineKeyboardButton(
+        text='Генерация картинок',
+        callback_data='create_image',
+    )
+    info = types.InlineKeyboardButton(
+        text='Общая информация о проекте',
+        callback_data='info',
+    )
+    fix_bot = types.InlineKeyboardButton(
+        text='Не работает бот?',
+        callback_data='fix_bot',
+    )
+    markup.add(buttom)
+    markup.add(create_image)
+    markup.add(info)
+    markup.add(fix_bot)
+    user_telegram_id = message.from_user.id
+    telegram_username = message.from_user.username or "no_username"
+    await add_member_to_db(user_telegram_id, telegram_username)
+    user_id = message.chat.id
+    await get_or_create_thread_id(user_id)
+    await bot.send_message(
+        chat_id=user_id,
+        text="Привет! Я математический помощник. Задавай свои вопросы!",
+        reply_markup=markup
+    )
+
+
+@bot.message_handler(commands=['admin'])
+async def admin(message: Message) -> None:
+    await admin_menu(message)
+
+
+@bot.message_handler(commands=['history'])
+async def history(message: Message) -> None:
+    await history_command(message)
+
+
+@bot.message_handler(commands=['search'])
+async def search(message: Message) -> None:
+    await search_command(message)
+
+
+@bot.message_handler(state=Steps.image_prompt)
+async def image_prompt_step(message: Message) -> None:
+    await handle_image_prompt(message, image_workers)
+
+
+@bot.message_handler(state=Steps.mailing_message)
+async def mailing_message_step(message: Message) -> None:
+    await check_mailing_message(message)
+
+
+@bot.message_handler(state=Steps.fix_bot)
+async def fix_bot_step(message: Message) -> None:
+    await bot.delete_state(message.chat.id, message.chat.id)
+    await fix_bot(message)
+
+
+async def send_processing_status(user_id: int) -> int:
+    status_msg = await bot.send_message(
+        user_id, "🔄 Бот обрабатывает ваш вопрос...",
+    )
+    return status_msg.message_id
+
+
+async def take_message_from_user(message: Message) -> None:
+    markup = types.ReplyKeyboardMarkup(
+        one_time_keyboard=True, resize_keyboard=True
+    )
+    markup.add(types.KeyboardButton('Закончить ответ'))
+    await bot.send_message(
+        chat_id=message.chat.id,
+        text="Режим диалога активирован!",
+        reply_markup=markup
+    )
+
+
+async def run_openai_with_retries(
+        thread_id: str, assistant_id: str, retries: int = 3
+        ) -> typing.Optional[Run]:
+    for attempt in range(retries):
+        try:
+            return await async_client.beta.threads.runs.create(
+                thread_id=thread_id,
+                assistant_id=assistant_id,
+                **run_params(),
+            )
+        except openai.RateLimitError:
+            wait_time = 2 ** attempt * 5
+            logging.warning("⚠️ Rate limit: ждём %s сек...", wait_time)
+            await asyncio.sleep(wait_time)
+        except Exception as e:
+            logging.exception("🚨 Ошибка при запросе в OpenAI: %s", e)
+            return None
+    logging.error("❌ Не удалось выполнить запрос после повторов.")
+    return None
+
+
+async def add_user_message(
+        user_id: int, thread_id: str, content: typing.Any) -> bool:
+    try:
+        await async_client.beta.threads.messages.create(
+            thread_id=thread_id,
+            role="user",
+            content=content
+        )
+        return True
+    except Exception as e:
+        logging.exception("Ошибка добавления сообщения в поток: %s", e)
+        return False
+
+
+@bot.message_handler(func=lambda message: True)
+async def handle_message(message: Message) -> None:
+    user_id = message.chat.id
+    user_text = message.text[:4096]
+
+    if not await is_user_active(message.from_user.id):
+        return
+
+    if message.text == 'Закончить ответ':
+        await set_user_active_status(message.from_user.id, False)
+        await bot.send_message(
+            chat_id=message.chat.id,
+            text="Диалог завершен!",
+            reply_markup=types.ReplyKeyboardRemove()
+        )
+        return await start(message)
+
+    thread_id = await get_or_create_thread_id(user_id)
+    if not thread_id:
+        await bot.send_message(
+            user_id, "Ошибка: Не удалось создать поток для общения.",
+        )
+        return
+
+    await save_message(user_id, thread_id, "user", user_text)
+    await bot.send_chat_action(message.chat.id, 'typing')
+    conversations.submit(thread_id, user_id, user_text)
+
+
+async def answer_batch(thread_id: str, batch: list) -> None:
+    """Один запуск ассистента на все накопившиеся сообщения потока"""
+    user_id = batch[0][0]
+    current_thread_id = await get_thread_id(user_id)
+    if current_thread_id and current_thread_id != thread_id:
+        # Пока сообщения ждали, диалог свернули в новый поток
+        for item_user_id, item in batch:
+            conversations.submit(current_thread_id, item_user_id, item)
+        return
+    content = merge_contents([content for _, content in batch])
+    cacheable = ANSWER_CACHE and isinstance(content, str)
+    if cacheable:
+        answer = await asyncio.to_thread(answer_cache.lookup, content)
+        if answer:
+            await send_cached_answer(user_id, thread_id, content, answer)
+            return
+    file_ids = uploaded_file_ids(content)
+    status_message_id = await send_processing_status(user_id)
+    if CONVERSATION_ENGINE == 'chat':
+        answer = await process_chat_reply(
+            user_id, thread_id, status_message_id, content,
+        )
+    elif await add_user_message(user_id, thread_id, content):
+        await add_thread_files(user_id, thread_id, file_ids)
+        answer = await process_openai_reply(
+            user_id, thread_id, status_message_id,
+        )
+    else:
+        await bot.send_message(
+            user_id,
+            "⚠️ Не удалось получить ответ от OpenAI. Попробуйте позже."
+        )
+        await bot.delete_message(user_id, status_message_id)
+        if file_ids:
+            await asyncio.to_thread(delete_uploaded_files, file_ids)
+        return
+    if cacheable and answer:
+        await asyncio.to_thread(answer_cache.store, content, answer)
+    if should_compact(thread_id):
+        await asyncio.to_thread(compact_thread, user_id, thread_id)
+
+
+async def send_cached_answer(
+        user_id: int, thread_id: str, question: str, answer: str) -> None:
+    """Ответ из кэша; вопрос и ответ добавляются в поток для контекста"""
+    if CONVERSATION_ENGINE != 'chat':
+        try:
+            await async_client.beta.threads.messages.create(
+                thread_id=thread_id, role="user", content=question,
+            )
+            await async_client.beta.threads.messages.create(
+                thread_id=thread_id, role="assistant", content=answer,
+            )
+        except Exception as e:
+            logging.exception(
+                "Ошибка добавления ответа из кэша в поток: %s", e,
+            )
+    for part in format_reply(answer):
+        await save_message(user_id, thread_id, "assistant", part)
+        await bot.send_message(user_id, part, parse_mode='MarkdownV2')
+
+
+conversations = AsyncConversationQueue(spawn, answer_batch)
+transcribers = AsyncMediaWorkers(VOICE_WORKERS, spawn)
+photo_workers = AsyncMediaWorkers(PHOTO_WORKERS, spawn)
+image_workers = AsyncMediaWorkers(IMAGE_WORKERS, spawn)
+
+
+async def wait_for_run(thread_id: str, run: Run) -> Run:
+    """
+    Опрос с растущим интервалом и сроком RUN_TIMEOUT, как в RunManager:
+    зависший запуск отменяется, чтобы поток принял следующий.
+    """
+    deadline = time.monotonic() + RUN_TIMEOUT
+    interval = RUN_POLL_MIN
+    cancelling = False
+    while True:
+        if run.status == "requires_action":
+            if not cancelling:
+                # Инструментов у ассистента нет: ждать здесь нечего
+                deadline = 0
+        elif run.status in RUN_FINAL_STATUSES:
+            return run
+        if time.monotonic() > deadline:
+            if cancelling:
+                logging.error("Запуск %s не отменился вовремя", run.id)
+                return run
+            logging.warning(
+                "Отменяем запуск %s (статус %s)", run.id, run.status,
+            )
+            cancelling = True
+            deadline = time.monotonic() + RUN_CANCEL_GRACE
+            interval = RUN_POLL_MIN
+            try:
+                run = await async_client.beta.threads.runs.cancel(
+                    thread_id=thread_id, run_id=run.id,
+                )
+            except Exception as e:
+                logging.warning("Ошибка отмены запуска %s: %s", run.id, e)
+            continue
+        await asyncio.sleep(interval)
+        interval = min(interval * RUN_POLL_BACKOFF, RUN_POLL_MAX)
+        try:
+            run = await async_client.beta.threads.runs.retrieve(
+                thread_id=thread_id, run_id=run.id,
+            )
+        except Exception as e:
+            logging.warning("Ошибка опроса запуска %s: %s", run.id, e)
+
+
+async def process_chat_reply(
+        user_id: int, thread_id: str, status_message_id: int,
+        content: typing.Any = None) -> typing.Optional[str]:
+    """Один потоковый запрос chat completions с контекстом из истории"""
+    try:
+        messages = await asyncio.to_thread(
+            conversation_context, user_id, thread_id, content,
+        )
+        assistant_reply = await complete(messages)
+    except Exception as e:
+        logging.exception("🚨 Ошибка при запросе в OpenAI: %s", e)
+        assistant_reply = None
+
+    if assistant_reply:
+        try:
+            for part in format_reply(assistant_reply):
+                await save_message(user_id, thread_id, "assistant", part)
+                await bot.send_message(user_id, part, parse_mode='MarkdownV2')
+        except Exception as e:
+            logging.exception("Ошибка обработки ответа от OpenAI: %s", e)
+            assistant_reply = None
+    else:
+        await bot.send_message(
+            user_id,
+            "⚠️ Не удалось получить ответ от OpenAI. Попробуйте позже."
+        )
+    try:
+        await bot.delete_message(user_id, status_message_id)
+    except Exception as e:
+        logging.error(f"Ошибка при удалении статуса: {e}")
+    return assistant_reply
+
+
+async def process_openai_reply(
+        user_id: int, thread_id: str,
+        status_message_id: int) -> typing.Optional[str]:
+    """Отвечает пользователю; возвращает полный ответ ассистента"""
+    run = await run_openai_with_retries(thread_id, ASSISTAND_ID)
+    if run:
+        run = await wait_for_run(thread_id, run)
+    if not run or run.status != "completed":
+        if run:
+            logging.error("Запуск %s завершился: %s", run.id, run.status)
+        await bot.send_message(
+            user_id,
+            "⚠️ Не удалось получить ответ от OpenAI. Попробуйте позже."
+        )
+        try:
+            await bot.delete_message(user_id, status_message_id)
+        except Exception as e:
+            logging.error(f"Ошибка при удалении статуса: {e}")
+        return None
+
+    assistant_reply = None
+    try:
+        messages = await async_client.beta.threads.messages.list(
+            thread_id=thread_id, run_id=run.id,
+        )
+        assistant_reply = messages.data[0].content[0].text.value
+        escaped_parts = format_reply(assistant_reply)
+
+        for part in escaped_parts:
+            await save_message(user_id, thread_id, "assistant", part)
+            await bot.send_message(
+                user_id,
+                part,
+                parse_mode='MarkdownV2',
+            )
+    except Exception as e:
+        logging.exception("Ошибка обработки ответа от OpenAI: %s", e)
+        assistant_reply = None
+    try:
+        await bot.delete_message(user_id, status_message_id)
+    except Exception as e:
+        logging.error(f"Ошибка при удалении статуса: {e}")
+    return assistant_reply
+
+
+@bot.message_handler(content_types=['voice'])
+async def handle_voice(message: Message) -> None:
+    if not await is_user_active(message.from_user.id):
+        return
+
+    error = voice_limit_error(message.voice)
+    if error:
+        await bot.reply_to(message, error)
+        return
+
+    user_id = message.chat.id
+    thread_id = await get_or_create_thread_id(user_id)
+    if not thread_id:
+        await bot.send_message(
+            user_id, "❌ Ошибка: не удалось создать поток.",
+        )
+        return
+
+    position = transcribers.submit(transcribe_voice, message, thread_id)
+    if position:
+        await bot.reply_to(
+            message,
+            f"🎙 Сейчас много голосовых, ваше — {position}-е в очереди "
+            "на распознавание",
+        )
+    else:
+        await bot.send_chat_action(user_id, 'typing')
+
+
+async def transcribe_voice(message: Message, thread_id: str) -> None:
+    user_id = message.chat.id
+    try:
+        file_info = await bot.get_file(message.voice.file_id)
+        if file_info.file_size and file_info.file_size > VOICE_MAX_SIZE:
+            await bot.reply_to(message, voice_too_large_text())
+            return
+        downloaded_file = await bot.download_file(file_info.file_path)
+
+        transcript = await async_client.audio.transcriptions.create(
+            model="whisper-1",
+            file=(f"voice_{message.message_id}.ogg", downloaded_file),
+        )
+    except Exception as e:
+        logging.exception("Ошибка распознавания голосового: %s", e)
+        await bot.reply_to(message, f"Ошибка: {e}")
+        return
+
+    text = transcript.text.strip()
+    if not text:
+        await bot.reply_to(message, "🤷 Не удалось разобрать речь в голосовом")
+        return
+    await save_message(user_id, thread_id, "user", text)
+    conversations.submit(thread_id, user_id, text)
+
+
+@bot.message_handler(content_types=['photo'])
+async def handle_image(message: Message) -> None:
+    """Фото идёт в ту же очередь диалога, что и текст: один запуск"""
+    if not await is_user_active(message.from_user.id):
+        return
+
+    user_id = message.chat.id
+    thread_id = await get_or_create_thread_id(user_id)
+    if not thread_id:
+        await bot.send_message(
+            user_id, "❌ Ошибка: не удалось создать поток.",
+        )
+        return
+
+    position = photo_workers.submit(prepare_photo, message, thread_id)
+    if position:
+        await bot.reply_to(
+            message, f"🖼 Сейчас много фото, ваше — {position}-е в очереди",
+        )
+    else:
+        await bot.send_chat_action(user_id, 'typing')
+
+
+async def prepare_photo(message: Message, thread_id: str) -> None:
+    user_id = message.chat.id
+    try:
+        photo = choose_photo_size(message.photo)
+        file_info = await bot.get_file(photo.file_id)
+        if file_info.file_size and file_info.file_size > PHOTO_MAX_SIZE:
+            raise MediaTooLargeError(file_info.file_size)
+        downloaded_file = await bot.download_file(file_info.file_path)
+        jpeg = await asyncio.to_thread(
+            preprocess_photo, io.BytesIO(downloaded_file),
+        )
+        if CONVERSATION_ENGINE == 'chat':
+            image_part = image_url_part(jpeg)
+        else:
+            uploaded = await async_client.files.create(
+                file=('photo.jpg', jpeg), purpose='vision',
+            )
+            image_part = image_file_part(uploaded.id)
+    except MediaTooLargeError:
+        await bot.reply_to(message, "❌ Фото слишком большое, пришлите поменьше.")
+        return
+    except Exception as e:
+        logging.exception("Ошибка обработки изображения: %s", e)
+        await bot.reply_to(
+            message, f"❌ Ошибка анализа изображения: {str(e)}",
+        )
+        return
+
+    await save_message(
+        user_id, thread_id, "user", photo_history_text(message.caption),
+    )
+    conversations.submit(
+        thread_id, user_id, photo_content(message.caption, image_part),
+    )
+
+
+async def info(message: Message) -> None:
+    markup = types.InlineKeyboardMarkup()
+    back_menu = types.InlineKeyboardButton(
+        text='В главное меню',
+        callback_data='back_menu',
+    )
+    markup.add(back_menu)
+    await bot.send_message(
+        text=INFO_ABOUT_BOT,
+        chat_id=message.chat.id,
+        reply_markup=markup,
+    )
+
+
+async def fix_bot_take_message(message: Message) -> None:
+    """Обработчик инициализации удаления истории"""
+    markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
+    markup.add(types.KeyboardButton('Удалить историю'))
+
+    await bot.send_message(
+        chat_id=message.chat.id,
+        text="Для удаления истории нажмите кнопку ниже:",
+        reply_markup=markup
+    )
+    await bot.set_state(message.chat.id, Steps.fix_bot, message.chat.id)
+
+
+async def fix_bot(message: Message) -> None:
+    """Фактическое удаление истории"""
+    try:
+        await bot.send_chat_action(message.chat.id, 'typing')
+
+        if message.text != 'Удалить историю':
+            await bot.send_message(message.chat.id, "Действие отменено")
+            return await start(message)
+
+        if await delete_user_history(message.from_user.id):
+            await asyncio.to_thread(drop_thread_files, message.from_user.id)
+            await bot.send_message(
+                chat_id=message.chat.id,
+                text="✅ История успешно удалена!",
+                reply_markup=types.ReplyKeyboardRemove()
+            )
+        else:
+            await bot.send_message(
+                chat_id=message.chat.id,
+                text="❌ Ошибка при удалении истории",
+                reply_markup=types.ReplyKeyboardRemove()
+            )
+
+        return await start(message)
+
+    except Exception as e:
+        error_msg = f'Ошибка: {str(e)}'
+        await bot.send_message(ADMIN_IDS[0], error_msg)
+        await bot.send_message(
+            message.chat.id,
+            "⚠️ Произошла системная ошибка",
+            reply_markup=types.ReplyKeyboardRemove()
+        )
+        return await start(message)
+
+
+@bot.callback_query_handler(func=lambda call: call.data == 'ai')
+async def start_chat(call: CallbackQuery) -> None:
+    await set_user_active_status(call.from_user.id, True)
+    await bot.delete_message(call.message.chat.id, call.message.message_id)
+    await take_message_from_user(call.message)
+
+
+@bot.callback_query_handler(
+    func=lambda call: call.data.startswith(('hist:', 'users:'))
+)
+async def admin_page_callback(call: CallbackQuery) -> None:
+    await handle_admin_page(call)
+
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith('find:'))
+async def search_page_callback(call: CallbackQuery) -> None:
+    await handle_search_page(call)
+
+
+@bot.callback_query_handler(func=lambda call: True)
+async def callback_query(call: CallbackQuery) -> None:
+    await bot.delete_message(call.message.chat.id, call.message.message_id)
+    if call.data == 'info':
+        await info(call.message)
+    elif call.data == 'create_image':
+        await take_image_prompt_from_user(call.message)
+    elif call.data == 'back_menu':
+        await start(call.message)
+    elif call.data == 'show_users':
+        await show_users(call.message)
+    elif call.data == 'show_balance':
+        await show_balance(call.message)
+    elif call.data == 'show_history':
+        await show_message(call.message)
+    elif call.data == 'take_mailing_message':
+        await write_mailing_message(call.message)
+    elif call.data == 'accept_mailing_message':
+        await mailing(call.message)
+    elif call.data == 'rewrite_mailing_message':
+        await write_mailing_message(call.message)
+    elif call.data == 'menu_admin':
+        await admin(call.message)
+    elif call.data == 'fix_bot':
+        await fix_bot_take_message(call.message)
+
+
+async def main() -> None:
+    await setup_database()
+    await asyncio.to_thread(resume_broadcasts)
+    start_archiver()
+    logging.info("Асинхронный бот запущен...")
+    if BOT_MODE == 'webhook':
+        await run_webhook(bot)
+    else:
+        await run_polling(bot)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,95 @@
+"""
+Webhook для асинхронного бота (BOT_MODE=webhook), см. webhook.py.
+
+Обновления принимает aiohttp, а обрабатывают шарды
+AsyncShardedDispatcher с порядком внутри чата.
+"""
+import asyncio
+import logging
+
+from aiohttp import web
+from telebot.async_telebot import AsyncTeleBot
+from telebot.types import Update
+
+from webhook import (check_secret, MAX_BODY_SIZE, POLLING_TIMEOUT,
+                     POLLING_RETRY_DELAY,
+                     )
+from dispatcher import AsyncShardedDispatcher
+from const import (WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_HOST, WEBHOOK_PORT,
+                   WEBHOOK_SECRET,
+                   )
+
+
+def dispatcher_for(bot: AsyncTeleBot) -> AsyncShardedDispatcher:
+    async def handle(update: Update) -> None:
+        await bot.process_new_updates([update])
+    dispatcher = AsyncShardedDispatcher(handle)
+    dispatcher.start()
+    return dispatcher
+
+
+async def run_webhook(bot: AsyncTeleBot) -> None:
+    if not WEBHOOK_URL or not WEBHOOK_SECRET:
+        raise RuntimeError(
+            'Для BOT_MODE=webhook нужны WEBHOOK_URL и WEBHOOK_SECRET'
+        )
+
+    dispatcher = dispatcher_for(bot)
+
+    async def receive(request: web.Request) -> web.Response:
+        if not check_secret(request.headers, WEBHOOK_SECRET):
+            return web.Response(status=403)
+        try:
+            update = Update.de_json(await request.text())
+        except Exception as e:
+            logging.warning("Некорректное обновление webhook: %s", e)
+            return web.Response(status=400)
+        if not dispatcher.submit(update):
+            logging.warning("Очередь обновлений полна, отвечаем 503")
+            return web.Response(status=503)
+        return web.Response()
+
+    app = web.Application(client_max_size=MAX_BODY_SIZE)
+    app.router.add_post(WEBHOOK_PATH, receive)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+        await bot.set_webhook(
+            url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+        )
+        logging.info(
+            "Webhook слушает %s:%s%s",
+            WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH,
+        )
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+        await dispatcher.shutdown()
+
+
+async def run_polling(bot: AsyncTeleBot) -> None:
+    """
+    Long polling через те же шарды: polling AsyncTeleBot обрабатывает
+    пачку обновлений одновременно, без порядка внутри чата.
+    """
+    await bot.remove_webhook()
+    dispatcher = dispatcher_for(bot)
+    offset = None
+    try:
+        while True:
+            try:
+                updates = await bot.get_updates(
+                    offset=offset, timeout=POLLING_TIMEOUT,
+                    request_timeout=POLLING_TIMEOUT + 10,
+                )
+            except Exception as e:
+                logging.exception("Ошибка получения обновлений: %s", e)
+                await asyncio.sleep(POLLING_RETRY_DELAY)
+                continue
+            for update in updates:
+                await dispatcher.put(update)
+                offset = update.update_id + 1
+    finally:
+        await dispatcher.shutdown()
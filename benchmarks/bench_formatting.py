@@ -0,0 +1,182 @@
+"""
+Бенчмарк и регрессионный контроль форматирования ответов.
+
+Запуск из корня проекта:
+    python -m benchmarks.bench_formatting            # сравнить с baseline
+    python -m benchmarks.bench_formatting --update   # перезаписать baseline
+
+Для каждой функции и каждого текста корпуса меряется пропускная
+способность и пик выделенной памяти (tracemalloc). Время нормируется
+на калибровочную нагрузку, чтобы baseline был сравним между машинами.
+Отдельно проверяется рост времени на патологических входах: при
+удвоении входа линейный алгоритм замедляется ~в 2 раза, квадратичный —
+~в 4. Новые регрессии и новые патологии завершают запуск с кодом 1.
+"""
+import argparse
+import json
+import re
+import sys
+import timeit
+import tracemalloc
+from pathlib import Path
+from typing import Callable
+
+from utils import (clean_response, escape_markdown, replace_math_symbols,
+                   split_text, format_reply,
+                   )
+from benchmarks.corpus import corpus, PATHOLOGICAL
+
+
+BASELINE = Path(__file__).with_name('baseline.json')
+
+FUNCTIONS: dict[str, Callable[[str], object]] = {
+    'clean_response': clean_response,
+    'escape_markdown': escape_markdown,
+    'replace_math_symbols': replace_math_symbols,
+    'split_text': split_text,
+    'format_reply': format_reply,
+}
+
+PATHOLOGICAL_SIZE = 8000
+GROWTH_LIMIT = 3.0
+# Рост на вызовах быстрее миллисекунды — шум таймера, а не сложность.
+GROWTH_MIN_SECONDS = 1e-3
+ALLOC_SLACK = 4096
+
+_CALIBRATION_TEXT = 'Решение: x^2 + y^2 = 25, a_1 = 1/2. ' * 200
+_CALIBRATION_RE = re.compile(r'(\w)\^(\w+)')
+
+
+def best_time(func: Callable, arg: str, repeat: int = 3) -> float:
+    """Лучшее время одного вызова в секундах"""
+    timer = timeit.Timer(lambda: func(arg))
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def calibrate() -> float:
+    def workload(text: str) -> int:
+        text = _CALIBRATION_RE.sub(r'\1\2', text)
+        return len(text.replace(' ', '').split(','))
+    return best_time(workload, _CALIBRATION_TEXT)
+
+
+def peak_alloc(func: Callable, arg: str) -> int:
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        func(arg)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def single_time(func: Callable, arg: str, repeat: int = 3) -> float:
+    return min(timeit.repeat(lambda: func(arg), repeat=repeat, number=1))
+
+
+def growth(func: Callable, make: Callable[[int], str]) -> float:
+    small = single_time(func, make(PATHOLOGICAL_SIZE))
+    large = single_time(func, make(PATHOLOGICAL_SIZE * 2))
+    if large < GROWTH_MIN_SECONDS or not small:
+        return 0.0
+    return large / small
+
+
+def run() -> dict:
+    unit = calibrate()
+    texts = corpus()
+    results = {'throughput': {}, 'pathological': {}}
+
+    for name, func in FUNCTIONS.items():
+        for text_name, text in texts.items():
+            seconds = best_time(func, text)
+            results['throughput'][f'{name}/{text_name}'] = {
+                'chars': len(text),
+                'mb_per_s': len(text.encode()) / seconds / 1e6,
+                'cost': seconds / unit,
+                'peak_bytes': peak_alloc(func, text),
+            }
+        for case, make in PATHOLOGICAL.items():
+            results['pathological'][f'{name}/{case}'] = growth(func, make)
+
+    return results
+
+
+def report(results: dict, baseline: dict | None, tolerance: float) -> list:
+    failures = []
+    base_throughput = (baseline or {}).get('throughput', {})
+    known = set((baseline or {}).get('known_pathological', []))
+
+    print(f"{'функция/текст':<40}{'МБ/с':>9}{'cost':>10}"
+          f"{'пик, КБ':>10}{'Δcost':>9}")
+    for key, item in results['throughput'].items():
+        base = base_throughput.get(key)
+        delta = ''
+        if base:
+            change = item['cost'] / base['cost'] - 1
+            delta = f'{change:+.0%}'
+            if change > tolerance:
+                failures.append(f'{key}: медленнее baseline на {change:.0%}')
+            if item['peak_bytes'] > base['peak_bytes'] * (1 + tolerance) \
+                    + ALLOC_SLACK:
+                failures.append(
+                    f"{key}: пик памяти {item['peak_bytes']} байт "
+                    f"против {base['peak_bytes']}"
+                )
+        print(f"{key:<40}{item['mb_per_s']:>9.2f}{item['cost']:>10.2f}"
+              f"{item['peak_bytes'] / 1024:>10.1f}{delta:>9}")
+
+    print('\nПатологические входы (рост времени при удвоении входа):')
+    for key, ratio in results['pathological'].items():
+        if ratio <= GROWTH_LIMIT:
+            continue
+        status = 'известно' if key in known else 'НОВОЕ'
+        print(f'  {key:<50} x{ratio:.1f}  {status}')
+        if key not in known:
+            failures.append(f'{key}: нелинейный рост x{ratio:.1f}')
+    return failures
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument(
+        '--update', action='store_true', help='перезаписать baseline',
+    )
+    parser.add_argument(
+        '--tolerance', type=float, default=0.25,
+        help='допустимое ухудшение относительно baseline (0.25 = 25%%)',
+    )
+    args = parser.parse_args()
+
+    results = run()
+    baseline = None
+    if BASELINE.exists():
+        baseline = json.loads(BASELINE.read_text(encoding='utf-8'))
+
+    if args.update:
+        results['known_pathological'] = sorted(
+            key for key, ratio in results['pathological'].items()
+            if ratio > GROWTH_LIMIT
+        )
+        BASELINE.write_text(
+            json.dumps(results, ensure_ascii=False, indent=2) + '\n',
+            encoding='utf-8',
+        )
+        report(results, None, args.tolerance)
+        print(f'\nBaseline сохранён в {BASELINE}')
+        return 0
+
+    failures = report(results, baseline, args.tolerance)
+    if baseline is None:
+        print('\nBaseline не найден, запустите с --update')
+    if failures:
+        print('\nРегрессии:')
+        for failure in failures:
+            print(f'  - {failure}')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
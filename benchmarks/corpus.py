@@ -0,0 +1,101 @@
+"""
+Корпус типичных ответов репетитора для бенчмарков форматирования.
+
+Тексты генерируются детерминированно (фиксированный seed), поэтому
+замеры сравнимы между запусками и с сохранённым baseline.
+"""
+import random
+
+
+SENTENCES = [
+    'Рассмотрим треугольник ABC со сторонами a = 3 см, b = 4 см.',
+    'Найдем длину гипотенузы по теореме Пифагора.',
+    'Подставим известные значения в формулу и вычислим результат.',
+    'Обратите внимание: единицы измерения должны совпадать!',
+    'Молярная масса воды равна 18 г/моль.',
+    'Реакция идет с выделением газа (CO2) и образованием осадка.',
+    'Теперь упростим выражение, сократив общие множители.',
+    'Проверим ответ подстановкой — равенство выполняется.',
+]
+
+FORMULAS = [
+    'x^2 + y^2 = r^2',
+    'a^(n+1) = a^n * a',
+    'H_2O + CO_2 = H_2CO_3',
+    'x_(n+1) = x_n - f(x_n)/f\'(x_n)',
+    'sqrt(16) = 4, sqrt(a^2 + b^2)',
+    'S = 1/2 * a * h, V = 1/3 * S * h',
+    '3/4 + 1/4 = 1, 5/8 - 3/8 = 1/4',
+    'E = m*c^2',
+    '2H_2 + O_2 -> 2H_2O',
+    '$\\frac{a}{b}$ = a/b',
+]
+
+CODE = [
+    '```\nfor i in range(10):\n    print(i ** 2)\n```',
+    '```python\ndef f(x):\n    return x**2 - 4*x + 4\n```',
+]
+
+
+def paragraph(rng: random.Random) -> str:
+    parts = []
+    for _ in range(rng.randint(2, 5)):
+        if rng.random() < 0.35:
+            parts.append(rng.choice(FORMULAS))
+        else:
+            parts.append(rng.choice(SENTENCES))
+    return ' '.join(parts)
+
+
+def numbered_list(rng: random.Random) -> str:
+    return '\n'.join(
+        f'{i}. **Шаг {i}**: {rng.choice(SENTENCES)} {rng.choice(FORMULAS)}'
+        for i in range(1, rng.randint(3, 7))
+    )
+
+
+def tutor_reply(size: int, seed: int = 0, formula_heavy: bool = False) -> str:
+    """Ответ «Дано / Решение / Ответ» длиной не меньше size символов"""
+    rng = random.Random(seed)
+    blocks = ['Дано: ' + rng.choice(FORMULAS), 'Решение:']
+    while sum(len(block) + 2 for block in blocks) < size:
+        roll = rng.random()
+        if formula_heavy and roll < 0.6:
+            blocks.append(' '.join(rng.choice(FORMULAS) for _ in range(8)))
+        elif roll < 0.45:
+            blocks.append(paragraph(rng))
+        elif roll < 0.85:
+            blocks.append(numbered_list(rng))
+        else:
+            blocks.append(rng.choice(CODE))
+    blocks.append('**Ответ**: ' + rng.choice(FORMULAS))
+    return '\n\n'.join(blocks)
+
+
+def corpus() -> dict[str, str]:
+    return {
+        'short_1kb': tutor_reply(1_000, seed=1),
+        'typical_4kb': tutor_reply(4_000, seed=2),
+        'long_10kb': tutor_reply(10_000, seed=3),
+        'worst_50kb': tutor_reply(50_000, seed=4, formula_heavy=True),
+    }
+
+
+def repeat(unit: str, size: int, prefix: str = '') -> str:
+    """Текст длиной size из prefix и повторов unit"""
+    return (prefix + unit * (size // len(unit) + 1))[:size]
+
+
+# Входы, на которых нежадные регулярки и группы [^)]+ могут вести себя
+# нелинейно: незакрытые $, **, ``` и скобки. Функция длины текста.
+PATHOLOGICAL = {
+    'unterminated_dollar': lambda n: repeat('x', n, prefix='$'),
+    'many_dollars': lambda n: repeat('$a ', n),
+    'unterminated_bold': lambda n: repeat('слово ', n, prefix='**'),
+    'many_bold_openers': lambda n: repeat('**a ', n),
+    'unterminated_code': lambda n: repeat('x\n', n, prefix='```'),
+    'unclosed_power_groups': lambda n: repeat('a^(', n),
+    'unclosed_subscript_groups': lambda n: repeat('a_(', n),
+    'unclosed_sqrt': lambda n: repeat('sqrt(', n),
+    'no_spaces': lambda n: repeat('x', n),
+}
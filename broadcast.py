@@ -0,0 +1,185 @@
+"""
+Рассылки администратора.
+
+Задание и статус каждого получателя хранятся в Postgres
+(broadcast_jobs, broadcast_recipients), поэтому после перезапуска бота
+рассылка продолжается с того же места. Экземпляры бота забирают
+получателей пачками (FOR UPDATE SKIP LOCKED), так что рассылку,
+которую продолжили сразу несколько экземпляров, никто не получит
+дважды. Отправка идёт в несколько потоков под общим ограничением
+скорости Telegram, ответ 429 ставит на паузу всех отправителей на
+retry_after секунд. Из базы удаляются только пользователи, которые
+заблокировали бота или удалили аккаунт.
+"""
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from telebot.apihelper import ApiTelegramException
+
+from bot_instance import bot
+from database import (take_broadcast_recipients, mark_broadcast_recipients,
+                      broadcast_progress, finish_broadcast,
+                      take_running_broadcasts, delete_invalid_users,
+                      )
+from const import (BROADCAST_RATE, BROADCAST_WORKERS,
+                   BROADCAST_PROGRESS_INTERVAL,
+                   )
+
+
+BATCH_SIZE = 200
+MAX_ATTEMPTS = 5
+# Через сколько секунд пачку упавшего экземпляра забирает другой
+CLAIM_TTL = 600
+
+_running_jobs: set[int] = set()
+_running_lock = threading.Lock()
+
+
+class RateLimiter:
+    """Общий на все потоки лимит: не больше rate отправок в секунду"""
+
+    def __init__(self, rate: float) -> None:
+        self.interval = 1.0 / rate
+        self._next_slot = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            slot = max(self._next_slot, now)
+            self._next_slot = slot + self.interval
+        delay = slot - now
+        if delay > 0:
+            time.sleep(delay)
+
+    def pause(self, seconds: float) -> None:
+        """Откладывает все следующие отправки (ответ 429 от Telegram)"""
+        with self._lock:
+            self._next_slot = max(
+                self._next_slot, time.monotonic() + seconds,
+            )
+
+
+limiter = RateLimiter(BROADCAST_RATE)
+
+
+def is_blocked_error(e: ApiTelegramException) -> bool:
+    description = (e.description or '').lower()
+    return e.error_code == 403 and (
+        'blocked' in description or 'deactivated' in description
+    )
+
+
+def send_one(chat_id: int, text: str) -> tuple[int, str, str | None]:
+    error = None
+    for attempt in range(MAX_ATTEMPTS):
+        limiter.acquire()
+        try:
+            bot.send_message(chat_id, text)
+            return chat_id, 'sent', None
+        except ApiTelegramException as e:
+            error = e.description
+            if e.error_code == 429:
+                parameters = (e.result_json or {}).get('parameters', {})
+                limiter.pause(parameters.get('retry_after', 2 ** attempt))
+                continue
+            if is_blocked_error(e):
+                return chat_id, 'blocked', error
+            if e.error_code >= 500:
+                time.sleep(2 ** attempt)
+                continue
+            return chat_id, 'failed', error
+        except Exception as e:
+            error = str(e)
+            time.sleep(2 ** attempt)
+    return chat_id, 'failed', error
+
+
+def progress_text(job_id: int, counts: dict[str, int], done: bool) -> str:
+    total = sum(counts.values())
+    processed = total - counts.get('pending', 0) - counts.get('sending', 0)
+    title = '📊 Результаты рассылки' if done else '🚀 Идёт рассылка'
+    return (
+        f"{title} #{job_id}:\n"
+        f"Обработано: {processed} из {total}\n"
+        f"✅ Успешно: {counts.get('sent', 0)}\n"
+        f"🚫 Заблокировали бота: {counts.get('blocked', 0)}\n"
+        f"❌ Ошибок: {counts.get('failed', 0)}"
+    )
+
+
+def show_progress(
+        job_id: int, admin_chat_id: int,
+        progress_message_id: int | None, done: bool = False) -> None:
+    text = progress_text(job_id, broadcast_progress(job_id), done)
+    try:
+        if progress_message_id:
+            bot.edit_message_text(
+                text, chat_id=admin_chat_id, message_id=progress_message_id,
+            )
+        else:
+            bot.send_message(admin_chat_id, text)
+    except Exception as e:
+        if 'message is not modified' not in str(e):
+            logging.error(f"Ошибка обновления прогресса рассылки: {e}")
+
+
+def run_broadcast(
+        job_id: int, admin_chat_id: int,
+        text: str, progress_message_id: int | None) -> None:
+    last_progress = 0.0
+    try:
+        with ThreadPoolExecutor(max_workers=BROADCAST_WORKERS) as pool:
+            while True:
+                chat_ids = take_broadcast_recipients(
+                    job_id, BATCH_SIZE, CLAIM_TTL,
+                )
+                if not chat_ids:
+                    break
+                results = list(pool.map(
+                    lambda chat_id: send_one(chat_id, text), chat_ids,
+                ))
+                mark_broadcast_recipients(job_id, results)
+                delete_invalid_users(
+                    [chat_id for chat_id, status, _ in results
+                     if status == 'blocked']
+                )
+                if time.monotonic() - last_progress >= BROADCAST_PROGRESS_INTERVAL:
+                    last_progress = time.monotonic()
+                    show_progress(job_id, admin_chat_id, progress_message_id)
+        # Итог показывает экземпляр, отправивший последнюю пачку
+        if finish_broadcast(job_id):
+            show_progress(
+                job_id, admin_chat_id, progress_message_id, done=True,
+            )
+    except Exception as e:
+        logging.exception("Рассылка %s прервана: %s", job_id, e)
+    finally:
+        with _running_lock:
+            _running_jobs.discard(job_id)
+
+
+def launch_broadcast(
+        job_id: int, admin_chat_id: int,
+        text: str, progress_message_id: int | None) -> None:
+    """Запускает рассылку в фоне, не занимая поток обработчиков бота"""
+    with _running_lock:
+        if job_id in _running_jobs:
+            return
+        _running_jobs.add(job_id)
+    threading.Thread(
+        target=run_broadcast,
+        args=(job_id, admin_chat_id, text, progress_message_id),
+        name=f'broadcast-{job_id}',
+        daemon=True,
+    ).start()
+
+
+def resume_broadcasts() -> None:
+    """Продолжает рассылки, прерванные перезапуском бота"""
+    for job_id, admin_chat_id, text, progress_message_id in (
+            take_running_broadcasts()):
+        logging.info("Продолжаем рассылку %s", job_id)
+        launch_broadcast(job_id, admin_chat_id, text, progress_message_id)
@@ -0,0 +1,201 @@
+"""
+Движок диалога на chat completions (CONVERSATION_ENGINE=chat).
+
+Вместо четырёх запросов Assistants API (сообщение в поток, запуск,
+опрос статуса, чтение ответа) — один потоковый запрос chat completions.
+Контекст собирается из локальной истории messages: последние сообщения
+диалога, сколько помещается в CHAT_CONTEXT_TOKENS. Ответы ассистента
+хранятся в истории частями в MarkdownV2, перед отправкой в модель они
+склеиваются и разэкранируются.
+"""
+import asyncio
+import logging
+import typing
+import uuid
+
+import openai
+
+from openai_client import client, async_client
+from database import take_recent_messages, take_first_message
+from const import (ASSISTAND_ID, CHAT_MODEL, CHAT_SYSTEM_PROMPT,
+                   CHAT_CONTEXT_TOKENS, CHAT_HISTORY_LIMIT, RUN_TIMEOUT,
+                   )
+from utils import unescape_markdown
+
+
+DEFAULT_MODEL = 'gpt-4o-mini'
+# Токенизатора в зависимостях нет: для русского текста токен — это
+# примерно 3 символа, плюс служебные токены на каждое сообщение.
+CHARS_PER_TOKEN = 3
+MESSAGE_OVERHEAD_TOKENS = 4
+# Начало краткого содержания, с которого начинается свёрнутый поток
+# (см. context.compact_thread)
+SUMMARY_PREFIX = '📝 Краткое содержание прошлого диалога:\n\n'
+# Картинка в detail=auto после сжатия на стороне OpenAI — до ~765 токенов
+IMAGE_TOKENS = 765
+
+
+def new_thread_id() -> str:
+    """Локальный идентификатор диалога: поток в OpenAI не создаётся"""
+    return f'chat-{uuid.uuid4().hex}'
+
+
+_settings: tuple[str, str] | None = None
+
+
+def chat_settings() -> tuple[str, str]:
+    """Модель и системный промпт: из env или из настроек ассистента"""
+    global _settings
+    if _settings:
+        return _settings
+    model, instructions = CHAT_MODEL, CHAT_SYSTEM_PROMPT
+    if model is None or instructions is None:
+        try:
+            assistant = client.beta.assistants.retrieve(ASSISTAND_ID)
+        except Exception as e:
+            # Не запоминаем: попробуем снова на следующем сообщении
+            logging.exception("Не удалось получить настройки ассистента: %s", e)
+            return model or DEFAULT_MODEL, instructions or ''
+        model = model or assistant.model
+        instructions = instructions or assistant.instructions
+    _settings = (model or DEFAULT_MODEL, instructions or '')
+    return _settings
+
+
+def estimate_tokens(content: str | list) -> int:
+    if isinstance(content, list):
+        return MESSAGE_OVERHEAD_TOKENS + sum(
+            len(part['text']) // CHARS_PER_TOKEN if part['type'] == 'text'
+            else IMAGE_TOKENS
+            for part in content
+        )
+    return len(content) // CHARS_PER_TOKEN + MESSAGE_OVERHEAD_TOKENS
+
+
+def build_context(
+        rows: list[tuple], instructions: str,
+        budget: int = CHAT_CONTEXT_TOKENS) -> list[dict]:
+    """
+    Сообщения для chat completions из истории (role, content) от старых
+    к новым. Части одного ответа склеиваются, старые сообщения
+    отбрасываются, пока контекст не уложится в budget токенов. Краткое
+    содержание свёрнутого диалога идёт системным сообщением и не
+    отбрасывается.
+    """
+    history: list[dict] = []
+    summaries: list[dict] = []
+    for role, content in rows:
+        if role == 'assistant':
+            content = unescape_markdown(content)
+            if content.startswith(SUMMARY_PREFIX):
+                summaries.append({'role': 'system', 'content': content})
+                continue
+            if history and history[-1]['role'] == 'assistant':
+                history[-1]['content'] += '\n' + content
+                continue
+        history.append({'role': role, 'content': content})
+
+    budget -= estimate_tokens(instructions)
+    for summary in summaries:
+        budget -= estimate_tokens(summary['content'])
+    start = len(history)
+    while start > 0:
+        cost = estimate_tokens(history[start - 1]['content'])
+        if cost > budget and start < len(history):
+            break
+        budget -= cost
+        start -= 1
+    context = history[start:]
+    # Контекст не должен начинаться с ответа без вопроса
+    while len(context) > 1 and context[0]['role'] == 'assistant':
+        context.pop(0)
+    context[:0] = summaries
+    if instructions:
+        context.insert(0, {'role': 'system', 'content': instructions})
+    return context
+
+
+def conversation_context(
+        user_id: int, thread_id: str,
+        content: str | list | None = None) -> list[dict]:
+    """
+    Контекст для ответа на последние сообщения пользователя. Картинки
+    в истории не хранятся, поэтому если в content есть картинки, он
+    заменяет хвост истории из сообщений пользователя (это они же,
+    сохранённые текстом).
+    """
+    _, instructions = chat_settings()
+    rows = take_recent_messages(user_id, thread_id, CHAT_HISTORY_LIMIT)
+    if len(rows) == CHAT_HISTORY_LIMIT:
+        # Поток сворачивается по числу реплик, а читается по строкам:
+        # краткое содержание из начала потока могло не попасть в окно
+        first = take_first_message(user_id, thread_id)
+        if first and first != rows[0] and first[0] == 'assistant' \
+                and unescape_markdown(first[1]).startswith(SUMMARY_PREFIX):
+            rows.insert(0, first)
+    if isinstance(content, list):
+        while rows and rows[-1][0] == 'user':
+            rows.pop()
+        rows.append(('user', content))
+    elif content and (not rows or rows[-1][0] != 'user'):
+        # Сообщение сохранено в прежний поток, если пришло во время
+        # сворачивания диалога (см. context.compact_thread)
+        rows.append(('user', content))
+    return build_context(rows, instructions)
+
+
+class CompletionStream:
+    """
+    Потоковый запрос chat completions для RunManager.stream: срок,
+    отмену и повтор при rate limit обеспечивает планировщик.
+    """
+
+    def __init__(self, messages: list[dict]) -> None:
+        self.messages = messages
+
+    def open(self) -> typing.ContextManager[typing.Any]:
+        model, _ = chat_settings()
+        return client.chat.completions.create(
+            model=model, messages=self.messages, stream=True,
+        )
+
+    def deltas(self, stream: typing.Any) -> typing.Iterator[str]:
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+    def run(self, stream: typing.Any) -> None:
+        return None
+
+
+async def complete(messages: list[dict], retries: int = 3) -> str | None:
+    """Асинхронный вариант: собирает потоковый ответ целиком"""
+    try:
+        async with asyncio.timeout(RUN_TIMEOUT):
+            return await _complete(messages, retries)
+    except TimeoutError:
+        logging.error("Ответ модели не получен за %s сек.", RUN_TIMEOUT)
+        return None
+
+
+async def _complete(messages: list[dict], retries: int) -> str | None:
+    model, _ = await asyncio.to_thread(chat_settings)
+    for attempt in range(retries):
+        chunks: list[str] = []
+        try:
+            stream = await async_client.chat.completions.create(
+                model=model, messages=messages, stream=True,
+            )
+            async with stream:
+                async for chunk in stream:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        chunks.append(chunk.choices[0].delta.content)
+            return ''.join(chunks)
+        except openai.RateLimitError:
+            if chunks:
+                raise
+            wait_time = 2 ** attempt * 5
+            logging.warning("⚠️ Rate limit: ждём %s сек...", wait_time)
+            await asyncio.sleep(wait_time)
+    logging.error("❌ Не удалось выполнить запрос после повторов.")
+    return None
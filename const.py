@@ -28,8 +28,8 @@ prompt = """Ты учитель математики и химии Филимо
 
 INFO_ABOUT_BOT = """Всем приветствую тех, кто активировал данного бота и уже участвует в тесте нашего с @richckov проекта!
 Так как это первый запуск, у нас есть несколько правил и ограничений:\n\n
-1. Бот отвечает только на одно сообщение! Если отправите два, он может сломаться
-и выдать ошибку либо ответить только на последнее.\n
+1. Можно отправить несколько сообщений подряд: пока бот думает над ответом, новые сообщения
+копятся, и бот ответит на них все вместе одним ответом.\n
 2. Бот пока работает только с текстом. Поддержку изображений добавим в ближайшее время!\n
 3. Это полностью бесплатный бот. Никаких платежей за его использование не предусмотрено!\n
 4. Если бот не ответил, попробуйте отправить сообщение ещё раз через некоторое время.\n
@@ -46,3 +46,153 @@ OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 ADMIN_IDS = [976462978, 7639609189]
 
 ASSISTAND_ID = os.getenv('ASSISTAND_ID')
+
+DB_HOST = os.getenv('DB_HOST', 'localhost')
+
+DB_PORT = os.getenv('DB_PORT', '5432')
+
+DB_NAME = os.getenv('DB_NAME', 'proxyapi')
+
+DB_USER = os.getenv('DB_USER', 'postgres')
+
+DB_PASSWORD = os.getenv('DB_PASSWORD', '12345')
+
+DB_POOL_MIN_SIZE = int(os.getenv('DB_POOL_MIN_SIZE', 2))
+
+DB_POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', 10))
+
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 10))
+
+STREAM_REPLIES = os.getenv('STREAM_REPLIES', '1') == '1'
+
+STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', 1.5))
+
+# memory — состояние в памяти процесса (один процесс бота),
+# postgres — общее для всех процессов, таблица state_store
+STATE_BACKEND = os.getenv('STATE_BACKEND', 'memory')
+
+STATE_MAX_SIZE = int(os.getenv('STATE_MAX_SIZE', 100000))
+
+STEP_TTL = float(os.getenv('STEP_TTL', 3600))
+
+STEP_CACHE_TTL = float(os.getenv('STEP_CACHE_TTL', 2))
+
+THREAD_CACHE_TTL = float(os.getenv('THREAD_CACHE_TTL', 3600))
+
+MESSAGE_BATCH_SIZE = int(os.getenv('MESSAGE_BATCH_SIZE', 100))
+
+MESSAGE_FLUSH_INTERVAL = float(os.getenv('MESSAGE_FLUSH_INTERVAL', 1))
+
+MESSAGE_QUEUE_SIZE = int(os.getenv('MESSAGE_QUEUE_SIZE', 10000))
+
+# Сколько полных месяцев истории хранить в БД; 0 - хранить всё.
+# Архивация включается только вместе с явно заданным ARCHIVE_DIR
+MESSAGE_RETENTION_MONTHS = int(os.getenv('MESSAGE_RETENTION_MONTHS', 0))
+
+ARCHIVE_DIR = os.getenv('ARCHIVE_DIR')
+
+ARCHIVE_INTERVAL = float(os.getenv('ARCHIVE_INTERVAL', 6 * 3600))
+
+ADMIN_HISTORY_PAGE_SIZE = int(os.getenv('ADMIN_HISTORY_PAGE_SIZE', 10))
+
+ADMIN_USERS_PAGE_SIZE = int(os.getenv('ADMIN_USERS_PAGE_SIZE', 50))
+
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', 25))
+
+BROADCAST_WORKERS = int(os.getenv('BROADCAST_WORKERS', 8))
+
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv('BROADCAST_PROGRESS_INTERVAL', 5))
+
+ANSWER_CACHE = os.getenv('ANSWER_CACHE', '1') == '1'
+
+# Меняйте при правке инструкций ассистента: старые ответы не будут выдаваться
+ANSWER_CACHE_VERSION = os.getenv('ANSWER_CACHE_VERSION', '1')
+
+ANSWER_CACHE_SIZE = int(os.getenv('ANSWER_CACHE_SIZE', 5000))
+
+ANSWER_CACHE_TTL = float(os.getenv('ANSWER_CACHE_TTL', 30 * 24 * 3600))
+
+ANSWER_CACHE_SIMILARITY = float(os.getenv('ANSWER_CACHE_SIMILARITY', 0.85))
+
+ANSWER_CACHE_MIN_LENGTH = int(os.getenv('ANSWER_CACHE_MIN_LENGTH', 30))
+
+# assistants — OpenAI Assistants (потоки на стороне OpenAI),
+# chat — chat completions с контекстом из локальной истории messages
+CONVERSATION_ENGINE = os.getenv('CONVERSATION_ENGINE', 'assistants')
+
+# Если не заданы, берутся модель и инструкции ассистента ASSISTAND_ID
+CHAT_MODEL = os.getenv('CHAT_MODEL')
+
+CHAT_SYSTEM_PROMPT = os.getenv('CHAT_SYSTEM_PROMPT')
+
+CHAT_CONTEXT_TOKENS = int(os.getenv('CHAT_CONTEXT_TOKENS', 8000))
+
+CHAT_HISTORY_LIMIT = int(os.getenv('CHAT_HISTORY_LIMIT', 100))
+
+VOICE_WORKERS = int(os.getenv('VOICE_WORKERS', 4))
+
+VOICE_MAX_SIZE = int(os.getenv('VOICE_MAX_SIZE', 20 * 1024 * 1024))
+
+VOICE_MAX_DURATION = int(os.getenv('VOICE_MAX_DURATION', 300))
+
+PHOTO_WORKERS = int(os.getenv('PHOTO_WORKERS', 4))
+
+PHOTO_MAX_SIZE = int(os.getenv('PHOTO_MAX_SIZE', 20 * 1024 * 1024))
+
+# Бюджет пикселей после сжатия: OpenAI всё равно уменьшает картинку
+# до 768 px по короткой стороне, больше отправлять незачем
+PHOTO_MAX_PIXELS = int(os.getenv('PHOTO_MAX_PIXELS', 1_000_000))
+
+PHOTO_JPEG_QUALITY = int(os.getenv('PHOTO_JPEG_QUALITY', 80))
+
+IMAGE_WORKERS = int(os.getenv('IMAGE_WORKERS', 2))
+
+IMAGE_CACHE = os.getenv('IMAGE_CACHE', '1') == '1'
+
+# polling — long polling (разработка), webhook — HTTP-сервер webhook.py
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+
+# Публичный адрес, по которому Telegram шлёт обновления, без пути
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8080))
+
+# Telegram присылает его в заголовке X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+
+# Обновления одного чата обрабатываются по порядку в одном шарде
+UPDATE_SHARDS = int(os.getenv('UPDATE_SHARDS', 16))
+
+UPDATE_QUEUE_SIZE = int(os.getenv('UPDATE_QUEUE_SIZE', 1000))
+
+# Сколько секунд ждать ответ ассистента, прежде чем отменить запуск
+RUN_TIMEOUT = float(os.getenv('RUN_TIMEOUT', 300))
+
+RUN_POLL_WORKERS = int(os.getenv('RUN_POLL_WORKERS', 4))
+
+# Поток ответа занимает поток пула, пока ответ не дочитан
+RUN_STREAM_WORKERS = int(os.getenv('RUN_STREAM_WORKERS', 16))
+
+# Сколько последних сообщений потока видит ассистент (0 — все)
+CONTEXT_LAST_MESSAGES = int(os.getenv('CONTEXT_LAST_MESSAGES', 30))
+
+# Предел токенов контекста запуска ассистента (0 — без предела)
+CONTEXT_MAX_PROMPT_TOKENS = int(os.getenv('CONTEXT_MAX_PROMPT_TOKENS', 0))
+
+SUMMARY_ENABLED = os.getenv('SUMMARY_ENABLED', '1') == '1'
+# Поток сворачивается в краткое содержание, как только число реплик в
+# нём (подряд идущие строки одной роли — одна реплика) дорастает до
+# окна, которое видит модель: тогда содержание в начале нового потока
+# не выпадает из контекста. Окно у assistants — CONTEXT_LAST_MESSAGES,
+# у chat — CHAT_HISTORY_LIMIT (0 — не сворачивать)
+SUMMARY_AFTER = (
+    (CHAT_HISTORY_LIMIT if CONVERSATION_ENGINE == 'chat'
+     else CONTEXT_LAST_MESSAGES)
+    if SUMMARY_ENABLED else 0
+)
+
+SUMMARY_MODEL = os.getenv('SUMMARY_MODEL', 'gpt-4o-mini')
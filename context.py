@@ -0,0 +1,131 @@
+"""
+Ограничение контекста диалога.
+
+Каждый запуск ассистента видит не весь поток, а последние
+CONTEXT_LAST_MESSAGES сообщений и не больше CONTEXT_MAX_PROMPT_TOKENS
+токенов (truncation_strategy и max_prompt_tokens Assistants API;
+движок chat ограничивает контекст сам, см. chat_engine).
+
+Чтобы обрезанное начало не терялось, когда поток дорастает до окна
+модели (SUMMARY_AFTER реплик), диалог сворачивается: модель
+SUMMARY_MODEL пишет краткое содержание, и пользователь переезжает на
+новый поток, который начинается с этого содержания. Стоимость и время
+ответа поэтому не растут с возрастом диалога.
+"""
+import logging
+import typing
+
+from openai_client import client
+from database import (count_thread_turns, take_recent_messages,
+                      set_thread_id, save_message, thread_turns_hint,
+                      take_thread_files,
+                      )
+from const import (CONVERSATION_ENGINE, CONTEXT_LAST_MESSAGES,
+                   CONTEXT_MAX_PROMPT_TOKENS, SUMMARY_AFTER, SUMMARY_MODEL,
+                   )
+from chat_engine import new_thread_id, SUMMARY_PREFIX
+from media import delete_uploaded_files
+from utils import escape_markdown, unescape_markdown
+
+
+# Сколько последних сообщений отдавать на сворачивание
+SUMMARY_SOURCE_LIMIT = 200
+SUMMARY_MAX_TOKENS = 700
+SUMMARY_PROMPT = (
+    'Ты помогаешь репетитору. Кратко перескажи диалог с учеником: '
+    'какие темы и задачи разбирали, к каким ответам пришли, что ученик '
+    'понял плохо и о чём просил. Пиши по-русски, списком, не длиннее '
+    '1500 символов. Формулы и числа из задач сохраняй точно.'
+)
+
+
+def run_params() -> dict[str, typing.Any]:
+    """Параметры runs.create/runs.stream, ограничивающие контекст"""
+    params: dict[str, typing.Any] = {}
+    if CONTEXT_LAST_MESSAGES:
+        params['truncation_strategy'] = {
+            'type': 'last_messages',
+            'last_messages': CONTEXT_LAST_MESSAGES,
+        }
+    if CONTEXT_MAX_PROMPT_TOKENS:
+        params['max_prompt_tokens'] = CONTEXT_MAX_PROMPT_TOKENS
+    return params
+
+
+def summarize(rows: list[tuple]) -> str:
+    transcript = '\n\n'.join(
+        f"{'Ученик' if role == 'user' else 'Репетитор'}: "
+        f"{unescape_markdown(content) if role == 'assistant' else content}"
+        for role, content in rows
+    )
+    response = client.chat.completions.create(
+        model=SUMMARY_MODEL,
+        messages=[
+            {'role': 'system', 'content': SUMMARY_PROMPT},
+            {'role': 'user', 'content': transcript},
+        ],
+        max_tokens=SUMMARY_MAX_TOKENS,
+    )
+    return response.choices[0].message.content.strip()
+
+
+def new_summary_thread(summary: str) -> str:
+    text = SUMMARY_PREFIX + summary
+    if CONVERSATION_ENGINE == 'chat':
+        return new_thread_id()
+    thread = client.beta.threads.create(
+        messages=[{'role': 'assistant', 'content': text}],
+    )
+    return thread.id
+
+
+def drop_thread_files(user_id: int, thread_id: str | None = None) -> None:
+    """
+    Удаляет из OpenAI фото брошенного потока (или всех потоков
+    пользователя): на них больше не сошлётся ни один запуск
+    """
+    try:
+        delete_uploaded_files(take_thread_files(user_id, thread_id))
+    except Exception as e:
+        logging.exception("Не удалось удалить фото потока %s: %s", thread_id, e)
+
+
+def should_compact(thread_id: str) -> bool:
+    """
+    Проверка после ответа без запроса к БД: по счётчику реплик
+    процесса. Если поток процессу не знаком, точно посчитает
+    compact_thread
+    """
+    if not SUMMARY_AFTER:
+        return False
+    turns = thread_turns_hint(thread_id)
+    return turns is None or turns >= SUMMARY_AFTER
+
+
+def compact_thread(user_id: int, thread_id: str) -> typing.Optional[str]:
+    """
+    Сворачивает длинный поток в новый; возвращает его id или None,
+    если сворачивать рано. Вызывается между запусками потока, когда
+    в старый поток уже ничего не пишется, и только если should_compact.
+    """
+    if not SUMMARY_AFTER:
+        return None
+    try:
+        if count_thread_turns(user_id, thread_id) < SUMMARY_AFTER:
+            return None
+        rows = take_recent_messages(user_id, thread_id, SUMMARY_SOURCE_LIMIT)
+        summary = summarize(rows)
+        new_thread = new_summary_thread(summary)
+    except Exception as e:
+        logging.exception("Не удалось свернуть поток %s: %s", thread_id, e)
+        return None
+    save_message(
+        user_id, new_thread, 'assistant',
+        escape_markdown(SUMMARY_PREFIX + summary),
+    )
+    set_thread_id(user_id, new_thread)
+    drop_thread_files(user_id, thread_id)
+    logging.info(
+        "Поток %s пользователя %s свёрнут в %s", thread_id, user_id, new_thread,
+    )
+    return new_thread
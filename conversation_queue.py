@@ -0,0 +1,135 @@
+"""
+Очередь сообщений на разговор (thread OpenAI).
+
+Для одного потока одновременно идёт не больше одного запуска
+ассистента: OpenAI не даёт добавлять сообщения в поток с активным
+запуском, и параллельные запуски падали с ошибкой. Сообщения, которые
+пришли, пока запуск идёт, копятся и уходят следующим запуском одним
+сообщением, поэтому серия сообщений подряд стоит один ответ.
+
+Если handle_batch вернул Future (запуск ведёт RunManager), поток пула
+освобождается, а очередь разговора продолжается после его завершения.
+"""
+import asyncio
+import logging
+import threading
+import typing
+from concurrent.futures import Executor, Future
+
+Content = typing.Union[str, list]
+Item = typing.Tuple[int, Content]
+BatchHandler = typing.Callable[
+    [str, typing.List[Item]], typing.Optional[Future]
+]
+AsyncBatchHandler = typing.Callable[
+    [str, typing.List[Item]], typing.Awaitable[None]
+]
+
+
+def merge_contents(contents: typing.List[Content]) -> Content:
+    """
+    Склеивает несколько сообщений пользователя в одно: тексты через
+    пустую строку, а если есть картинки — в общий список частей.
+    """
+    if all(isinstance(content, str) for content in contents):
+        return '\n\n'.join(contents)
+    parts = []
+    for content in contents:
+        if isinstance(content, str):
+            parts.append({"type": "text", "text": content})
+        else:
+            parts.extend(content)
+    return parts
+
+
+class ConversationQueue:
+    """Последовательная обработка сообщений каждого потока в пуле потоков"""
+
+    def __init__(self, executor: Executor, handle_batch: BatchHandler) -> None:
+        self.executor = executor
+        self.handle_batch = handle_batch
+        self._pending: dict[str, list[Item]] = {}
+        self._active: set[str] = set()
+        self._lock = threading.Lock()
+
+    def submit(self, thread_id: str, user_id: int, content: Content) -> bool:
+        """
+        Ставит сообщение в очередь потока. Возвращает False, если оно
+        присоединилось к сообщениям, которые ждут окончания запуска.
+        """
+        with self._lock:
+            self._pending.setdefault(thread_id, []).append((user_id, content))
+            if thread_id in self._active:
+                return False
+            self._active.add(thread_id)
+        self.executor.submit(self._drain, thread_id)
+        return True
+
+    def _drain(self, thread_id: str) -> None:
+        while True:
+            with self._lock:
+                batch = self._pending.pop(thread_id, None)
+                if not batch:
+                    self._active.discard(thread_id)
+                    return
+            try:
+                pending = self.handle_batch(thread_id, batch)
+            except Exception as e:
+                logging.exception(
+                    "Ошибка обработки сообщений потока %s: %s", thread_id, e,
+                )
+                continue
+            if isinstance(pending, Future):
+                pending.add_done_callback(
+                    lambda _: self.executor.submit(self._drain, thread_id)
+                )
+                return
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                'active': len(self._active),
+                'pending': sum(map(len, self._pending.values())),
+            }
+
+
+class AsyncConversationQueue:
+    """То же для asyncio: одна задача-обработчик на активный поток"""
+
+    def __init__(
+            self,
+            spawn: typing.Callable[[typing.Coroutine], None],
+            handle_batch: AsyncBatchHandler) -> None:
+        self.spawn = spawn
+        self.handle_batch = handle_batch
+        self._pending: dict[str, list[Item]] = {}
+        self._active: set[str] = set()
+
+    def submit(self, thread_id: str, user_id: int, content: Content) -> bool:
+        self._pending.setdefault(thread_id, []).append((user_id, content))
+        if thread_id in self._active:
+            return False
+        self._active.add(thread_id)
+        self.spawn(self._drain(thread_id))
+        return True
+
+    async def _drain(self, thread_id: str) -> None:
+        try:
+            while batch := self._pending.pop(thread_id, None):
+                try:
+                    await self.handle_batch(thread_id, batch)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logging.exception(
+                        "Ошибка обработки сообщений потока %s: %s",
+                        thread_id, e,
+                    )
+        finally:
+            self._active.discard(thread_id)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            'active': len(self._active),
+            'pending': sum(map(len, self._pending.values())),
+        }
@@ -1,175 +1,468 @@
+import datetime
+
 import psycopg2
+from psycopg2.extras import execute_values
+from psycopg2.extensions import connection as Connection
+
+from const import (DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASSWORD,
+                   DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DB_POOL_TIMEOUT,
+                   STATE_BACKEND, STATE_MAX_SIZE, STEP_TTL, STEP_CACHE_TTL,
+                   THREAD_CACHE_TTL,
+                   MESSAGE_BATCH_SIZE, MESSAGE_FLUSH_INTERVAL,
+                   MESSAGE_QUEUE_SIZE,
+                   )
+from db_pool import ConnectionPool
+from cache import TTLCache
+from state_store import create_state_store
+from migrations import apply_migrations
+from message_writer import MessageWriter
 
 
-def create_connection() -> None:
+def create_connection() -> Connection:
     try:
         connection = psycopg2.connect(
-            host="localhost",
-            port="5432",
-            database="proxyapi",
-            user="postgres",
-            password="12345",
+            host=DB_HOST,
+            port=DB_PORT,
+            database=DB_NAME,
+            user=DB_USER,
+            password=DB_PASSWORD,
             client_encoding='UTF-8'
         )
         print('База данных подключена, можно работать!')
         return connection
     except Exception as e:
         print(f'База даннах не подключена. Ошибка:\n{e}')
+        raise
+
+
+pool = ConnectionPool(
+    create_connection,
+    min_size=DB_POOL_MIN_SIZE,
+    max_size=DB_POOL_MAX_SIZE,
+    timeout=DB_POOL_TIMEOUT,
+)
+
+
+def get_connection():
+    """Соединение из общего пула, возвращается в пул по выходу из with"""
+    return pool.connection()
+
+
+state = create_state_store(STATE_BACKEND, get_connection, STATE_MAX_SIZE)
+
+# Фильтр next_step спрашивает шаг на каждое обновление, а с postgres это
+# запрос к БД. Поэтому шаг (и его отсутствие — '') ненадолго кэшируется
+# в процессе; шаг, заданный другим процессом, виден через STEP_CACHE_TTL
+_steps = TTLCache(maxsize=STATE_MAX_SIZE, ttl=STEP_CACHE_TTL)
+# users и так общая таблица: для postgres thread_id берётся прямо из
+# неё, без лишнего запроса к state_store
+CACHE_THREADS = STATE_BACKEND == 'memory'
+
+# Число реплик в потоке по данным процесса, чтобы не считать их в БД
+# после каждого ответа: точный счёт раз в THREAD_TURNS_TTL, в промежутке
+# прибавляет save_message. Значение — [число реплик, роль последней]:
+# список меняется на месте, чтобы прибавление не продлевало запись
+THREAD_TURNS_TTL = 600
+_thread_turns = TTLCache(maxsize=STATE_MAX_SIZE, ttl=THREAD_TURNS_TTL)
+
+
+def set_next_step(chat_id: int, step: str) -> None:
+    """Следующее сообщение из чата уйдёт обработчику шага step"""
+    state.set(f'step:{chat_id}', step, STEP_TTL)
+    _steps.set(chat_id, step)
+
+
+def get_next_step(chat_id: int) -> str | None:
+    step = _steps.get(chat_id)
+    if step is None:
+        step = state.get(f'step:{chat_id}') or ''
+        _steps.set(chat_id, step)
+    return step or None
+
+
+def pop_next_step(chat_id: int) -> str | None:
+    _steps.set(chat_id, '')
+    return state.pop(f'step:{chat_id}')
+
+
+def set_search(chat_id: int, search: dict) -> None:
+    """Последний поиск администратора, по которому листаются страницы"""
+    state.set(f'search:{chat_id}', search, STEP_TTL)
+
+
+def get_search(chat_id: int) -> dict | None:
+    return state.get(f'search:{chat_id}')
 
 
 def setup_database() -> None:
-    conn = create_connection()
-    with conn:
-        cursor = conn.cursor()
-        cursor.execute('''CREATE TABLE IF NOT EXISTS messages (
-    id SERIAL PRIMARY KEY,
-    user_id BIGINT NOT NULL,
-    thread_id TEXT NOT NULL,
-    role TEXT NOT NULL CHECK (role IN ('user', 'assistant')),
-    content TEXT NOT NULL,
-    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-)''')
-        cursor.execute('''
-                       CREATE TABLE IF NOT EXISTS users (
-                           id SERIAL PRIMARY KEY,
-                           user_telegram_id BIGINT UNIQUE,
-                           telegram_username TEXT,
-                           balance INTEGER DEFAULT 0,
-                           is_active BOOLEAN DEFAULT FALSE
-                       )
-        ''')
+    pool.open()
+    apply_migrations(create_connection)
 
 
 def add_member_to_db(user_telegram_id: int, telegram_username: str) -> None:
-    conn = create_connection()
     try:
-        cursor = conn.cursor()
-
-        cursor.execute('''
-                       SELECT id FROM users WHERE user_telegram_id = %s
-                       ''', (user_telegram_id,))
-        user = cursor.fetchone()
-
-        if not user:
+        with get_connection() as conn, conn.cursor() as cursor:
             cursor.execute('''
-                           INSERT INTO users (
-                               user_telegram_id,
-                               telegram_username
-                           ) VALUES (%s, %s)
-                           ''', (
-                               user_telegram_id,
-                               telegram_username,
-                            ))
-            conn.commit()
-            print("Пользователь успешно добавлен.")
+                           SELECT id FROM users WHERE user_telegram_id = %s
+                           ''', (user_telegram_id,))
+            user = cursor.fetchone()
+
+            if not user:
+                cursor.execute('''
+                               INSERT INTO users (
+                                   user_telegram_id,
+                                   telegram_username
+                               ) VALUES (%s, %s)
+                               ''', (
+                                   user_telegram_id,
+                                   telegram_username,
+                                ))
+                print("Пользователь успешно добавлен.")
 
     except Exception as e:
         print(f"Произошла ошибка: {e}")
-    finally:
-        cursor.close()
-        conn.close()
 
 
-def take_users() -> str:
-    with create_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM users ORDER BY id")
-        rows = cursor.fetchall()
-        if rows:
-            response = ''
-            for user in rows:
-                response += f'{user[0]}. id: {user[1]}, username: @{user[2]}\n'
+def take_users_page(
+        after_id: int | None = None,
+        before_id: int | None = None,
+        limit: int = 50,
+) -> tuple[list[tuple], bool]:
+    """
+    Страница пользователей по возрастанию id (keyset-пагинация).
+    Возвращает строки (id, user_telegram_id, telegram_username) и
+    признак того, что в направлении листания есть ещё записи.
+    """
+    with get_connection() as conn, conn.cursor() as cursor:
+        if before_id is not None:
+            cursor.execute("""
+                SELECT id, user_telegram_id, telegram_username FROM users
+                WHERE id < %s ORDER BY id DESC LIMIT %s
+            """, (before_id, limit + 1))
         else:
-            response = 'Пока нет зарегистрированных пользователей'
-
-    return response
+            cursor.execute("""
+                SELECT id, user_telegram_id, telegram_username FROM users
+                WHERE id > %s ORDER BY id LIMIT %s
+            """, (after_id or 0, limit + 1))
+        rows = cursor.fetchall()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if before_id is not None:
+        rows.reverse()
+    return rows, has_more
 
 
 def set_user_active_status(user_id: int, is_active: bool) -> None:
-    conn = create_connection()
-    try:
-        cursor = conn.cursor()
+    with get_connection() as conn, conn.cursor() as cursor:
         cursor.execute('''
             UPDATE users
             SET is_active = %s
             WHERE user_telegram_id = %s
         ''', (is_active, user_id))
-        conn.commit()
-    finally:
-        cursor.close()
-        conn.close()
 
 
 def is_user_active(user_id: int) -> bool:
-    conn = create_connection()
     try:
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT is_active
-            FROM users
-            WHERE user_telegram_id = %s
-        ''', (user_id,))
-        return cursor.fetchone()[0]
+        with get_connection() as conn, conn.cursor() as cursor:
+            cursor.execute('''
+                SELECT is_active
+                FROM users
+                WHERE user_telegram_id = %s
+            ''', (user_id,))
+            return cursor.fetchone()[0]
     except Exception:
         return False
-    finally:
-        cursor.close()
-        conn.close()
 
 
 def get_thread_id(user_id: int) -> str:
-    conn = create_connection()
-    cursor = conn.cursor()
-    cursor.execute("""
-                   SELECT thread_id FROM messages WHERE user_id = %s
-                   """, (user_id,))
-    result = cursor.fetchone()
-    cursor.close()
-    conn.close()
-    return result[0] if result else None
+    if CACHE_THREADS:
+        thread_id = state.get(f'thread:{user_id}')
+        if thread_id:
+            return thread_id
+    with get_connection() as conn, conn.cursor() as cursor:
+        cursor.execute("""
+                       SELECT thread_id FROM users WHERE user_telegram_id = %s
+                       """, (user_id,))
+        result = cursor.fetchone()
+    thread_id = result[0] if result else None
+    if thread_id and CACHE_THREADS:
+        state.set(f'thread:{user_id}', thread_id, THREAD_CACHE_TTL)
+    return thread_id
+
+
+def set_thread_id(user_id: int, thread_id: str) -> None:
+    with get_connection() as conn, conn.cursor() as cursor:
+        cursor.execute("""
+                       INSERT INTO users (user_telegram_id, thread_id)
+                       VALUES (%s, %s)
+                       ON CONFLICT (user_telegram_id)
+                       DO UPDATE SET thread_id = EXCLUDED.thread_id
+                       """, (user_id, thread_id))
+    if CACHE_THREADS:
+        state.set(f'thread:{user_id}', thread_id, THREAD_CACHE_TTL)
+
+
+def insert_messages(rows: list[tuple]) -> None:
+    """Вставляет пачку (user_id, thread_id, role, content) одним запросом"""
+    with get_connection() as conn, conn.cursor() as cursor:
+        execute_values(
+            cursor,
+            "INSERT INTO messages (user_id, thread_id, role, content) VALUES %s",
+            rows,
+            page_size=len(rows),
+        )
+
+
+message_writer = MessageWriter(
+    insert_messages,
+    batch_size=MESSAGE_BATCH_SIZE,
+    flush_interval=MESSAGE_FLUSH_INTERVAL,
+    max_pending=MESSAGE_QUEUE_SIZE,
+)
 
 
 def save_message(user_id: int, thread_id: str, role: str, content: str):
-    conn = create_connection()
-    cursor = conn.cursor()
+    """Ставит сообщение в очередь на запись, не дожидаясь коммита"""
     try:
-        cursor.execute(
-            "INSERT INTO messages (user_id, thread_id, role, content) VALUES (%s, %s, %s, %s)",
-            (user_id, thread_id, role, content)
-        )
-        conn.commit()
-        cursor.close()
-        conn.close()
+        message_writer.put((user_id, thread_id, role, content))
     except Exception as e:
         print(f"Ошибка при сохранении в БД: {e}")
+        return
+    turns = _thread_turns.get(thread_id)
+    if turns is not None and turns[1] != role:
+        turns[0] += 1
+        turns[1] = role
+
 
+def take_messages_page(
+        user_id: int | None = None,
+        older_than: int | None = None,
+        newer_than: int | None = None,
+        limit: int = 10,
+) -> tuple[list[tuple], bool]:
+    """
+    Страница истории от новых к старым (keyset по timestamp, id).
+    older_than/newer_than — id сообщения, от которого листать.
+    Возвращает строки (id, user_id, timestamp, role, content) и признак
+    того, что в направлении листания есть ещё записи.
+    """
+    conditions = []
+    params: list = []
+    if user_id is not None:
+        conditions.append('user_id = %s')
+        params.append(user_id)
+    order = 'ASC' if older_than is None and newer_than is not None else 'DESC'
 
-def take_messages() -> str:
-    with create_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM messages ORDER BY timestamp DESC")
+    with get_connection() as conn, conn.cursor() as cursor:
+        cursor_id = older_than if older_than is not None else newer_than
+        if cursor_id is not None:
+            # Время сообщения-курсора подставляется в запрос значением,
+            # чтобы планировщик читал только партиции до/после него
+            cursor.execute(
+                "SELECT timestamp FROM messages WHERE id = %s", (cursor_id,)
+            )
+            row = cursor.fetchone()
+            if row is None:
+                return [], False
+            sign = '<' if order == 'DESC' else '>'
+            conditions.append(
+                f'timestamp {sign}= %s AND (timestamp, id) {sign} (%s, %s)'
+            )
+            params += [row[0], row[0], cursor_id]
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        params.append(limit + 1)
+        cursor.execute(f"""
+            SELECT id, user_id, timestamp, role, content FROM messages
+            {where}
+            ORDER BY timestamp {order}, id {order}
+            LIMIT %s
+        """, params)
         rows = cursor.fetchall()
-        if rows:
-            response = ''
-            for user in rows:
-                response += f'id: {user[1]}\nВремя: {user[5]}\nСообщение:\n{user[4]}\n\n'
-        else:
-            response = 'Пока никто ничего не спрашивал...'
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if order == 'ASC':
+        rows.reverse()
+    return rows, has_more
+
+
+# Должно совпадать с выражением индекса messages_content_tsv_idx,
+# иначе планировщик его не использует
+CONTENT_TSV = "to_tsvector('russian', content)"
+
+
+def search_messages(
+        query: str,
+        user_id: int | None = None,
+        since: datetime.date | None = None,
+        until: datetime.date | None = None,
+        offset: int = 0,
+        limit: int = 10,
+) -> tuple[list[tuple], bool]:
+    """
+    Полнотекстовый поиск по истории (русская морфология, GIN-индекс
+    по выражению CONTENT_TSV), самые релевантные сначала. query в
+    синтаксисе websearch: слова, "фраза", -исключить, or. Возвращает
+    строки (id, user_id, timestamp, role, фрагмент с совпадениями) и
+    признак того, что есть следующая страница.
+    """
+    conditions = [f'{CONTENT_TSV} @@ q.query']
+    params: list = [query]
+    if user_id is not None:
+        conditions.append('user_id = %s')
+        params.append(user_id)
+    if since is not None:
+        conditions.append('timestamp >= %s')
+        params.append(since)
+    if until is not None:
+        conditions.append('timestamp < %s')
+        params.append(until)
+    params += [limit + 1, offset]
 
-    return response
+    with get_connection() as conn, conn.cursor() as cursor:
+        cursor.execute(f"""
+            WITH q AS (SELECT websearch_to_tsquery('russian', %s) AS query),
+            found AS (
+                SELECT id, user_id, timestamp, role, content,
+                       ts_rank_cd({CONTENT_TSV}, q.query) AS rank
+                FROM messages, q
+                WHERE {' AND '.join(conditions)}
+                ORDER BY rank DESC, timestamp DESC, id DESC
+                LIMIT %s OFFSET %s
+            )
+            SELECT id, user_id, timestamp, role,
+                   ts_headline('russian', content, q.query,
+                               'StartSel=«, StopSel=», MaxFragments=2')
+            FROM found, q
+            ORDER BY rank DESC, timestamp DESC, id DESC
+        """, params)
+        rows = cursor.fetchall()
+    return rows[:limit], len(rows) > limit
+
+
+def iter_messages(user_id: int | None = None, batch_size: int = 2000):
+    """
+    Построчно отдаёт историю через серверный курсор, не загружая
+    таблицу в память целиком.
+    """
+    query = "SELECT id, user_id, thread_id, role, content, timestamp FROM messages"
+    params: tuple = ()
+    if user_id is not None:
+        query += " WHERE user_id = %s"
+        params = (user_id,)
+    query += " ORDER BY timestamp, id"
+    with get_connection() as conn:
+        with conn.cursor(name='export_messages') as cursor:
+            cursor.itersize = batch_size
+            cursor.execute(query, params)
+            yield from cursor
+
+
+def take_recent_messages(
+        user_id: int, thread_id: str, limit: int) -> list[tuple]:
+    """
+    Последние limit сообщений диалога от старых к новым: (role, content).
+    Перед чтением дописывает в БД отложенные сообщения.
+    """
+    message_writer.flush(timeout=5)
+    with get_connection() as conn, conn.cursor() as cursor:
+        cursor.execute("""
+            SELECT role, content FROM messages
+            WHERE user_id = %s AND thread_id = %s
+            ORDER BY timestamp DESC, id DESC
+            LIMIT %s
+        """, (user_id, thread_id, limit))
+        rows = cursor.fetchall()
+    rows.reverse()
+    return rows
+
+
+def take_first_message(user_id: int, thread_id: str) -> tuple | None:
+    """Первое сообщение диалога (role, content) или None"""
+    with get_connection() as conn, conn.cursor() as cursor:
+        cursor.execute("""
+            SELECT role, content FROM messages
+            WHERE user_id = %s AND thread_id = %s
+            ORDER BY timestamp, id
+            LIMIT 1
+        """, (user_id, thread_id))
+        return cursor.fetchone()
+
+
+def count_thread_turns(user_id: int, thread_id: str) -> int:
+    """
+    Число реплик потока: подряд идущие строки одной роли — это части
+    одного ответа или сообщения одной пачки, а в потоке OpenAI одно
+    сообщение
+    """
+    message_writer.flush(timeout=5)
+    with get_connection() as conn, conn.cursor() as cursor:
+        cursor.execute("""
+            SELECT count(*) FILTER (WHERE role IS DISTINCT FROM previous),
+                   (array_agg(role ORDER BY timestamp DESC, id DESC))[1]
+            FROM (
+                SELECT id, timestamp, role,
+                       lag(role) OVER (ORDER BY timestamp, id) AS previous
+                FROM messages
+                WHERE user_id = %s AND thread_id = %s
+            ) AS thread
+        """, (user_id, thread_id))
+        count, last_role = cursor.fetchone()
+    _thread_turns.set(thread_id, [count, last_role])
+    return count
+
+
+def thread_turns_hint(thread_id: str) -> int | None:
+    """Примерное число реплик потока без запроса к БД; None — неизвестно"""
+    turns = _thread_turns.get(thread_id)
+    return turns[0] if turns is not None else None
+
+
+def add_thread_files(
+        user_id: int, thread_id: str, file_ids: list[str]) -> None:
+    """
+    Фото, загруженные в сообщение потока. Пока поток жив, последующие
+    запуски снова отправляют это сообщение модели, поэтому файлы
+    удаляются только вместе с потоком (см. context.drop_thread_files)
+    """
+    if not file_ids:
+        return
+    with get_connection() as conn, conn.cursor() as cursor:
+        execute_values(cursor, """
+            INSERT INTO thread_files (file_id, user_id, thread_id)
+            VALUES %s ON CONFLICT DO NOTHING
+        """, [(file_id, user_id, thread_id) for file_id in file_ids])
+
+
+def take_thread_files(
+        user_id: int, thread_id: str | None = None) -> list[str]:
+    """Забирает фото потока, а без thread_id — всех потоков пользователя"""
+    with get_connection() as conn, conn.cursor() as cursor:
+        if thread_id is None:
+            cursor.execute(
+                "DELETE FROM thread_files WHERE user_id = %s "
+                "RETURNING file_id", (user_id,),
+            )
+        else:
+            cursor.execute(
+                "DELETE FROM thread_files WHERE user_id = %s "
+                "AND thread_id = %s RETURNING file_id", (user_id, thread_id),
+            )
+        return [row[0] for row in cursor.fetchall()]
 
 
 def delete_user_history(user_id: int) -> bool:
-    conn = create_connection()
-    cursor = conn.cursor()
     try:
         print('Попали в delete_user_history')
-        cursor.execute(
-            "DELETE FROM messages WHERE user_id = %s", (user_id,)
-        )
-        conn.commit()
-        cursor.close()
-        conn.close()
+        message_writer.flush(timeout=10)
+        with get_connection() as conn, conn.cursor() as cursor:
+            cursor.execute(
+                "DELETE FROM messages WHERE user_id = %s", (user_id,)
+            )
+            cursor.execute(
+                "UPDATE users SET thread_id = NULL WHERE user_telegram_id = %s",
+                (user_id,)
+            )
+        state.delete(f'thread:{user_id}')
         print('История удалена')
         return True
     except Exception:
@@ -177,31 +470,213 @@ def delete_user_history(user_id: int) -> bool:
         return False
 
 
-def take_user_telegram_id() -> list[tuple]:
-    conn = create_connection()
-    try:
-        with conn.cursor() as cursor:
-            cursor.execute("SELECT user_telegram_id FROM users")
-            return cursor.fetchall()
-    except Exception as e:
-        print(e)
-    finally:
-        if conn:
-            conn.close()
+def delete_invalid_users(chat_ids: list[int]) -> None:
+    """Удаляет пачку пользователей, заблокировавших бота"""
+    if not chat_ids:
+        return
+    with get_connection() as conn, conn.cursor() as cursor:
+        cursor.execute(
+            "DELETE FROM users WHERE user_telegram_id = ANY(%s)",
+            (list(chat_ids),)
+        )
 
 
-def delete_invalid_user(chat_id: int):
-    """Удаляет невалидного пользователя из БД"""
-    conn = create_connection()
-    try:
-        with conn.cursor() as cursor:
-            cursor.execute(
-                "DELETE FROM users WHERE user_telegram_id = %s",
-                (chat_id,)
+def create_broadcast_draft(admin_chat_id: int, text: str) -> int:
+    with get_connection() as conn, conn.cursor() as cursor:
+        cursor.execute("""
+            DELETE FROM broadcast_jobs
+            WHERE admin_chat_id = %s AND status = 'draft'
+        """, (admin_chat_id,))
+        cursor.execute("""
+            INSERT INTO broadcast_jobs (admin_chat_id, text)
+            VALUES (%s, %s) RETURNING id
+        """, (admin_chat_id, text))
+        return cursor.fetchone()[0]
+
+
+def get_broadcast_draft(admin_chat_id: int) -> tuple[int, str] | None:
+    with get_connection() as conn, conn.cursor() as cursor:
+        cursor.execute("""
+            SELECT id, text FROM broadcast_jobs
+            WHERE admin_chat_id = %s AND status = 'draft'
+            ORDER BY id DESC LIMIT 1
+        """, (admin_chat_id,))
+        return cursor.fetchone()
+
+
+def start_broadcast(job_id: int, progress_message_id: int) -> int | None:
+    """
+    Переводит черновик в работу и фиксирует список получателей.
+    Возвращает число получателей или None, если задание уже запущено.
+    """
+    with get_connection() as conn, conn.cursor() as cursor:
+        cursor.execute("""
+            UPDATE broadcast_jobs
+            SET status = 'running', progress_message_id = %s
+            WHERE id = %s AND status = 'draft'
+        """, (progress_message_id, job_id))
+        if not cursor.rowcount:
+            return None
+        cursor.execute("""
+            INSERT INTO broadcast_recipients (job_id, chat_id)
+            SELECT %s, user_telegram_id FROM users
+            WHERE user_telegram_id IS NOT NULL
+            ON CONFLICT DO NOTHING
+        """, (job_id,))
+        return cursor.rowcount
+
+
+def take_running_broadcasts() -> list[tuple]:
+    with get_connection() as conn, conn.cursor() as cursor:
+        cursor.execute("""
+            SELECT id, admin_chat_id, text, progress_message_id
+            FROM broadcast_jobs WHERE status = 'running' ORDER BY id
+        """)
+        return cursor.fetchall()
+
+
+def take_broadcast_recipients(
+        job_id: int, limit: int, claim_ttl: float) -> list[int]:
+    """
+    Забирает пачку получателей в отправку (status = 'sending'), так что
+    несколько экземпляров бота делят рассылку без повторов. Пачки,
+    зависшие дольше claim_ttl секунд (экземпляр упал), забираются снова.
+    """
+    with get_connection() as conn, conn.cursor() as cursor:
+        cursor.execute("""
+            UPDATE broadcast_recipients
+            SET status = 'sending', claimed_at = CURRENT_TIMESTAMP
+            WHERE (job_id, chat_id) IN (
+                SELECT job_id, chat_id FROM broadcast_recipients
+                WHERE job_id = %s AND (
+                    status = 'pending'
+                    OR (status = 'sending' AND claimed_at
+                        < CURRENT_TIMESTAMP - make_interval(secs => %s))
+                )
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
             )
-            conn.commit()
-    except Exception as e:
-        print(e)
-    finally:
-        if conn:
-            conn.close()
+            RETURNING chat_id
+        """, (job_id, claim_ttl, limit))
+        return [row[0] for row in cursor.fetchall()]
+
+
+def mark_broadcast_recipients(job_id: int, results: list[tuple]) -> None:
+    """results — (chat_id, status, error) по каждому получателю"""
+    if not results:
+        return
+    with get_connection() as conn, conn.cursor() as cursor:
+        execute_values(cursor, """
+            UPDATE broadcast_recipients r
+            SET status = v.status, error = v.error
+            FROM (VALUES %s) AS v (job_id, chat_id, status, error)
+            WHERE r.job_id = v.job_id AND r.chat_id = v.chat_id
+        """, [(job_id, *result) for result in results])
+
+
+def broadcast_progress(job_id: int) -> dict[str, int]:
+    with get_connection() as conn, conn.cursor() as cursor:
+        cursor.execute("""
+            SELECT status, count(*) FROM broadcast_recipients
+            WHERE job_id = %s GROUP BY status
+        """, (job_id,))
+        return dict(cursor.fetchall())
+
+
+def finish_broadcast(job_id: int) -> bool:
+    """
+    Завершает рассылку, если все получатели обработаны. False — её уже
+    завершили или другой экземпляр ещё отправляет свою пачку.
+    """
+    with get_connection() as conn, conn.cursor() as cursor:
+        cursor.execute("""
+            UPDATE broadcast_jobs
+            SET status = 'done', finished_at = CURRENT_TIMESTAMP
+            WHERE id = %s AND status = 'running' AND NOT EXISTS (
+                SELECT 1 FROM broadcast_recipients
+                WHERE job_id = %s AND status IN ('pending', 'sending')
+            )
+        """, (job_id, job_id))
+        return cursor.rowcount > 0
+
+
+def take_cached_questions(namespace: str, limit: int, ttl: float) -> list[tuple]:
+    """Последние использованные вопросы кэша ответов: (key, question)"""
+    with get_connection() as conn, conn.cursor() as cursor:
+        cursor.execute("""
+            SELECT question_key, question FROM answer_cache
+            WHERE namespace = %s
+              AND created_at > now() - make_interval(secs => %s)
+            ORDER BY last_used_at DESC
+            LIMIT %s
+        """, (namespace, ttl, limit))
+        return cursor.fetchall()
+
+
+def get_cached_answer(namespace: str, question_key: str, ttl: float) -> str | None:
+    """Ответ из кэша; заодно отмечает использование для вытеснения LRU"""
+    with get_connection() as conn, conn.cursor() as cursor:
+        cursor.execute("""
+            UPDATE answer_cache
+            SET hits = hits + 1, last_used_at = CURRENT_TIMESTAMP
+            WHERE namespace = %s AND question_key = %s
+              AND created_at > now() - make_interval(secs => %s)
+            RETURNING answer
+        """, (namespace, question_key, ttl))
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+
+def save_cached_answer(
+        namespace: str, question_key: str,
+        question: str, answer: str) -> None:
+    with get_connection() as conn, conn.cursor() as cursor:
+        cursor.execute("""
+            INSERT INTO answer_cache (namespace, question_key, question, answer)
+            VALUES (%s, %s, %s, %s)
+            ON CONFLICT (namespace, question_key) DO UPDATE
+            SET question = EXCLUDED.question, answer = EXCLUDED.answer,
+                created_at = CURRENT_TIMESTAMP,
+                last_used_at = CURRENT_TIMESTAMP
+        """, (namespace, question_key, question, answer))
+
+
+def evict_cached_answers(namespace: str, max_size: int, ttl: float) -> list[str]:
+    """Удаляет устаревшие и лишние (давно не использованные) ответы"""
+    with get_connection() as conn, conn.cursor() as cursor:
+        cursor.execute("""
+            DELETE FROM answer_cache
+            WHERE namespace = %s AND (
+                created_at <= now() - make_interval(secs => %s)
+                OR id IN (
+                    SELECT id FROM answer_cache WHERE namespace = %s
+                    ORDER BY last_used_at DESC OFFSET %s
+                )
+            )
+            RETURNING question_key
+        """, (namespace, ttl, namespace, max_size))
+        return [row[0] for row in cursor.fetchall()]
+
+
+def get_cached_image(prompt_key: str) -> str | None:
+    """file_id уже отправленной картинки по ключу промпта"""
+    with get_connection() as conn, conn.cursor() as cursor:
+        cursor.execute("""
+            UPDATE image_cache
+            SET hits = hits + 1, last_used_at = CURRENT_TIMESTAMP
+            WHERE prompt_key = %s
+            RETURNING file_id
+        """, (prompt_key,))
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+
+def save_cached_image(prompt_key: str, prompt: str, file_id: str) -> None:
+    with get_connection() as conn, conn.cursor() as cursor:
+        cursor.execute("""
+            INSERT INTO image_cache (prompt_key, prompt, file_id)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (prompt_key) DO UPDATE
+            SET file_id = EXCLUDED.file_id,
+                last_used_at = CURRENT_TIMESTAMP
+        """, (prompt_key, prompt, file_id))
@@ -0,0 +1,202 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterator
+
+import psycopg2
+from psycopg2.extensions import connection as Connection
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+
+
+class PoolExhaustedError(Exception):
+    """Не удалось получить соединение из пула за отведённое время"""
+
+
+class ConnectionPool:
+    """
+    Ограниченный потокобезопасный пул соединений с PostgreSQL.
+
+    Соединения открываются лениво до max_size, при исчерпании пула
+    поток ждёт освобождения соединения не дольше timeout секунд.
+    Перед выдачей соединение проверяется, мёртвые соединения
+    пересоздаются.
+    """
+
+    def __init__(
+            self,
+            connect: Callable[[], Connection],
+            min_size: int = 2,
+            max_size: int = 10,
+            timeout: float = 10.0,
+            health_check_interval: float = 30.0,
+    ) -> None:
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError('Некорректные размеры пула соединений')
+        self._connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+
+        self._cond = threading.Condition()
+        self._idle: list[tuple[Connection, float]] = []
+        self._size = 0
+        self._in_use = 0
+
+        self._checkouts = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+        self._exhausted = 0
+        self._health_failures = 0
+
+    def open(self) -> None:
+        """Заранее открывает min_size соединений"""
+        while True:
+            with self._cond:
+                if self._size >= self.min_size:
+                    return
+                self._size += 1
+            try:
+                conn = self._connect()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                raise
+            with self._cond:
+                self._idle.append((conn, time.monotonic()))
+                self._cond.notify()
+
+    def getconn(self, timeout: float | None = None) -> Connection:
+        timeout = self.timeout if timeout is None else timeout
+        started = time.monotonic()
+        deadline = started + timeout
+        conn = None
+        last_used = 0.0
+
+        with self._cond:
+            while True:
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._exhausted += 1
+                    logging.warning(
+                        "Пул соединений исчерпан: %s/%s заняты",
+                        self._in_use, self.max_size,
+                    )
+                    raise PoolExhaustedError(
+                        f'Нет свободных соединений за {timeout} сек.'
+                    )
+                self._cond.wait(remaining)
+
+            waited = time.monotonic() - started
+            self._in_use += 1
+            self._checkouts += 1
+            self._total_wait += waited
+            self._max_wait = max(self._max_wait, waited)
+
+        try:
+            if conn is None:
+                return self._connect()
+            if not self._is_healthy(conn, last_used):
+                with self._cond:
+                    self._health_failures += 1
+                self._close(conn)
+                return self._connect()
+            return conn
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+    def putconn(self, conn: Connection, discard: bool = False) -> None:
+        if not discard and not conn.closed:
+            try:
+                if conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                discard = True
+
+        if discard or conn.closed:
+            self._close(conn)
+            with self._cond:
+                self._size -= 1
+                self._in_use -= 1
+                self._cond.notify()
+            return
+
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._in_use -= 1
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self, timeout: float | None = None) -> Iterator[Connection]:
+        """
+        Выдаёт соединение из пула. При успешном выходе транзакция
+        фиксируется, при исключении — откатывается.
+        """
+        conn = self.getconn(timeout)
+        discard = False
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                discard = True
+            raise
+        finally:
+            self.putconn(conn, discard=discard or bool(conn.closed))
+
+    def closeall(self) -> None:
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+        for conn, _ in idle:
+            self._close(conn)
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': self._in_use,
+                'max_size': self.max_size,
+                'checkouts': self._checkouts,
+                'avg_wait': (
+                    self._total_wait / self._checkouts
+                    if self._checkouts else 0.0
+                ),
+                'max_wait': self._max_wait,
+                'exhausted': self._exhausted,
+                'health_failures': self._health_failures,
+            }
+
+    def _is_healthy(self, conn: Connection, last_used: float) -> bool:
+        if conn.closed:
+            return False
+        if time.monotonic() - last_used < self.health_check_interval:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    @staticmethod
+    def _close(conn: Connection) -> None:
+        try:
+            conn.close()
+        except Exception:
+            pass
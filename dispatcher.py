@@ -0,0 +1,219 @@
+"""
+Обработка обновлений Telegram по шардам с порядком внутри чата.
+
+Чат по хэшу chat.id закреплён за одним из UPDATE_SHARDS шардов, у
+каждого шарда один обработчик. Поэтому два обновления одного чата
+никогда не обрабатываются одновременно и идут в порядке поступления,
+а тяжёлый чат занимает не больше одного обработчика. Внутри шарда
+чаты обслуживаются по кругу: по одному обновлению от каждого чата,
+так что длинная серия сообщений одного чата не задерживает соседей
+по шарду. Очередь шарда ограничена UPDATE_QUEUE_SIZE / UPDATE_SHARDS.
+"""
+import asyncio
+import logging
+import threading
+import typing
+from collections import OrderedDict, deque
+
+from telebot.types import Update
+
+from const import UPDATE_SHARDS, UPDATE_QUEUE_SIZE
+
+
+Handler = typing.Callable[[Update], None]
+AsyncHandler = typing.Callable[[Update], typing.Awaitable[None]]
+
+
+def update_chat_id(update: Update) -> int:
+    """Чат, к которому относится обновление; иначе само обновление"""
+    for name in ('message', 'edited_message', 'channel_post',
+                 'edited_channel_post'):
+        message = getattr(update, name, None)
+        if message is not None:
+            return message.chat.id
+    callback = update.callback_query
+    if callback is not None:
+        if callback.message is not None:
+            return callback.message.chat.id
+        return callback.from_user.id
+    for name in ('inline_query', 'chosen_inline_result',
+                 'pre_checkout_query', 'shipping_query', 'my_chat_member',
+                 'chat_member', 'chat_join_request'):
+        event = getattr(update, name, None)
+        if event is not None:
+            chat = getattr(event, 'chat', None)
+            return chat.id if chat is not None else event.from_user.id
+    return update.update_id
+
+
+class Shard:
+    """Очереди чатов одного шарда в порядке обхода по кругу"""
+
+    def __init__(self, capacity: int) -> None:
+        self.capacity = capacity
+        self.chats: OrderedDict[int, deque] = OrderedDict()
+        self.size = 0
+
+    def full(self) -> bool:
+        return self.size >= self.capacity
+
+    def push(self, key: int, update: Update) -> None:
+        self.chats.setdefault(key, deque()).append(update)
+        self.size += 1
+
+    def pop(self) -> Update:
+        """Следующее обновление первого чата; чат уходит в конец круга"""
+        key, updates = next(iter(self.chats.items()))
+        update = updates.popleft()
+        if updates:
+            self.chats.move_to_end(key)
+        else:
+            del self.chats[key]
+        self.size -= 1
+        return update
+
+
+def shard_stats(shards: list[Shard]) -> dict[str, typing.Any]:
+    depths = [shard.size for shard in shards]
+    return {
+        'shards': len(shards),
+        'pending': sum(depths),
+        'max_depth': max(depths),
+        'chats': sum(len(shard.chats) for shard in shards),
+        'depths': depths,
+    }
+
+
+class ShardedDispatcher:
+    """Шарды с потоком-обработчиком на каждый"""
+
+    def __init__(
+            self,
+            handle: Handler,
+            shards: int = UPDATE_SHARDS,
+            queue_size: int = UPDATE_QUEUE_SIZE) -> None:
+        self.handle = handle
+        capacity = max(1, queue_size // shards)
+        self._shards = [Shard(capacity) for _ in range(shards)]
+        self._conditions = [threading.Condition() for _ in range(shards)]
+        self._closed = False
+        self._threads = [
+            threading.Thread(
+                target=self._consume, args=(i,),
+                name=f'shard-{i}', daemon=True,
+            )
+            for i in range(shards)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(
+            self, update: Update, block: bool = False,
+            timeout: float | None = None) -> bool:
+        """
+        Ставит обновление в очередь его шарда. Без block возвращает
+        False, если очередь полна; с block ждёт места до timeout.
+        """
+        key = update_chat_id(update)
+        i = hash(key) % len(self._shards)
+        shard, condition = self._shards[i], self._conditions[i]
+        with condition:
+            if shard.full() and not (block and condition.wait_for(
+                    lambda: not shard.full() or self._closed, timeout)):
+                return False
+            if self._closed:
+                return False
+            shard.push(key, update)
+            condition.notify_all()
+        return True
+
+    def _consume(self, i: int) -> None:
+        shard, condition = self._shards[i], self._conditions[i]
+        while True:
+            with condition:
+                condition.wait_for(lambda: shard.chats or self._closed)
+                if not shard.chats:
+                    return
+                update = shard.pop()
+                condition.notify_all()
+            try:
+                self.handle(update)
+            except Exception as e:
+                logging.exception(
+                    "Ошибка обработки обновления %s: %s", update.update_id, e,
+                )
+
+    def shutdown(self) -> None:
+        """Дорабатывает уже принятые обновления и останавливает потоки"""
+        self._closed = True
+        for condition in self._conditions:
+            with condition:
+                condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+
+    def stats(self) -> dict[str, typing.Any]:
+        return shard_stats(self._shards)
+
+
+class AsyncShardedDispatcher:
+    """То же для asyncio: задача-обработчик на каждый шард"""
+
+    def __init__(
+            self,
+            handle: AsyncHandler,
+            shards: int = UPDATE_SHARDS,
+            queue_size: int = UPDATE_QUEUE_SIZE) -> None:
+        self.handle = handle
+        capacity = max(1, queue_size // shards)
+        self._shards = [Shard(capacity) for _ in range(shards)]
+        self._ready = [asyncio.Event() for _ in range(shards)]
+        self._space = [asyncio.Event() for _ in range(shards)]
+        self._tasks: list[asyncio.Task] = []
+
+    def start(self) -> None:
+        self._tasks = [
+            asyncio.create_task(self._consume(i))
+            for i in range(len(self._shards))
+        ]
+
+    def submit(self, update: Update) -> bool:
+        key = update_chat_id(update)
+        i = hash(key) % len(self._shards)
+        if self._shards[i].full():
+            return False
+        self._shards[i].push(key, update)
+        self._ready[i].set()
+        return True
+
+    async def put(self, update: Update) -> None:
+        """Ждёт места в очереди шарда"""
+        i = hash(update_chat_id(update)) % len(self._shards)
+        while not self.submit(update):
+            self._space[i].clear()
+            await self._space[i].wait()
+
+    async def _consume(self, i: int) -> None:
+        shard = self._shards[i]
+        while True:
+            while not shard.chats:
+                self._ready[i].clear()
+                await self._ready[i].wait()
+            update = shard.pop()
+            self._space[i].set()
+            try:
+                await self.handle(update)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.exception(
+                    "Ошибка обработки обновления %s: %s", update.update_id, e,
+                )
+
+    async def shutdown(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def stats(self) -> dict[str, typing.Any]:
+        return shard_stats(self._shards)
@@ -1,8 +1,38 @@
+"""
+Генерация картинок DALL·E.
+
+Генерация — самый долгий и дорогой запрос, поэтому она идёт в
+отдельном пуле image_workers (не больше IMAGE_WORKERS одновременно),
+а пользователь видит своё место в очереди. Отправленная картинка
+запоминается по нормализованному промпту как file_id Telegram: повтор
+того же промпта и копия администратору отправляются без новой
+генерации и повторной загрузки. Одинаковые промпты, пришедшие во
+время генерации, ждут её результата.
+"""
+import logging
+import threading
+
 from openai_client import client
 from bot_instance import bot
 from telebot import types
 from telebot.types import Message
-from const import ADMIN_IDS
+from const import ADMIN_IDS, IMAGE_WORKERS, IMAGE_CACHE
+from database import get_cached_image, save_cached_image, set_next_step
+from utils import normalize, question_key
+from media import MediaWorkers
+
+
+IMAGE_MODEL = "dall-e-3"
+IMAGE_SIZE = "1024x1024"
+
+image_workers = MediaWorkers(IMAGE_WORKERS, 'image')
+# Ключ промпта -> чаты, которые ждут уже идущую генерацию
+_in_progress: dict[str, list[int]] = {}
+_in_progress_lock = threading.Lock()
+
+
+def prompt_key(prompt: str) -> str:
+    return question_key(f'{IMAGE_MODEL}:{IMAGE_SIZE}:{normalize(prompt)}')
 
 
 def take_image_prompt_from_user(message: Message) -> None:
@@ -11,12 +41,12 @@ def take_image_prompt_from_user(message: Message) -> None:
     )
     end_button = types.KeyboardButton('Закончить ответ')
     markup.add(end_button)
-    msg = bot.send_message(
+    bot.send_message(
         chat_id=message.chat.id,
         text='Опишите, что именно вы хотите изобразить на картинке',
         reply_markup=markup
     )
-    bot.register_next_step_handler(msg, handle_image_prompt)
+    set_next_step(message.chat.id, 'image_prompt')
 
 
 def handle_image_prompt(message: Message) -> None:
@@ -28,18 +58,44 @@ def handle_image_prompt(message: Message) -> None:
                 reply_markup=types.ReplyKeyboardRemove()
             )
             return
-        bot.send_chat_action(message.chat.id, 'upload_photo')
-        image_url = create_image(message.text)
+        if not message.text:
+            bot.send_message(
+                chat_id=message.chat.id,
+                text="Опишите картинку текстом.",
+                reply_markup=types.ReplyKeyboardRemove()
+            )
+            return
 
-        bot.send_photo(
-            chat_id=message.chat.id,
-            photo=image_url
-        )
+        key = prompt_key(message.text)
+        if IMAGE_CACHE and send_cached_image(message.chat.id, key):
+            return
+
+        with _in_progress_lock:
+            if key in _in_progress:
+                _in_progress[key].append(message.chat.id)
+                waiting = True
+            else:
+                _in_progress[key] = []
+                waiting = False
+        if waiting:
+            bot.send_message(
+                chat_id=message.chat.id,
+                text="🎨 Такую картинку уже рисуем, пришлём, как будет готова.",
+                reply_markup=types.ReplyKeyboardRemove()
+            )
+            return
 
-        bot.send_photo(
-            chat_id=ADMIN_IDS[0],
-            photo=image_url,
+        position = image_workers.submit(
+            generate_image, message.chat.id, key, message.text,
         )
+        if position:
+            bot.send_message(
+                chat_id=message.chat.id,
+                text=f"🎨 Вы {position}-й в очереди на генерацию картинки.",
+                reply_markup=types.ReplyKeyboardRemove()
+            )
+        else:
+            bot.send_chat_action(message.chat.id, 'upload_photo')
 
     except Exception as e:
         bot.send_message(
@@ -48,11 +104,70 @@ def handle_image_prompt(message: Message) -> None:
         )
 
 
+def send_cached_image(chat_id: int, key: str) -> bool:
+    try:
+        file_id = get_cached_image(key)
+    except Exception as e:
+        logging.exception("Ошибка чтения кэша картинок: %s", e)
+        return False
+    if not file_id:
+        return False
+    bot.send_photo(
+        chat_id=chat_id,
+        photo=file_id,
+        reply_markup=types.ReplyKeyboardRemove()
+    )
+    # Копия администратору уходит только с новой генерации
+    return True
+
+
+def generate_image(chat_id: int, key: str, prompt: str) -> None:
+    """Генерация в пуле image_workers и рассылка всем, кто её ждёт"""
+    file_id = None
+    try:
+        bot.send_chat_action(chat_id, 'upload_photo')
+        sent = bot.send_photo(
+            chat_id=chat_id,
+            photo=create_image(prompt),
+            reply_markup=types.ReplyKeyboardRemove()
+        )
+        file_id = sent.photo[-1].file_id
+        # До снятия отметки о генерации, чтобы новый такой же промпт
+        # попал уже в кэш, а не на вторую генерацию
+        if IMAGE_CACHE:
+            save_cached_image(key, prompt, file_id)
+    except Exception as e:
+        logging.exception("Ошибка генерации картинки: %s", e)
+        if not file_id:
+            bot.send_message(
+                chat_id=chat_id, text=f"Произошла ошибка: {str(e)}",
+            )
+    finally:
+        with _in_progress_lock:
+            waiters = _in_progress.pop(key, [])
+
+    if not file_id:
+        for waiter in waiters:
+            bot.send_message(
+                chat_id=waiter,
+                text="Не удалось нарисовать картинку, попробуйте ещё раз.",
+            )
+        return
+
+    for recipient in [*waiters, ADMIN_IDS[0]]:
+        try:
+            bot.send_photo(chat_id=recipient, photo=file_id)
+        except Exception as e:
+            logging.exception(
+                "Не удалось отправить картинку %s: %s", recipient, e,
+            )
+
+
 def create_image(prompt: str) -> str:
     response = client.images.generate(
-        model="dall-e-3",
+        model=IMAGE_MODEL,
         prompt=prompt,
-        size="1024x1024",
+        size=IMAGE_SIZE,
         quality="standard",
         n=1,
     )
@@ -1,28 +1,53 @@
-import time
 import logging
-import os
+import signal
+import sys
+import threading
 import typing
 
-from concurrent.futures import ThreadPoolExecutor
-from telebot import types
+from concurrent.futures import Future, ThreadPoolExecutor
+from telebot import types, util
 from telebot.types import Message, CallbackQuery
 from openai.types.beta.threads import Run
-import openai
 
 from bot_instance import bot
 from openai_client import client
 from database import (setup_database, get_thread_id,
                       save_message, add_member_to_db,
                       set_user_active_status, is_user_active,
-                      delete_user_history,
+                      delete_user_history, set_thread_id,
+                      set_next_step, get_next_step, pop_next_step,
+                      add_thread_files,
                       )
-from utils import split_text, escape_markdown, clean_response
+from utils import format_reply
 from admin import (admin_menu, show_users,
                    show_balance, show_message,
-                   mailing, write_mailing_message
+                   mailing, write_mailing_message, check_mailing_message,
+                   history_command, handle_admin_page,
+                   search_command, handle_search_page,
+                   )
+from const import (INFO_ABOUT_BOT, ASSISTAND_ID, ADMIN_IDS, STREAM_REPLIES,
+                   ANSWER_CACHE, CONVERSATION_ENGINE,
+                   VOICE_WORKERS, VOICE_MAX_SIZE,
+                   PHOTO_WORKERS, PHOTO_MAX_SIZE, BOT_MODE,
+                   )
+from image import take_image_prompt_from_user, handle_image_prompt
+from broadcast import resume_broadcasts
+from archive import start_archiver
+from webhook import run_webhook, run_polling
+from streaming import StreamingReply
+from conversation_queue import ConversationQueue, merge_contents
+from run_manager import RunManager, AssistantStream
+from context import (run_params, should_compact, compact_thread,
+                     drop_thread_files,
+                     )
+from answer_cache import answer_cache
+from chat_engine import new_thread_id, conversation_context, CompletionStream
+from media import (MediaWorkers, MediaTooLargeError, voice_limit_error,
+                   voice_too_large_text, download_to_buffer, transcribe,
+                   photo_content, photo_history_text, choose_photo_size,
+                   preprocess_photo, image_url_part, image_file_part,
+                   upload_photo, uploaded_file_ids, delete_uploaded_files,
                    )
-from const import INFO_ABOUT_BOT, ASSISTAND_ID, ADMIN_IDS
-from image import take_image_prompt_from_user
 
 
 logging.basicConfig(
@@ -36,10 +61,27 @@ logging.basicConfig(
 
 setup_database()
 
-user_threads = {}
 executor = ThreadPoolExecutor(max_workers=10)
 
 
+@bot.message_handler(
+    func=lambda message: get_next_step(message.chat.id) is not None,
+    content_types=util.content_type_media,
+)
+def next_step(message: Message) -> None:
+    """
+    Ответ на вопрос бота. Шаг хранится в общем хранилище состояния,
+    а не в register_next_step_handler, поэтому ответ может прийти
+    в любой процесс бота.
+    """
+    step = pop_next_step(message.chat.id)
+    handler = NEXT_STEPS.get(step)
+    if handler is None:
+        logging.warning("Шаг %s для чата %s не найден", step, message.chat.id)
+        return
+    handler(message)
+
+
 @bot.message_handler(commands=["start"])
 def start(message: Message) -> None:
     markup = types.InlineKeyboardMarkup()
@@ -67,13 +109,7 @@ def start(message: Message) -> None:
     telegram_username = message.from_user.username or "no_username"
     add_member_to_db(user_telegram_id, telegram_username)
     user_id = message.chat.id
-    thread_id = get_thread_id(user_id)
-    if not thread_id:
-        try:
-            thread = client.beta.threads.create()
-            user_threads[user_id] = thread.id
-        except Exception as e:
-            logging.exception("Ошибка при создании потока: %s", e)
+    get_or_create_thread_id(user_id)
     bot.send_message(
         chat_id=user_id,
         text="Привет! Я математический помощник. Задавай свои вопросы!",
@@ -81,11 +117,38 @@ def start(message: Message) -> None:
     )
 
 
+def get_or_create_thread_id(user_id: int) -> typing.Optional[str]:
+    thread_id = get_thread_id(user_id)
+    if thread_id:
+        return thread_id
+    if CONVERSATION_ENGINE == 'chat':
+        thread_id = new_thread_id()
+        set_thread_id(user_id, thread_id)
+        return thread_id
+    try:
+        thread = client.beta.threads.create()
+    except Exception as e:
+        logging.exception("Ошибка создания потока: %s", e)
+        return None
+    set_thread_id(user_id, thread.id)
+    return thread.id
+
+
 @bot.message_handler(commands=['admin'])
 def admin(message: Message) -> None:
     admin_menu(message)
 
 
+@bot.message_handler(commands=['history'])
+def history(message: Message) -> None:
+    history_command(message)
+
+
+@bot.message_handler(commands=['search'])
+def search(message: Message) -> None:
+    search_command(message)
+
+
 def send_processing_status(user_id: int) -> int:
     status_msg = bot.send_message(user_id, "🔄 Бот обрабатывает ваш вопрос...")
     return status_msg.message_id
@@ -103,26 +166,6 @@ def take_message_from_user(message: Message) -> None:
     )
 
 
-def run_openai_with_retries(
-        thread_id: str, assistant_id: str, retries: int = 3
-        ) -> typing.Optional[Run]:
-    for attempt in range(retries):
-        try:
-            return client.beta.threads.runs.create(
-                thread_id=thread_id,
-                assistant_id=assistant_id
-            )
-        except openai.RateLimitError:
-            wait_time = 2 ** attempt * 5
-            logging.warning("⚠️ Rate limit: ждём %s сек...", wait_time)
-            time.sleep(wait_time)
-        except Exception as e:
-            logging.exception("🚨 Ошибка при запросе в OpenAI: %s", e)
-            return None
-    logging.error("❌ Не удалось выполнить запрос после повторов.")
-    return None
-
-
 @bot.message_handler(func=lambda message: True)
 def handle_message(message: Message) -> None:
     user_id = message.chat.id
@@ -131,8 +174,6 @@ def handle_message(message: Message) -> None:
     if not is_user_active(message.from_user.id):
         return
 
-    # status_message_id = send_processing_status(user_id)
-
     if message.text == 'Закончить ответ':
         set_user_active_status(message.from_user.id, False)
         bot.send_message(
@@ -142,75 +183,263 @@ def handle_message(message: Message) -> None:
         )
         return start(message)
 
-    thread_id = get_thread_id(user_id)
+    thread_id = get_or_create_thread_id(user_id)
     if not thread_id:
+        bot.send_message(
+            user_id, "Ошибка: Не удалось создать поток для общения.",
+        )
+        return
+
+    save_message(user_id, thread_id, "user", user_text)
+    bot.send_chat_action(message.chat.id, 'typing')
+    conversations.submit(thread_id, user_id, user_text)
+
+
+def answer_batch(thread_id: str, batch: list) -> typing.Optional[Future]:
+    """
+    Один запуск ассистента на все накопившиеся сообщения потока.
+    Возвращает Future, если ответ придёт позже через RunManager.
+    """
+    user_id = batch[0][0]
+    current_thread_id = get_thread_id(user_id)
+    if current_thread_id and current_thread_id != thread_id:
+        # Пока сообщения ждали, диалог свернули в новый поток
+        for item_user_id, item in batch:
+            conversations.submit(current_thread_id, item_user_id, item)
+        return None
+    content = merge_contents([content for _, content in batch])
+    cacheable = ANSWER_CACHE and isinstance(content, str)
+    if cacheable:
+        answer = answer_cache.lookup(content)
+        if answer:
+            send_cached_answer(user_id, thread_id, content, answer)
+            return None
+    file_ids = uploaded_file_ids(content)
+    status_message_id = send_processing_status(user_id)
+    if CONVERSATION_ENGINE != 'chat':
         try:
-            new_thread = client.beta.threads.create()
-            thread_id = new_thread.id
+            client.beta.threads.messages.create(
+                thread_id=thread_id,
+                role="user",
+                content=content,
+            )
         except Exception as e:
-            logging.exception("Ошибка создания потока: %s", e)
+            logging.exception("Ошибка добавления сообщения в поток: %s", e)
             bot.send_message(
-                user_id, "Ошибка: Не удалось создать поток для общения.",
+                user_id,
+                "⚠️ Не удалось получить ответ от OpenAI. Попробуйте позже."
+            )
+            bot.delete_message(user_id, status_message_id)
+            delete_uploaded_files(file_ids)
+            return None
+        add_thread_files(user_id, thread_id, file_ids)
+    question = content if cacheable else None
+    answer = reply_to_user(user_id, thread_id, status_message_id, content)
+    if not isinstance(answer, Future):
+        finish_answer(user_id, thread_id, question, answer)
+        return None
+
+    def finish(done: Future) -> None:
+        answer = None if done.exception() else done.result()
+        finish_answer(user_id, thread_id, question, answer)
+    # Выполнится до того, как очередь возьмёт следующие сообщения потока
+    answer.add_done_callback(finish)
+    return answer
+
+
+def finish_answer(
+        user_id: int, thread_id: str,
+        question: typing.Optional[str],
+        answer: typing.Optional[str]) -> None:
+    """Кэширует ответ и сворачивает поток, если он стал длинным"""
+    if question and answer:
+        answer_cache.store(question, answer)
+    if should_compact(thread_id):
+        compact_thread(user_id, thread_id)
+
+
+def send_cached_answer(
+        user_id: int, thread_id: str, question: str, answer: str) -> None:
+    """
+    Ответ из кэша без запуска ассистента. Вопрос и ответ добавляются
+    в поток, чтобы ассистент видел их в продолжении диалога (движку
+    chat хватает локальной истории).
+    """
+    if CONVERSATION_ENGINE != 'chat':
+        try:
+            client.beta.threads.messages.create(
+                thread_id=thread_id, role="user", content=question,
+            )
+            client.beta.threads.messages.create(
+                thread_id=thread_id, role="assistant", content=answer,
             )
-            return
+        except Exception as e:
+            logging.exception(
+                "Ошибка добавления ответа из кэша в поток: %s", e,
+            )
+    for part in format_reply(answer):
+        save_message(user_id, thread_id, "assistant", part)
+        bot.send_message(user_id, part, parse_mode='MarkdownV2')
+
+
+conversations = ConversationQueue(executor, answer_batch)
+transcribers = MediaWorkers(VOICE_WORKERS, 'voice')
+photo_workers = MediaWorkers(PHOTO_WORKERS, 'photo')
+_runs: typing.Optional[RunManager] = None
+_runs_lock = threading.Lock()
+
+
+def get_runs() -> RunManager:
+    """RunManager создаётся при первом запуске, вместе с его потоками"""
+    global _runs
+    with _runs_lock:
+        if _runs is None:
+            _runs = RunManager(client, executor)
+        return _runs
+
+
+def reply_to_user(
+        user_id: int, thread_id: str, status_message_id: int,
+        content: typing.Any = None) -> typing.Union[str, Future, None]:
+    """
+    Отвечает пользователю; возвращает полный ответ ассистента или
+    Future с ним, если запуск ведёт RunManager.
+    """
+    if CONVERSATION_ENGINE == 'chat':
+        return process_chat_reply(
+            user_id, thread_id, status_message_id, content,
+        )
+    if STREAM_REPLIES:
+        return process_openai_reply_stream(
+            user_id, thread_id, status_message_id,
+        )
+    return process_openai_reply(user_id, thread_id, status_message_id)
 
-    save_message(user_id, thread_id, "user", user_text)
+
+def process_chat_reply(
+        user_id: int, thread_id: str, status_message_id: int,
+        content: typing.Any = None) -> typing.Optional[Future]:
+    """Один потоковый запрос chat completions с контекстом из истории"""
     try:
-        bot.send_chat_action(message.chat.id, 'typing')
-        status_message_id = send_processing_status(user_id)
-        client.beta.threads.messages.create(
-            thread_id=thread_id,
-            role="user",
-            content=user_text
-        )
+        messages = conversation_context(user_id, thread_id, content)
     except Exception as e:
-        logging.exception("Ошибка добавления сообщения в поток: %s", e)
-        return
+        logging.exception("🚨 Ошибка при запросе в OpenAI: %s", e)
+        send_reply_error(user_id, status_message_id)
+        return None
+    reply = StreamingReply(user_id, status_message_id)
+    chunks: list[str] = []
+
+    def feed(delta: str) -> None:
+        chunks.append(delta)
+        if STREAM_REPLIES:
+            reply.feed(delta)
+    return get_runs().stream(
+        thread_id, CompletionStream(messages), feed,
+        lambda run, completed: deliver_stream_reply(
+            user_id, thread_id, status_message_id, reply,
+            ''.join(chunks), completed,
+        ),
+    )
+
+
+def process_openai_reply_stream(
+        user_id: int, thread_id: str, status_message_id: int) -> Future:
+    reply = StreamingReply(user_id, status_message_id)
+    return get_runs().stream(
+        thread_id,
+        AssistantStream(client, thread_id, ASSISTAND_ID, run_params()),
+        reply.feed,
+        lambda run, completed: deliver_stream_reply(
+            user_id, thread_id, status_message_id, reply, reply.text,
+            completed and run is not None and run.status == "completed",
+            run,
+        ),
+    )
+
+
+def deliver_stream_reply(
+        user_id: int, thread_id: str, status_message_id: int,
+        reply: StreamingReply, text: str, completed: bool,
+        run: typing.Optional[Run] = None) -> typing.Optional[str]:
+    """
+    Дописывает потоковый ответ; возвращает его текст, если ответ
+    получен целиком. Оборванный ответ показан пользователю, но не
+    годится для кэша.
+    """
+    if not text:
+        if run is not None and run.status != "completed":
+            logging.error("Запуск %s завершился: %s", run.id, run.status)
+        send_reply_error(user_id, status_message_id)
+        return None
+    try:
+        for part in reply.finish(text):
+            save_message(user_id, thread_id, "assistant", part)
+    except Exception as e:
+        logging.exception("Ошибка обработки ответа от OpenAI: %s", e)
+        return None
+    return text if completed else None
+
 
-    executor.submit(
-        process_openai_reply, user_id, thread_id, status_message_id,
+def send_reply_error(user_id: int, status_message_id: int) -> None:
+    bot.send_message(
+        user_id,
+        "⚠️ Не удалось получить ответ от OpenAI. Попробуйте позже."
     )
+    try:
+        bot.delete_message(user_id, status_message_id)
+    except Exception as e:
+        logging.error(f"Ошибка при удалении статуса: {e}")
 
 
 def process_openai_reply(
-        user_id: int, thread_id: str, status_message_id: int) -> None:
-    run = run_openai_with_retries(thread_id, ASSISTAND_ID)
-    if not run:
-        bot.send_message(
-            user_id,
-            "⚠️ Не удалось получить ответ от OpenAI. Попробуйте позже."
-        )
-        return
+        user_id: int, thread_id: str, status_message_id: int) -> Future:
+    """Запуск без ожидания в потоке: итог придёт в deliver_run_reply"""
+    return get_runs().submit(
+        thread_id, ASSISTAND_ID,
+        lambda run: deliver_run_reply(
+            user_id, thread_id, status_message_id, run,
+        ),
+        **run_params(),
+    )
 
-    while True:
-        run_status = client.beta.threads.runs.retrieve(
-            thread_id=thread_id, run_id=run.id,
-        )
-        if run_status.status in ["completed", "failed"]:
-            break
-        time.sleep(1)
 
+def deliver_run_reply(
+        user_id: int, thread_id: str, status_message_id: int,
+        run: typing.Optional[Run]) -> typing.Optional[str]:
+    assistant_reply = None
     try:
-        messages = client.beta.threads.messages.list(thread_id=thread_id)
-        assistant_reply = messages.data[0].content[0].text.value
-        split_assistant_reply = split_text(assistant_reply)
-        escaped_parts = [
-            escape_markdown(part) for part in split_assistant_reply
-        ]
-
-        for part in escaped_parts:
-            save_message(user_id, thread_id, "assistant", part)
-            bot.send_message(
-                user_id,
-                part,
-                parse_mode='MarkdownV2',
+        if run is not None and run.status == "completed":
+            messages = client.beta.threads.messages.list(
+                thread_id=thread_id, run_id=run.id,
             )
+            assistant_reply = messages.data[0].content[0].text.value
     except Exception as e:
-        logging.exception("Ошибка обработки ответа от OpenAI: %s", e)
+        logging.exception("Ошибка получения ответа от OpenAI: %s", e)
+
+    if assistant_reply is None:
+        if run is not None:
+            logging.error("Запуск %s завершился: %s", run.id, run.status)
+        bot.send_message(
+            user_id,
+            "⚠️ Не удалось получить ответ от OpenAI. Попробуйте позже."
+        )
+    else:
+        try:
+            for part in format_reply(assistant_reply):
+                save_message(user_id, thread_id, "assistant", part)
+                bot.send_message(
+                    user_id,
+                    part,
+                    parse_mode='MarkdownV2',
+                )
+        except Exception as e:
+            logging.exception("Ошибка обработки ответа от OpenAI: %s", e)
+            assistant_reply = None
     try:
         bot.delete_message(user_id, status_message_id)
     except Exception as e:
         logging.error(f"Ошибка при удалении статуса: {e}")
+    return assistant_reply
 
 
 @bot.message_handler(content_types=['voice'])
@@ -218,135 +447,94 @@ def handle_voice(message: Message) -> None:
     if not is_user_active(message.from_user.id):
         return
 
-    user_id = message.chat.id
-    thread_id = get_thread_id(user_id)
+    error = voice_limit_error(message.voice)
+    if error:
+        bot.reply_to(message, error)
+        return
 
-    status_message_id = send_processing_status(user_id)
+    user_id = message.chat.id
+    thread_id = get_or_create_thread_id(user_id)
 
     if not thread_id:
-        try:
-            new_thread = client.beta.threads.create()
-            thread_id = new_thread.id
-        except Exception as e:
-            logging.exception("Ошибка создания потока: %s", e)
-            bot.send_message(user_id, "❌ Ошибка: не удалось создать поток.")
-            return
-    print("Голосовое сообщение получено!")
+        bot.send_message(user_id, "❌ Ошибка: не удалось создать поток.")
+        return
 
-    try:
-        file_info = bot.get_file(message.voice.file_id)
-        downloaded_file = bot.download_file(file_info.file_path)
-        print(file_info)
-
-        file_path = f"voice_{message.message_id}.ogg"
-        print(file_path)
-        with open(file_path, 'wb') as new_file:
-            new_file.write(downloaded_file)
-
-        with open(file_path, 'rb') as audio_file:
-            transcript = client.audio.transcriptions.create(
-                model="whisper-1",
-                file=audio_file
-            )
-        print("Транскрипция:", transcript.text)
-        save_message(user_id, thread_id, "user", transcript.text)
-        try:
-            client.beta.threads.messages.create(
-                thread_id=thread_id,
-                role="user",
-                content=transcript.text
-            )
-        except Exception as e:
-            logging.exception("Ошибка добавления сообщения в поток: %s", e)
-            return
-        executor.submit(
-            process_openai_reply, user_id, thread_id, status_message_id
+    position = transcribers.submit(transcribe_voice, message, thread_id)
+    if position:
+        bot.reply_to(
+            message,
+            f"🎙 Сейчас много голосовых, ваше — {position}-е в очереди "
+            "на распознавание",
         )
+    else:
+        bot.send_chat_action(user_id, 'typing')
+
+
+def transcribe_voice(message: Message, thread_id: str) -> None:
+    """Распознавание в пуле transcribers, ответ — через очередь диалога"""
+    user_id = message.chat.id
+    try:
+        buffer = download_to_buffer(message.voice.file_id, VOICE_MAX_SIZE)
+        text = transcribe(buffer, f"voice_{message.message_id}.ogg")
+    except MediaTooLargeError:
+        bot.reply_to(message, voice_too_large_text())
+        return
     except Exception as e:
+        logging.exception("Ошибка распознавания голосового: %s", e)
         bot.reply_to(message, f"Ошибка: {e}")
+        return
 
-    finally:
-        if os.path.exists(file_path):
-            os.remove(file_path)
+    if not text:
+        bot.reply_to(message, "🤷 Не удалось разобрать речь в голосовом")
+        return
+    save_message(user_id, thread_id, "user", text)
+    conversations.submit(thread_id, user_id, text)
 
 
 @bot.message_handler(content_types=['photo'])
 def handle_image(message: Message) -> None:
+    """Фото идёт в ту же очередь диалога, что и текст: один запуск"""
     if not is_user_active(message.from_user.id):
         return
 
     user_id = message.chat.id
-    thread_id = get_thread_id(user_id)
-    status_message_id = send_processing_status(user_id)
+    thread_id = get_or_create_thread_id(user_id)
 
     if not thread_id:
-        try:
-            new_thread = client.beta.threads.create()
-            thread_id = new_thread.id
-        except Exception as e:
-            logging.exception("Ошибка создания потока: %s", e)
-            bot.send_message(user_id, "❌ Ошибка: не удалось создать поток.")
-            return
+        bot.send_message(user_id, "❌ Ошибка: не удалось создать поток.")
+        return
 
-    try:
-        # Получаем файл
-        file_info = bot.get_file(message.photo[-1].file_id)
-        file_path = file_info.file_path
-        file_url = f"https://api.telegram.org/file/bot{bot.token}/{file_path}"
-
-        caption = message.caption or "Что изображено на картинке?"
-
-        client.beta.threads.messages.create(
-            thread_id=thread_id,
-            role="user",
-            content=[
-                {"type": "text", "text": caption},
-                {
-                    "type": "image_url",
-                    "image_url": {
-                        "url": file_url
-                    }
-                }
-            ]
+    position = photo_workers.submit(prepare_photo, message, thread_id)
+    if position:
+        bot.reply_to(
+            message, f"🖼 Сейчас много фото, ваше — {position}-е в очереди",
         )
+    else:
+        bot.send_chat_action(user_id, 'typing')
 
-        run = run_openai_with_retries(thread_id, ASSISTAND_ID)
-        if not run:
-            bot.send_message(
-                user_id,
-                "⚠️ Не удалось получить ответ. Попробуйте позже.",
-            )
-            return
 
-        while True:
-            run_status = client.beta.threads.runs.retrieve(
-                thread_id=thread_id, run_id=run.id,
-             )
-            if run_status.status in ["completed", "failed"]:
-                break
-            time.sleep(1)
-
-        messages = client.beta.threads.messages.list(thread_id=thread_id)
-        assistant_reply = messages.data[0].content[0].text.value
-
-        cleaned_reply = clean_response(assistant_reply)
-        formatted_parts = [
-            escape_markdown(part) for part in split_text(cleaned_reply)
-        ]
-
-        for part in formatted_parts:
-            save_message(user_id, thread_id, "assistant", part)
-            bot.send_message(user_id, part, parse_mode='MarkdownV2')
-        executor.submit(
-            process_openai_reply,
-            user_id,
-            thread_id,
-            status_message_id  # <-- Добавлен третий аргумент
-        )
+def prepare_photo(message: Message, thread_id: str) -> None:
+    """Скачивание и сжатие фото в пуле photo_workers"""
+    user_id = message.chat.id
+    try:
+        photo = choose_photo_size(message.photo)
+        jpeg = preprocess_photo(download_to_buffer(photo.file_id, PHOTO_MAX_SIZE))
+        if CONVERSATION_ENGINE == 'chat':
+            image_part = image_url_part(jpeg)
+        else:
+            image_part = image_file_part(upload_photo(jpeg))
+    except MediaTooLargeError:
+        bot.reply_to(message, "❌ Фото слишком большое, пришлите поменьше.")
+        return
     except Exception as e:
         logging.exception("Ошибка обработки изображения: %s", e)
         bot.reply_to(message, f"❌ Ошибка анализа изображения: {str(e)}")
-        bot.delete_message(user_id, status_message_id)
+        return
+
+    save_message(user_id, thread_id, "user", photo_history_text(message.caption))
+    conversations.submit(
+        thread_id, user_id, photo_content(message.caption, image_part),
+    )
 
 
 @bot.callback_query_handler(func=lambda call: call.data == 'ai')
@@ -376,14 +564,14 @@ def fix_bot_take_message(message: Message) -> None:
     markup.add(types.KeyboardButton('Удалить историю'))
 
     # Отправляем сообщение с клавиатурой
-    msg = bot.send_message(
+    bot.send_message(
         chat_id=message.chat.id,
         text="Для удаления истории нажмите кнопку ниже:",
         reply_markup=markup
     )
 
-    # Регистрируем следующий шаг сразу после отправки сообщения
-    bot.register_next_step_handler(msg, fix_bot)
+    # Следующее сообщение из чата уйдёт в fix_bot
+    set_next_step(message.chat.id, 'fix_bot')
 
 
 def fix_bot(message: Message) -> None:
@@ -399,6 +587,7 @@ def fix_bot(message: Message) -> None:
 
         # Выполняем удаление
         if delete_user_history(message.from_user.id):
+            drop_thread_files(message.from_user.id)
             bot.send_message(
                 chat_id=message.chat.id,
                 text="✅ История успешно удалена!",
@@ -424,6 +613,25 @@ def fix_bot(message: Message) -> None:
         return start(message)
 
 
+NEXT_STEPS: dict[str, typing.Callable[[Message], None]] = {
+    'image_prompt': handle_image_prompt,
+    'mailing_message': check_mailing_message,
+    'fix_bot': fix_bot,
+}
+
+
+@bot.callback_query_handler(
+    func=lambda call: call.data.startswith(('hist:', 'users:'))
+)
+def admin_page_callback(call: CallbackQuery) -> None:
+    handle_admin_page(call)
+
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith('find:'))
+def search_page_callback(call: CallbackQuery) -> None:
+    handle_search_page(call)
+
+
 @bot.callback_query_handler(func=lambda call: True)
 def callback_query(call: CallbackQuery) -> None:
     bot.delete_message(call.message.chat.id, call.message.message_id)
@@ -455,5 +663,13 @@ def callback_query(call: CallbackQuery) -> None:
 
 
 if __name__ == "__main__":
+    # SystemExit вместо мгновенного завершения, чтобы atexit дописал
+    # отложенные сообщения в БД
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
     logging.info("Бот запущен...")
-    bot.polling(none_stop=True)
+    resume_broadcasts()
+    start_archiver()
+    if BOT_MODE == 'webhook':
+        run_webhook(bot)
+    else:
+        run_polling(bot)
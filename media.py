@@ -0,0 +1,291 @@
+"""
+Обработка медиа от пользователей: голосовые сообщения и фото.
+
+Тяжёлая работа (скачивание, распознавание, сжатие фото) идёт в
+отдельном пуле MediaWorkers, а не в потоке обработчиков telebot,
+поэтому длинное голосовое не задерживает ответы остальным. Файлы не
+пишутся на диск: скачивание идёт в буфер в памяти, он же передаётся
+в OpenAI. Фото уходит в OpenAI сжатым и без ссылки на файл Telegram,
+в которой есть токен бота.
+"""
+import asyncio
+import base64
+import io
+import logging
+import threading
+import typing
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from PIL import Image, ImageChops, ImageOps, ImageStat
+from telebot import apihelper
+from telebot.types import Voice, PhotoSize
+
+from bot_instance import bot
+from openai_client import client
+from const import (VOICE_MAX_SIZE, VOICE_MAX_DURATION,
+                   PHOTO_MAX_PIXELS, PHOTO_JPEG_QUALITY,
+                   )
+
+
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+DOWNLOAD_TIMEOUT = 60
+
+# Общие соединения с файловым сервером Telegram для всех скачиваний
+download_session = requests.Session()
+
+# Фон считается однотонным, пока отличие от цвета угла меньше порога
+BORDER_THRESHOLD = 24
+# Средняя насыщенность (0-255), ниже которой фото переводится в серое:
+# тетрадь, учебник, доска
+GRAYSCALE_SATURATION = 24
+
+
+class MediaTooLargeError(Exception):
+    pass
+
+
+class MediaWorkers:
+    """
+    Пул с ограниченным числом потоков. submit возвращает место в очереди
+    (0 — задача запускается сразу), чтобы показать его пользователю.
+    """
+
+    def __init__(self, workers: int, name: str) -> None:
+        self.workers = workers
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix=name,
+        )
+        self._running = 0
+        self._waiting = 0
+        self._lock = threading.Lock()
+
+    def submit(self, func: typing.Callable, *args: typing.Any) -> int:
+        with self._lock:
+            position = 0
+            if self._running + self._waiting >= self.workers:
+                position = self._waiting + 1
+            self._waiting += 1
+        self._executor.submit(self._run, func, *args)
+        return position
+
+    def _run(self, func: typing.Callable, *args: typing.Any) -> None:
+        with self._lock:
+            self._waiting -= 1
+            self._running += 1
+        try:
+            func(*args)
+        except Exception as e:
+            logging.exception("Ошибка обработки медиа: %s", e)
+        finally:
+            with self._lock:
+                self._running -= 1
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {'running': self._running, 'waiting': self._waiting}
+
+
+class AsyncMediaWorkers:
+    """То же для asyncio: не больше workers корутин одновременно"""
+
+    def __init__(
+            self, workers: int,
+            spawn: typing.Callable[[typing.Coroutine], None]) -> None:
+        self.spawn = spawn
+        self._slots = asyncio.Semaphore(workers)
+        self._waiting = 0
+
+    def submit(self, func: typing.Callable, *args: typing.Any) -> int:
+        position = 0
+        if self._waiting or self._slots.locked():
+            position = self._waiting + 1
+        self._waiting += 1
+        self.spawn(self._run(func, *args))
+        return position
+
+    async def _run(self, func: typing.Callable, *args: typing.Any) -> None:
+        acquired = False
+        try:
+            async with self._slots:
+                self._waiting -= 1
+                acquired = True
+                await func(*args)
+        except Exception as e:
+            logging.exception("Ошибка обработки медиа: %s", e)
+        finally:
+            if not acquired:
+                self._waiting -= 1
+
+    def stats(self) -> dict[str, int]:
+        return {'waiting': self._waiting}
+
+
+def voice_limit_error(voice: Voice) -> str | None:
+    """Текст отказа, если голосовое слишком длинное или большое"""
+    if voice.duration and voice.duration > VOICE_MAX_DURATION:
+        return (
+            f"⚠️ Голосовое слишком длинное: максимум "
+            f"{VOICE_MAX_DURATION // 60} мин. {VOICE_MAX_DURATION % 60} сек."
+        )
+    if voice.file_size and voice.file_size > VOICE_MAX_SIZE:
+        return voice_too_large_text()
+    return None
+
+
+def voice_too_large_text() -> str:
+    return (
+        f"⚠️ Голосовое слишком большое: максимум "
+        f"{VOICE_MAX_SIZE // (1024 * 1024)} МБ"
+    )
+
+
+def download_to_buffer(file_id: str, max_size: int) -> io.BytesIO:
+    """
+    Скачивает файл Telegram по частям в память. Если файл больше
+    max_size, скачивание прерывается с MediaTooLargeError.
+    """
+    file_info = bot.get_file(file_id)
+    if file_info.file_size and file_info.file_size > max_size:
+        raise MediaTooLargeError(file_info.file_size)
+    url = (apihelper.FILE_URL or "https://api.telegram.org/file/bot{0}/{1}")
+    buffer = io.BytesIO()
+    with download_session.get(
+            url.format(bot.token, file_info.file_path),
+            proxies=apihelper.proxy,
+            stream=True,
+            timeout=DOWNLOAD_TIMEOUT) as response:
+        if response.status_code != 200:
+            raise apihelper.ApiHTTPException('Download file', response)
+        for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+            buffer.write(chunk)
+            if buffer.tell() > max_size:
+                raise MediaTooLargeError(buffer.tell())
+    buffer.seek(0)
+    return buffer
+
+
+def transcribe(buffer: io.BytesIO, file_name: str) -> str:
+    """Распознаёт речь прямо из буфера, без временного файла"""
+    transcript = client.audio.transcriptions.create(
+        model="whisper-1",
+        file=(file_name, buffer),
+    )
+    return transcript.text.strip()
+
+
+DEFAULT_PHOTO_CAPTION = "Что изображено на картинке?"
+
+
+def photo_caption(caption: str | None) -> str:
+    return caption or DEFAULT_PHOTO_CAPTION
+
+
+def photo_history_text(caption: str | None) -> str:
+    """Запись о фото в локальной истории (сама картинка не хранится)"""
+    return f"[Фото] {photo_caption(caption)}"
+
+
+def photo_content(caption: str | None, image_part: dict) -> list[dict]:
+    """Сообщение пользователя с картинкой для OpenAI"""
+    return [{"type": "text", "text": photo_caption(caption)}, image_part]
+
+
+def image_url_part(jpeg: bytes) -> dict:
+    """Картинка прямо в запросе (chat completions), без ссылки на Telegram"""
+    data = base64.b64encode(jpeg).decode()
+    return {
+        "type": "image_url",
+        "image_url": {"url": f"data:image/jpeg;base64,{data}"},
+    }
+
+
+def image_file_part(file_id: str) -> dict:
+    """Картинка, загруженная в OpenAI с purpose=vision (Assistants API)"""
+    return {"type": "image_file", "image_file": {"file_id": file_id}}
+
+
+def choose_photo_size(
+        sizes: list[PhotoSize],
+        max_pixels: int = PHOTO_MAX_PIXELS) -> PhotoSize:
+    """Наименьший из вариантов Telegram, которого хватает на бюджет"""
+    sizes = sorted(sizes, key=lambda size: size.width * size.height)
+    for size in sizes:
+        if size.width * size.height >= max_pixels:
+            return size
+    return sizes[-1]
+
+
+def crop_borders(image: Image.Image) -> Image.Image:
+    """Обрезает однотонные поля цвета левого верхнего угла"""
+    background = Image.new(image.mode, image.size, image.getpixel((0, 0)))
+    diff = ImageChops.difference(image, background).convert('L')
+    bbox = diff.point(lambda value: 255 if value > BORDER_THRESHOLD else 0)\
+        .getbbox()
+    if not bbox:
+        return image
+    width, height = bbox[2] - bbox[0], bbox[3] - bbox[1]
+    # Почти пустой кадр — скорее ошибка порога, чем поля
+    if width * height < image.width * image.height * 0.1:
+        return image
+    return image.crop(bbox)
+
+
+def is_colourless(image: Image.Image) -> bool:
+    sample = image.copy()
+    sample.thumbnail((128, 128))
+    saturation = sample.convert('HSV').getchannel('S')
+    return ImageStat.Stat(saturation).mean[0] < GRAYSCALE_SATURATION
+
+
+def preprocess_photo(
+        buffer: io.BytesIO,
+        max_pixels: int = PHOTO_MAX_PIXELS,
+        quality: int = PHOTO_JPEG_QUALITY) -> bytes:
+    """
+    Готовит фото к vision-запросу: поворот по EXIF, обрезка полей,
+    серое для бесцветных снимков, уменьшение до max_pixels и JPEG.
+    """
+    with Image.open(buffer) as source:
+        image = ImageOps.exif_transpose(source).convert('RGB')
+    image = crop_borders(image)
+    if is_colourless(image):
+        image = image.convert('L')
+    pixels = image.width * image.height
+    if pixels > max_pixels:
+        scale = (max_pixels / pixels) ** 0.5
+        image = image.resize(
+            (max(1, int(image.width * scale)), max(1, int(image.height * scale))),
+            Image.Resampling.LANCZOS,
+        )
+    output = io.BytesIO()
+    image.save(output, format='JPEG', quality=quality, optimize=True)
+    return output.getvalue()
+
+
+def upload_photo(jpeg: bytes) -> str:
+    """Загружает фото в OpenAI для Assistants API, возвращает file_id"""
+    uploaded = client.files.create(file=('photo.jpg', jpeg), purpose='vision')
+    return uploaded.id
+
+
+def uploaded_file_ids(content: typing.Any) -> list[str]:
+    """Фото сообщения, загруженные в OpenAI через upload_photo"""
+    if isinstance(content, str):
+        return []
+    return [
+        part['image_file']['file_id'] for part in content
+        if part.get('type') == 'image_file'
+    ]
+
+
+def delete_uploaded_files(file_ids: list[str]) -> None:
+    """
+    Удаляет фото из хранилища OpenAI, когда на них больше не сошлётся
+    ни один запуск, иначе хранилище растёт с каждым присланным фото.
+    """
+    for file_id in file_ids:
+        try:
+            client.files.delete(file_id)
+        except Exception as e:
+            logging.warning("Не удалось удалить файл %s: %s", file_id, e)
@@ -0,0 +1,183 @@
+import atexit
+import json
+import logging
+import queue
+import threading
+import time
+from typing import Callable
+
+
+FALLBACK_FILE = 'unsaved_messages.jsonl'
+
+_STOP = object()
+
+
+class MessageWriter:
+    """
+    Отложенная пакетная запись сообщений в БД.
+
+    Обработчики кладут строки в ограниченную очередь и сразу продолжают
+    работу, фоновый поток пишет их пачками по batch_size строк или раз
+    в flush_interval секунд. Если БД не успевает и очередь заполнена,
+    put() ждёт (backpressure), а после put_timeout пишет строку сам.
+    Пачка, которую не удалось записать за max_attempts попыток, делится
+    пополам, пока не останется строка, которую БД не принимает: она
+    уходит в FALLBACK_FILE, а очередь пишется дальше. При остановке
+    оставшиеся строки дописываются так же.
+    """
+
+    def __init__(
+            self,
+            write_rows: Callable[[list[tuple]], None],
+            batch_size: int = 100,
+            flush_interval: float = 1.0,
+            max_pending: int = 10000,
+            put_timeout: float = 5.0,
+            max_retry_delay: float = 30.0,
+            max_attempts: int = 4,
+    ) -> None:
+        self._write_rows = write_rows
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.max_retry_delay = max_retry_delay
+        self.max_attempts = max_attempts
+        self._queue: queue.Queue = queue.Queue(maxsize=max_pending)
+        self._thread: threading.Thread | None = None
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(
+                target=self._run, name='message-writer', daemon=True,
+            )
+            self._thread.start()
+        atexit.register(self.stop)
+
+    def put(self, row: tuple) -> None:
+        if self._thread is None or not self._thread.is_alive():
+            self.start()
+        try:
+            self._queue.put(row, timeout=self.put_timeout)
+        except queue.Full:
+            logging.warning('Очередь записи сообщений переполнена')
+            self._write_now(row)
+
+    def flush(self, timeout: float | None = None) -> bool:
+        """
+        Ждёт, пока будут записаны все строки, поставленные до вызова.
+        timeout ограничивает и ожидание места в очереди.
+        """
+        if self._thread is None or not self._thread.is_alive():
+            return True
+        deadline = None if timeout is None else time.monotonic() + timeout
+        done = threading.Event()
+        try:
+            self._queue.put(done, timeout=timeout)
+        except queue.Full:
+            return False
+        if deadline is not None:
+            timeout = max(0.0, deadline - time.monotonic())
+        return done.wait(timeout)
+
+    def stop(self, timeout: float = 30.0) -> None:
+        with self._lock:
+            thread = self._thread
+            if thread is None or not thread.is_alive():
+                return
+        self._queue.put(_STOP)
+        thread.join(timeout)
+
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def _run(self) -> None:
+        batch: list[tuple] = []
+        deadline = time.monotonic() + self.flush_interval
+        while True:
+            try:
+                item = self._queue.get(
+                    timeout=max(0.0, deadline - time.monotonic()),
+                )
+            except queue.Empty:
+                item = None
+
+            if isinstance(item, tuple):
+                batch.append(item)
+                if len(batch) < self.batch_size:
+                    continue
+            elif item is not None and item is not _STOP:
+                self._write(batch)
+                batch = []
+                item.set()
+                continue
+
+            self._write(batch)
+            batch = []
+            deadline = time.monotonic() + self.flush_interval
+            if item is _STOP:
+                self._drain()
+                return
+
+    def _drain(self) -> None:
+        rows = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if isinstance(item, tuple):
+                rows.append(item)
+            elif item is not _STOP:
+                item.set()
+        self._write(rows)
+
+    def _write(self, rows: list[tuple], attempts: int | None = None) -> None:
+        if not rows:
+            return
+        if attempts is None:
+            attempts = self.max_attempts
+        delay = 0.5
+        for attempt in range(1, attempts + 1):
+            try:
+                self._write_rows(rows)
+                return
+            except Exception as e:
+                logging.error(
+                    'Ошибка пакетной записи %s сообщений: %s', len(rows), e,
+                )
+                if attempt < attempts:
+                    time.sleep(delay)
+                    delay = min(delay * 2, self.max_retry_delay)
+        if len(rows) > 1:
+            # Половины пробуем по разу: ищем строку, которую БД не принимает
+            middle = len(rows) // 2
+            self._write(rows[:middle], attempts=1)
+            self._write(rows[middle:], attempts=1)
+            return
+        self._save_fallback(rows)
+
+    def _write_now(self, row: tuple, attempts: int = 3) -> None:
+        """Запись в обход очереди; при недоступной БД строка уходит в файл"""
+        delay = 0.5
+        for _ in range(attempts):
+            try:
+                self._write_rows([row])
+                return
+            except Exception as e:
+                logging.exception('Ошибка записи сообщения: %s', e)
+                time.sleep(delay)
+                delay *= 2
+        self._save_fallback([row])
+
+    @staticmethod
+    def _save_fallback(rows: list[tuple]) -> None:
+        with open(FALLBACK_FILE, 'a', encoding='utf-8') as file:
+            for row in rows:
+                file.write(json.dumps(row, ensure_ascii=False) + '\n')
+        logging.error(
+            'Не удалось записать %s сообщений, они сохранены в %s',
+            len(rows), FALLBACK_FILE,
+        )
@@ -0,0 +1,326 @@
+"""
+Версионированные миграции схемы БД.
+
+Каждая миграция применяется один раз и записывается в schema_migrations.
+Миграции с transactional=False выполняются вне транзакции — это нужно
+для CREATE INDEX CONCURRENTLY, который не блокирует запись в таблицу.
+Новые миграции добавляются только в конец списка MIGRATIONS.
+"""
+import logging
+from typing import Callable, NamedTuple, Union
+
+from psycopg2.extensions import connection as Connection
+from psycopg2.extensions import cursor as Cursor
+
+from partitions import (prepare_partitioned_messages, copy_messages,
+                        swap_messages,
+                        )
+
+
+MIGRATIONS_LOCK_ID = 7_201_504
+
+Step = Union[str, Callable[[Cursor], None]]
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    steps: list[Step]
+    transactional: bool = True
+
+
+def create_index_concurrently(name: str, definition: str) -> Callable:
+    """
+    Шаг миграции: CREATE INDEX CONCURRENTLY без блокировки таблицы.
+    Невалидный индекс от прерванной прошлой попытки пересоздаётся.
+    """
+    def step(cursor: Cursor) -> None:
+        cursor.execute('''
+            SELECT i.indisvalid
+            FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid
+            WHERE c.relname = %s
+        ''', (name,))
+        row = cursor.fetchone()
+        if row and not row[0]:
+            cursor.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
+        cursor.execute(
+            f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {definition}'
+        )
+    return step
+
+
+def attach_partition_indexes(
+        table: str, index: str, definition: str) -> Callable:
+    """
+    Шаг миграции: для каждой партиции table строит индекс definition
+    через CREATE INDEX CONCURRENTLY и присоединяет к индексу родителя
+    index, созданному с ON ONLY. Когда присоединены все, индекс
+    родителя становится валидным; новые партиции получают его сами.
+    """
+    def step(cursor: Cursor) -> None:
+        cursor.execute('''
+            SELECT c.relname FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = %s::regclass
+        ''', (table,))
+        for (partition,) in cursor.fetchall():
+            # Партиции, созданные после индекса родителя, уже с индексом
+            cursor.execute('''
+                SELECT 1 FROM pg_inherits i
+                JOIN pg_index x ON x.indexrelid = i.inhrelid
+                WHERE i.inhparent = %s::regclass
+                  AND x.indrelid = %s::regclass
+            ''', (index, partition))
+            if cursor.fetchone():
+                continue
+            name = f'{partition}_{index.removeprefix(table + "_")}'
+            create_index_concurrently(name, f'{partition} {definition}')(
+                cursor,
+            )
+            cursor.execute(f'ALTER INDEX {index} ATTACH PARTITION {name}')
+    return step
+
+
+MIGRATIONS = [
+    Migration(1, 'initial tables', [
+        '''CREATE TABLE IF NOT EXISTS messages (
+    id SERIAL PRIMARY KEY,
+    user_id BIGINT NOT NULL,
+    thread_id TEXT NOT NULL,
+    role TEXT NOT NULL CHECK (role IN ('user', 'assistant')),
+    content TEXT NOT NULL,
+    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+)''',
+        '''
+                       CREATE TABLE IF NOT EXISTS users (
+                           id SERIAL PRIMARY KEY,
+                           user_telegram_id BIGINT UNIQUE,
+                           telegram_username TEXT,
+                           balance INTEGER DEFAULT 0,
+                           is_active BOOLEAN DEFAULT FALSE
+                       )
+        ''',
+    ]),
+    Migration(2, 'users.thread_id', [
+        'ALTER TABLE users ADD COLUMN IF NOT EXISTS thread_id TEXT',
+        '''
+                       UPDATE users u SET thread_id = m.thread_id
+                       FROM (
+                           SELECT DISTINCT ON (user_id) user_id, thread_id
+                           FROM messages
+                           ORDER BY user_id, id DESC
+                       ) m
+                       WHERE u.user_telegram_id = m.user_id
+                         AND u.thread_id IS NULL
+        ''',
+    ]),
+    Migration(3, 'index messages(user_id, timestamp)', [
+        create_index_concurrently(
+            'messages_user_id_timestamp_idx',
+            'messages (user_id, timestamp)',
+        ),
+    ], transactional=False),
+    Migration(4, 'index messages(timestamp, id)', [
+        create_index_concurrently(
+            'messages_timestamp_id_idx', 'messages (timestamp, id)',
+        ),
+    ], transactional=False),
+    Migration(5, 'index users(is_active)', [
+        create_index_concurrently(
+            'users_is_active_idx', 'users (is_active)',
+        ),
+    ], transactional=False),
+    Migration(6, 'broadcast jobs', [
+        '''
+                       CREATE TABLE IF NOT EXISTS broadcast_jobs (
+                           id SERIAL PRIMARY KEY,
+                           admin_chat_id BIGINT NOT NULL,
+                           text TEXT NOT NULL,
+                           status TEXT NOT NULL DEFAULT 'draft' CHECK (
+                               status IN ('draft', 'running', 'done')
+                           ),
+                           progress_message_id BIGINT,
+                           created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                           finished_at TIMESTAMP
+                       )
+        ''',
+        '''
+                       CREATE TABLE IF NOT EXISTS broadcast_recipients (
+                           job_id INTEGER NOT NULL
+                               REFERENCES broadcast_jobs (id) ON DELETE CASCADE,
+                           chat_id BIGINT NOT NULL,
+                           status TEXT NOT NULL DEFAULT 'pending' CHECK (
+                               status IN ('pending', 'sent', 'blocked', 'failed')
+                           ),
+                           error TEXT,
+                           PRIMARY KEY (job_id, chat_id)
+                       )
+        ''',
+        '''
+                       CREATE INDEX IF NOT EXISTS broadcast_recipients_status_idx
+                       ON broadcast_recipients (job_id, status)
+        ''',
+    ]),
+    Migration(7, 'answer cache', [
+        '''
+                       CREATE TABLE IF NOT EXISTS answer_cache (
+                           id SERIAL PRIMARY KEY,
+                           namespace TEXT NOT NULL,
+                           question_key TEXT NOT NULL,
+                           question TEXT NOT NULL,
+                           answer TEXT NOT NULL,
+                           hits INTEGER NOT NULL DEFAULT 0,
+                           created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                           last_used_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                           UNIQUE (namespace, question_key)
+                       )
+        ''',
+        '''
+                       CREATE INDEX IF NOT EXISTS answer_cache_last_used_idx
+                       ON answer_cache (namespace, last_used_at)
+        ''',
+    ]),
+    Migration(8, 'image cache', [
+        '''
+                       CREATE TABLE IF NOT EXISTS image_cache (
+                           prompt_key TEXT PRIMARY KEY,
+                           prompt TEXT NOT NULL,
+                           file_id TEXT NOT NULL,
+                           hits INTEGER NOT NULL DEFAULT 0,
+                           created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                           last_used_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                       )
+        ''',
+    ]),
+    Migration(9, 'state store', [
+        '''
+                       CREATE TABLE IF NOT EXISTS state_store (
+                           key TEXT PRIMARY KEY,
+                           value JSONB NOT NULL,
+                           expires_at TIMESTAMP NOT NULL
+                       )
+        ''',
+        '''
+                       CREATE INDEX IF NOT EXISTS state_store_expires_at_idx
+                       ON state_store (expires_at)
+        ''',
+    ]),
+    Migration(10, 'partition messages by month', [
+        prepare_partitioned_messages,
+        copy_messages,
+        swap_messages,
+        'ANALYZE messages',
+    ], transactional=False),
+    Migration(11, 'full-text search on messages', [
+        # У секционированной таблицы нет CONCURRENTLY: индекс родителя
+        # создаётся пустым, а индексы партиций строятся без блокировки
+        # записи и присоединяются к нему
+        '''
+                       CREATE INDEX IF NOT EXISTS messages_content_tsv_idx
+                       ON ONLY messages
+                       USING GIN (to_tsvector('russian', content))
+        ''',
+        attach_partition_indexes(
+            'messages', 'messages_content_tsv_idx',
+            "USING GIN (to_tsvector('russian', content))",
+        ),
+    ], transactional=False),
+    Migration(12, 'broadcast recipient claims', [
+        'ALTER TABLE broadcast_recipients ADD COLUMN IF NOT EXISTS '
+        'claimed_at TIMESTAMP',
+        '''
+                       ALTER TABLE broadcast_recipients
+                       DROP CONSTRAINT IF EXISTS broadcast_recipients_status_check,
+                       ADD CONSTRAINT broadcast_recipients_status_check CHECK (
+                           status IN (
+                               'pending', 'sending', 'sent', 'blocked', 'failed'
+                           )
+                       ) NOT VALID
+        ''',
+        '''
+                       ALTER TABLE broadcast_recipients
+                       VALIDATE CONSTRAINT broadcast_recipients_status_check
+        ''',
+    ]),
+    Migration(13, 'thread files', [
+        '''
+                       CREATE TABLE IF NOT EXISTS thread_files (
+                           file_id TEXT PRIMARY KEY,
+                           user_id BIGINT NOT NULL,
+                           thread_id TEXT NOT NULL,
+                           created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                       )
+        ''',
+        '''
+                       CREATE INDEX IF NOT EXISTS thread_files_user_id_idx
+                       ON thread_files (user_id, thread_id)
+        ''',
+    ]),
+]
+
+
+def _run_step(cursor: Cursor, step: Step) -> None:
+    if callable(step):
+        step(cursor)
+    else:
+        cursor.execute(step)
+
+
+def apply_migrations(connect: Callable[[], Connection]) -> None:
+    """Применяет все ещё не применённые миграции по порядку"""
+    conn = connect()
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                'SELECT pg_advisory_lock(%s)', (MIGRATIONS_LOCK_ID,)
+            )
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INTEGER PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            cursor.execute('SELECT version FROM schema_migrations')
+            applied = {row[0] for row in cursor.fetchall()}
+
+            for migration in sorted(MIGRATIONS, key=lambda m: m.version):
+                if migration.version in applied:
+                    continue
+                logging.info(
+                    'Применяем миграцию %s: %s',
+                    migration.version, migration.name,
+                )
+                if migration.transactional:
+                    cursor.execute('BEGIN')
+                try:
+                    for step in migration.steps:
+                        _run_step(cursor, step)
+                    cursor.execute(
+                        'INSERT INTO schema_migrations (version, name) '
+                        'VALUES (%s, %s)',
+                        (migration.version, migration.name),
+                    )
+                except Exception:
+                    if migration.transactional:
+                        cursor.execute('ROLLBACK')
+                    logging.exception(
+                        'Миграция %s не применена', migration.version,
+                    )
+                    raise
+                if migration.transactional:
+                    cursor.execute('COMMIT')
+
+            cursor.execute(
+                'SELECT pg_advisory_unlock(%s)', (MIGRATIONS_LOCK_ID,)
+            )
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    from database import create_connection
+
+    logging.basicConfig(level=logging.INFO)
+    apply_migrations(create_connection)
@@ -6,3 +6,8 @@ client = openai.OpenAI(
     api_key=OPENAI_API_KEY,
     base_url="https://api.proxyapi.ru/openai/v1",
 )
+
+async_client = openai.AsyncOpenAI(
+    api_key=OPENAI_API_KEY,
+    base_url="https://api.proxyapi.ru/openai/v1",
+)
@@ -0,0 +1,247 @@
+"""
+Помесячные партиции таблицы messages.
+
+messages разбита по timestamp на партиции messages_ГГГГ_ММ, плюс
+messages_default для строк вне созданных месяцев. Партиции создаются
+заранее на PARTITION_PREMAKE месяцев вперёд, а старые выгружает в
+архив и удаляет archive.py. Запросы с условием или сортировкой по
+timestamp читают только нужные месяцы.
+
+Перевод старой таблицы на партиции (миграция 10) не блокирует запись:
+новая таблица строится рядом, триггер дублирует в неё изменения, старые
+строки переносятся пачками, а в конце таблицы меняются местами в одной
+короткой транзакции.
+"""
+import datetime
+import logging
+import re
+import time
+
+from psycopg2 import errors
+from psycopg2.extensions import cursor as Cursor
+
+
+PARTITION_PREMAKE = 2
+# Сколько строк переносить из старой таблицы одной транзакцией
+COPY_BATCH_SIZE = 10_000
+# Сколько ждать блокировку messages, пока её держат долгие запросы, и
+# сколько раз пробовать снова
+SWAP_LOCK_TIMEOUT = '5s'
+SWAP_ATTEMPTS = 30
+PARTITION_NAME = re.compile(r'^messages_(\d{4})_(\d{2})$')
+
+
+def add_months(month: datetime.date, count: int) -> datetime.date:
+    index = month.year * 12 + month.month - 1 + count
+    return datetime.date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month: datetime.date) -> str:
+    return f'messages_{month.year:04d}_{month.month:02d}'
+
+
+def current_month(cursor: Cursor) -> datetime.date:
+    """Месяц по часам БД: timestamp в messages пишет сервер"""
+    cursor.execute("SELECT date_trunc('month', LOCALTIMESTAMP)::date")
+    return cursor.fetchone()[0]
+
+
+def list_partitions(
+        cursor: Cursor, parent: str = 'messages') -> dict[datetime.date, str]:
+    """Помесячные партиции parent: {первое число месяца: имя}"""
+    cursor.execute('''
+        SELECT c.relname FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = %s::regclass
+    ''', (parent,))
+    partitions = {}
+    for (name,) in cursor.fetchall():
+        match = PARTITION_NAME.match(name)
+        if match:
+            year, month = map(int, match.groups())
+            partitions[datetime.date(year, month, 1)] = name
+    return partitions
+
+
+def create_partitions(
+        cursor: Cursor, first: datetime.date, last: datetime.date,
+        parent: str = 'messages') -> None:
+    """Создаёт недостающие партиции с месяца first по last включительно"""
+    existing = list_partitions(cursor, parent)
+    month = first
+    while month <= last:
+        if month not in existing:
+            cursor.execute(f'''
+                CREATE TABLE IF NOT EXISTS {partition_name(month)}
+                PARTITION OF {parent}
+                FOR VALUES FROM (%s) TO (%s)
+            ''', (month, add_months(month, 1)))
+        month = add_months(month, 1)
+
+
+def ensure_partitions(cursor: Cursor) -> None:
+    month = current_month(cursor)
+    create_partitions(cursor, month, add_months(month, PARTITION_PREMAKE))
+
+
+def is_partitioned(cursor: Cursor) -> bool:
+    cursor.execute(
+        "SELECT relkind FROM pg_class WHERE oid = 'messages'::regclass"
+    )
+    return cursor.fetchone()[0] == 'p'
+
+
+def short_transaction(cursor: Cursor, step) -> None:
+    """
+    Выполняет step(cursor) в транзакции с lock_timeout. Если messages
+    держат долгие запросы, не копит за собой очередь, а откатывается и
+    пробует снова.
+    """
+    for attempt in range(1, SWAP_ATTEMPTS + 1):
+        cursor.execute('BEGIN')
+        try:
+            cursor.execute(f"SET LOCAL lock_timeout = '{SWAP_LOCK_TIMEOUT}'")
+            step(cursor)
+        except errors.LockNotAvailable:
+            cursor.execute('ROLLBACK')
+            logging.warning(
+                "messages занята, попытка %s из %s", attempt, SWAP_ATTEMPTS,
+            )
+            time.sleep(1)
+            continue
+        except Exception:
+            cursor.execute('ROLLBACK')
+            raise
+        cursor.execute('COMMIT')
+        return
+    raise RuntimeError('Не удалось заблокировать messages')
+
+
+def _create_partitioned_copy(cursor: Cursor) -> None:
+    cursor.execute("SELECT pg_get_serial_sequence('messages', 'id')")
+    sequence = cursor.fetchone()[0]
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS messages_partitioned (
+            id BIGINT NOT NULL DEFAULT nextval('{sequence}'),
+            user_id BIGINT NOT NULL,
+            thread_id TEXT NOT NULL,
+            role TEXT NOT NULL CHECK (role IN ('user', 'assistant')),
+            content TEXT NOT NULL,
+            timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (id, timestamp)
+        ) PARTITION BY RANGE (timestamp)
+    ''')
+    cursor.execute(
+        'CREATE TABLE IF NOT EXISTS messages_default '
+        'PARTITION OF messages_partitioned DEFAULT'
+    )
+    month = current_month(cursor)
+    cursor.execute(
+        "SELECT date_trunc('month', min(timestamp))::date FROM messages"
+    )
+    first = cursor.fetchone()[0] or month
+    create_partitions(
+        cursor, first, add_months(month, PARTITION_PREMAKE),
+        'messages_partitioned',
+    )
+    cursor.execute(
+        'CREATE INDEX IF NOT EXISTS messages_partitioned_user_id_timestamp_idx '
+        'ON messages_partitioned (user_id, timestamp)'
+    )
+    cursor.execute(
+        'CREATE INDEX IF NOT EXISTS messages_partitioned_timestamp_id_idx '
+        'ON messages_partitioned (timestamp, id)'
+    )
+    # Пока строки переносятся, новые записи, правки и удаления в messages
+    # сразу повторяются в новой таблице
+    cursor.execute('''
+        CREATE OR REPLACE FUNCTION messages_mirror() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                DELETE FROM messages_partitioned WHERE id = OLD.id;
+            END IF;
+            IF TG_OP = 'DELETE' THEN
+                RETURN OLD;
+            END IF;
+            INSERT INTO messages_partitioned
+                (id, user_id, thread_id, role, content, timestamp)
+            VALUES (NEW.id, NEW.user_id, NEW.thread_id, NEW.role,
+                    NEW.content, COALESCE(NEW.timestamp, LOCALTIMESTAMP))
+            ON CONFLICT DO NOTHING;
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+    ''')
+    cursor.execute('DROP TRIGGER IF EXISTS messages_mirror ON messages')
+    cursor.execute('''
+        CREATE TRIGGER messages_mirror
+        AFTER INSERT OR UPDATE OR DELETE ON messages
+        FOR EACH ROW EXECUTE FUNCTION messages_mirror()
+    ''')
+
+
+def prepare_partitioned_messages(cursor: Cursor) -> None:
+    """Шаг миграции: секционированная messages_partitioned рядом с messages"""
+    if not is_partitioned(cursor):
+        short_transaction(cursor, _create_partitioned_copy)
+
+
+def copy_messages(cursor: Cursor) -> None:
+    """
+    Шаг миграции: переносит старые строки пачками по COPY_BATCH_SIZE,
+    каждая пачка — своя короткая транзакция. Строки, записанные после
+    создания триггера, уже перенесены им, а после сбоя уже перенесённые
+    пропускаются. FOR SHARE не даёт удалить строку, пока её пачка не
+    закоммичена: иначе удаление из новой таблицы прошло бы раньше
+    вставки.
+    """
+    if is_partitioned(cursor):
+        return
+    cursor.execute('SELECT max(id) FROM messages')
+    last = cursor.fetchone()[0] or 0
+    copied = 0
+    while copied < last:
+        upto = min(copied + COPY_BATCH_SIZE, last)
+        cursor.execute('''
+            WITH batch AS (
+                SELECT id, user_id, thread_id, role, content,
+                       COALESCE(timestamp, LOCALTIMESTAMP)
+                FROM messages WHERE id > %s AND id <= %s
+                FOR SHARE
+            )
+            INSERT INTO messages_partitioned
+                (id, user_id, thread_id, role, content, timestamp)
+            SELECT * FROM batch
+            ON CONFLICT DO NOTHING
+        ''', (copied, upto))
+        copied = upto
+        logging.info("Перенесено сообщений до id %s из %s", copied, last)
+
+
+def _swap_messages(cursor: Cursor) -> None:
+    cursor.execute('LOCK TABLE messages IN ACCESS EXCLUSIVE MODE')
+    cursor.execute("SELECT pg_get_serial_sequence('messages', 'id')")
+    sequence = cursor.fetchone()[0]
+    cursor.execute(f'ALTER SEQUENCE {sequence} OWNED BY NONE')
+    cursor.execute('DROP TABLE messages')
+    cursor.execute('DROP FUNCTION messages_mirror()')
+    cursor.execute('ALTER TABLE messages_partitioned RENAME TO messages')
+    for old, new in (
+            ('messages_partitioned_pkey', 'messages_pkey'),
+            ('messages_partitioned_user_id_timestamp_idx',
+             'messages_user_id_timestamp_idx'),
+            ('messages_partitioned_timestamp_id_idx',
+             'messages_timestamp_id_idx'),
+    ):
+        cursor.execute(f'ALTER INDEX {old} RENAME TO {new}')
+    cursor.execute(f'ALTER SEQUENCE {sequence} AS BIGINT OWNED BY messages.id')
+
+
+def swap_messages(cursor: Cursor) -> None:
+    """
+    Шаг миграции: ставит секционированную таблицу на место messages.
+    Все строки уже перенесены, поэтому запись стоит только на время
+    переименования.
+    """
+    if not is_partitioned(cursor):
+        short_transaction(cursor, _swap_messages)
@@ -0,0 +1,408 @@
+"""
+Запуски ассистента (Assistants API) без ожидания в рабочих потоках.
+
+Раньше каждый запуск держал поток пула: он спал между опросами статуса
+и при rate limit, а запуск в статусе expired или requires_action
+опрашивался вечно. Теперь все активные запуски ведёт RunManager:
+один поток-планировщик по таймерам решает, какой запуск пора создать
+или опросить, а сами запросы к OpenAI выполняет небольшой пул.
+
+Интервал опроса растёт от RUN_POLL_MIN до RUN_POLL_MAX, пока запуск
+идёт. У каждого запуска есть срок RUN_TIMEOUT: по его истечении (или
+по cancel) запуск отменяется в OpenAI и ещё RUN_CANCEL_GRACE секунд
+опрашивается, чтобы поток освободился для следующего запуска. Итог
+приходит в callback, который выполняется в переданном executor.
+
+Потоковые ответы (stream) читает свой пул на stream_workers потоков,
+чтобы долгие ответы не занимали ни executor обработчиков, ни пул
+опроса. Срок, отмену и повтор при rate limit им тоже обеспечивает
+планировщик: поток ответа по сроку закрывается, а запуск Assistants
+API отменяется как обычный. Когда поток дочитан, его таймер срока
+убирается из очереди.
+"""
+import heapq
+import itertools
+import logging
+import threading
+import time
+import typing
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+
+import openai
+from openai import OpenAI
+from openai.types.beta.threads import Run
+
+from const import RUN_TIMEOUT, RUN_POLL_WORKERS, RUN_STREAM_WORKERS
+
+
+RUN_FINAL_STATUSES = (
+    "completed", "failed", "cancelled", "expired",
+    "incomplete", "requires_action",
+)
+RUN_POLL_MIN = 0.5
+RUN_POLL_MAX = 5.0
+RUN_POLL_BACKOFF = 1.5
+RUN_CANCEL_GRACE = 30.0
+RUN_CREATE_RETRIES = 3
+RATE_LIMIT_DELAY = 5.0
+
+Callback = typing.Callable[[typing.Optional[Run]], typing.Any]
+# Для потоковых ответов: итоговый Run (если есть) и дочитан ли поток
+StreamCallback = typing.Callable[[typing.Optional[Run], bool], typing.Any]
+# (когда, порядок, запуск, действие)
+Timer = tuple[float, int, 'RunTask', typing.Callable[['RunTask'], None]]
+
+
+class StreamSource(typing.Protocol):
+    """Откуда читать потоковый ответ"""
+
+    def open(self) -> typing.ContextManager[typing.Any]:
+        """Открывает поток; вызывается заново при повторе"""
+
+    def deltas(self, stream: typing.Any) -> typing.Iterable[str]:
+        """Куски текста ответа"""
+
+    def run(self, stream: typing.Any) -> typing.Optional[Run]:
+        """Текущий запуск Assistants API или None"""
+
+
+class AssistantStream:
+    """Потоковый запуск ассистента (runs.stream)"""
+
+    def __init__(
+            self, client: OpenAI, thread_id: str, assistant_id: str,
+            params: dict[str, typing.Any]) -> None:
+        self.client = client
+        self.thread_id = thread_id
+        self.assistant_id = assistant_id
+        self.params = params
+
+    def open(self) -> typing.ContextManager[typing.Any]:
+        return self.client.beta.threads.runs.stream(
+            thread_id=self.thread_id, assistant_id=self.assistant_id,
+            **self.params,
+        )
+
+    def deltas(self, stream: typing.Any) -> typing.Iterable[str]:
+        return stream.text_deltas
+
+    def run(self, stream: typing.Any) -> typing.Optional[Run]:
+        return stream.current_run
+
+
+class RunTask:
+    """Состояние одного запуска в планировщике"""
+
+    def __init__(
+            self, thread_id: str, assistant_id: str,
+            callback: Callback, deadline: float,
+            params: dict[str, typing.Any]) -> None:
+        self.thread_id = thread_id
+        self.assistant_id = assistant_id
+        self.params = params
+        self.callback = callback
+        self.deadline = deadline
+        self.run: Run | None = None
+        self.attempt = 0
+        self.interval = RUN_POLL_MIN
+        self.cancel_requested = False
+        self.cancelling = False
+        self.future: Future = Future()
+        # Только у потоковых ответов
+        self.source: StreamSource | None = None
+        self.on_delta: typing.Callable[[str], None] | None = None
+        self.stream: typing.Any = None
+        self.expiry: Timer | None = None
+        self.streamed = False
+        self.completed = False
+        # Поток дочитан или оборван: итог подводит кто-то один
+        self.closed = False
+
+
+class RunManager:
+
+    def __init__(
+            self,
+            client: OpenAI,
+            callback_executor: Executor,
+            workers: int = RUN_POLL_WORKERS,
+            timeout: float = RUN_TIMEOUT,
+            stream_workers: int = RUN_STREAM_WORKERS) -> None:
+        self.client = client
+        self.callback_executor = callback_executor
+        self.timeout = timeout
+        self._io = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='run-poll',
+        )
+        self._streams = ThreadPoolExecutor(
+            max_workers=stream_workers, thread_name_prefix='run-stream',
+        )
+        self._timers: list[Timer] = []
+        self._order = itertools.count()
+        self._tasks: dict[str, RunTask] = {}
+        self._condition = threading.Condition()
+        self._scheduler = threading.Thread(
+            target=self._schedule, name='run-scheduler', daemon=True,
+        )
+        self._scheduler.start()
+
+    def submit(
+            self, thread_id: str, assistant_id: str,
+            callback: Callback, **params: typing.Any) -> Future:
+        """
+        Создаёт запуск в потоке thread_id с параметрами params для
+        runs.create. callback получит итоговый Run (или None, если
+        запуск не удалось создать); Future завершится его результатом.
+        """
+        task = RunTask(
+            thread_id, assistant_id, callback,
+            time.monotonic() + self.timeout, params,
+        )
+        with self._condition:
+            self._tasks[thread_id] = task
+        self._after(0, task)
+        return task.future
+
+    def stream(
+            self, thread_id: str, source: StreamSource,
+            on_delta: typing.Callable[[str], None],
+            callback: StreamCallback) -> Future:
+        """
+        Читает потоковый ответ из source, отдавая куски в on_delta.
+        callback получит итоговый Run (для AssistantStream) и признак
+        того, что поток дочитан до конца, а не оборван.
+        """
+        task = RunTask(
+            thread_id, '', callback, time.monotonic() + self.timeout, {},
+        )
+        task.source = source
+        task.on_delta = on_delta
+        with self._condition:
+            self._tasks[thread_id] = task
+        task.expiry = self._after(self.timeout, task, self._expire_stream)
+        self._streams.submit(self._stream, task)
+        return task.future
+
+    def cancel(self, thread_id: str) -> bool:
+        """Отмена срабатывает на ближайшем опросе запуска"""
+        with self._condition:
+            task = self._tasks.get(thread_id)
+        if task is None:
+            return False
+        task.cancel_requested = True
+        if task.source is not None:
+            self._after(0, task, self._expire_stream)
+        return True
+
+    def stats(self) -> dict[str, int]:
+        with self._condition:
+            return {'active': len(self._tasks), 'timers': len(self._timers)}
+
+    def _after(
+            self, delay: float, task: RunTask,
+            action: typing.Callable[[RunTask], None] | None = None) -> Timer:
+        """Через delay секунд выполнит action (по умолчанию _step) в пуле"""
+        timer = (
+            time.monotonic() + delay, next(self._order), task,
+            action or self._step,
+        )
+        with self._condition:
+            heapq.heappush(self._timers, timer)
+            self._condition.notify()
+        return timer
+
+    def _discard(self, timer: Timer | None) -> None:
+        """Убирает ещё не сработавший таймер"""
+        with self._condition:
+            try:
+                self._timers.remove(timer)
+            except ValueError:
+                return
+            heapq.heapify(self._timers)
+
+    def _schedule(self) -> None:
+        while True:
+            with self._condition:
+                while True:
+                    now = time.monotonic()
+                    if self._timers and self._timers[0][0] <= now:
+                        break
+                    self._condition.wait(
+                        self._timers[0][0] - now if self._timers else None
+                    )
+                _, _, task, action = heapq.heappop(self._timers)
+            self._io.submit(action, task)
+
+    def _step(self, task: RunTask) -> None:
+        try:
+            if task.run is None:
+                self._create(task)
+            else:
+                self._poll(task)
+        except Exception as e:
+            logging.exception(
+                "Ошибка ведения запуска в %s: %s", task.thread_id, e,
+            )
+            self._finish(task)
+
+    def _stream(self, task: RunTask) -> None:
+        """Читает поток ответа; выполняется в пуле потоковых ответов"""
+        try:
+            with task.source.open() as stream:
+                with self._condition:
+                    if task.closed:
+                        return
+                    task.stream = stream
+                for delta in task.source.deltas(stream):
+                    if task.closed:
+                        return
+                    task.streamed = True
+                    task.on_delta(delta)
+                task.run = task.source.run(stream)
+                task.completed = True
+        except openai.RateLimitError:
+            if not task.streamed and not task.closed:
+                task.attempt += 1
+                if task.attempt < RUN_CREATE_RETRIES:
+                    wait_time = 2 ** (task.attempt - 1) * RATE_LIMIT_DELAY
+                    logging.warning(
+                        "⚠️ Rate limit: повтор через %s сек...", wait_time,
+                    )
+                    with self._condition:
+                        task.stream = None
+                    return self._after(wait_time, task, self._restream)
+                logging.error("❌ Не удалось выполнить запрос после повторов.")
+        except Exception as e:
+            if not task.closed:
+                logging.exception(
+                    "🚨 Ошибка при потоковом ответе OpenAI: %s", e,
+                )
+        with self._condition:
+            if task.closed:
+                # Поток оборвал _expire_stream, итог за ним
+                return
+            task.closed = True
+        self._discard(task.expiry)
+        self._finish(task)
+
+    def _restream(self, task: RunTask) -> None:
+        if task.closed:
+            return
+        if task.cancel_requested:
+            return self._expire_stream(task)
+        self._streams.submit(self._stream, task)
+
+    def _expire_stream(self, task: RunTask) -> None:
+        """Обрывает поток по сроку или cancel и отменяет его запуск"""
+        with self._condition:
+            if task.closed:
+                return
+            task.closed = True
+            stream = task.stream
+        # Если оборвали по cancel, срок уже не нужен
+        self._discard(task.expiry)
+        logging.warning("Обрываем потоковый ответ в %s", task.thread_id)
+        run = None
+        if stream is not None:
+            try:
+                run = task.source.run(stream)
+                stream.close()
+            except Exception as e:
+                logging.warning("Ошибка закрытия потока ответа: %s", e)
+        if run is None or run.status in RUN_FINAL_STATUSES \
+                and run.status != "requires_action":
+            task.run = run
+            return self._finish(task)
+        # Запуск продолжается без нас: отменяем и ждём, пока поток
+        # освободится, как у обычного запуска
+        task.run = run
+        self._cancel(task)
+
+    def _create(self, task: RunTask) -> None:
+        if task.cancel_requested:
+            return self._finish(task)
+        try:
+            task.run = self.client.beta.threads.runs.create(
+                thread_id=task.thread_id, assistant_id=task.assistant_id,
+                **task.params,
+            )
+        except openai.RateLimitError:
+            task.attempt += 1
+            if task.attempt >= RUN_CREATE_RETRIES:
+                logging.error(
+                    "❌ Не удалось выполнить запрос после повторов."
+                )
+                return self._finish(task)
+            wait_time = 2 ** (task.attempt - 1) * RATE_LIMIT_DELAY
+            logging.warning(
+                "⚠️ Rate limit: повтор через %s сек...", wait_time,
+            )
+            return self._after(wait_time, task)
+        except Exception as e:
+            logging.exception("🚨 Ошибка при запросе в OpenAI: %s", e)
+            return self._finish(task)
+        self._after(task.interval, task)
+
+    def _poll(self, task: RunTask) -> None:
+        now = time.monotonic()
+        if task.cancelling and now > task.deadline:
+            logging.error("Запуск %s не отменился вовремя", task.run.id)
+            return self._finish(task)
+        expired = task.cancel_requested or now > task.deadline
+        if expired and not task.cancelling:
+            return self._cancel(task)
+
+        try:
+            task.run = self.client.beta.threads.runs.retrieve(
+                thread_id=task.thread_id, run_id=task.run.id,
+            )
+        except Exception as e:
+            logging.warning("Ошибка опроса запуска %s: %s", task.run.id, e)
+            return self._after(task.interval, task)
+
+        if task.run.status == "requires_action":
+            if not task.cancelling:
+                # Инструментов у ассистента нет: ждать здесь нечего
+                logging.error(
+                    "Запуск %s ждёт вызова инструментов", task.run.id,
+                )
+                return self._cancel(task)
+        elif task.run.status in RUN_FINAL_STATUSES:
+            return self._finish(task)
+        task.interval = min(task.interval * RUN_POLL_BACKOFF, RUN_POLL_MAX)
+        self._after(task.interval, task)
+
+    def _cancel(self, task: RunTask) -> None:
+        logging.warning(
+            "Отменяем запуск %s (статус %s)", task.run.id, task.run.status,
+        )
+        task.cancelling = True
+        task.deadline = time.monotonic() + RUN_CANCEL_GRACE
+        task.interval = RUN_POLL_MIN
+        try:
+            task.run = self.client.beta.threads.runs.cancel(
+                thread_id=task.thread_id, run_id=task.run.id,
+            )
+        except Exception as e:
+            logging.warning("Ошибка отмены запуска %s: %s", task.run.id, e)
+        if task.run.status in RUN_FINAL_STATUSES \
+                and task.run.status != "requires_action":
+            return self._finish(task)
+        self._after(task.interval, task)
+
+    def _finish(self, task: RunTask) -> None:
+        with self._condition:
+            if self._tasks.get(task.thread_id) is task:
+                del self._tasks[task.thread_id]
+        self.callback_executor.submit(self._callback, task)
+
+    def _callback(self, task: RunTask) -> None:
+        try:
+            if task.source is not None:
+                result = task.callback(task.run, task.completed)
+            else:
+                result = task.callback(task.run)
+            task.future.set_result(result)
+        except Exception as e:
+            logging.exception("Ошибка обработки итога запуска: %s", e)
+            task.future.set_exception(e)
@@ -0,0 +1,226 @@
+"""
+Общее состояние диалогов: следующий шаг пользователя, thread_id
+(thread_id — только для memory, в postgres его хранит таблица users).
+
+Пока состояние жило в памяти процесса, бот мог работать только одним
+процессом. Хранилище выбирается STATE_BACKEND:
+
+memory   — в памяти процесса (TTLCache), для одного процесса;
+postgres — таблица state_store, общая для всех процессов бота.
+
+Каждая запись живёт не дольше своего ttl, а число записей ограничено
+max_size: в памяти вытесняются давно не использованные, в Postgres
+периодически удаляются истёкшие и самые старые. Значения должны
+сериализоваться в JSON.
+"""
+import asyncio
+import threading
+import typing
+from abc import ABC, abstractmethod
+
+from psycopg2.extras import Json
+from telebot.asyncio_storage import StateStorageBase, StateDataContext
+
+from cache import TTLCache
+
+
+# Через сколько записей чистить таблицу от истёкших и лишних ключей
+PURGE_EVERY = 1000
+
+
+class StateStore(ABC):
+    """Ключ-значение с временем жизни записей"""
+
+    @abstractmethod
+    def get(self, key: str, default: typing.Any = None) -> typing.Any:
+        ...
+
+    @abstractmethod
+    def set(self, key: str, value: typing.Any, ttl: float) -> None:
+        ...
+
+    @abstractmethod
+    def delete(self, key: str) -> None:
+        ...
+
+    @abstractmethod
+    def pop(self, key: str, default: typing.Any = None) -> typing.Any:
+        ...
+
+
+class MemoryStateStore(StateStore):
+
+    def __init__(self, max_size: int) -> None:
+        self._cache = TTLCache(maxsize=max_size)
+
+    def get(self, key: str, default: typing.Any = None) -> typing.Any:
+        return self._cache.get(key, default)
+
+    def set(self, key: str, value: typing.Any, ttl: float) -> None:
+        self._cache.set(key, value, ttl)
+
+    def delete(self, key: str) -> None:
+        self._cache.delete(key)
+
+    def pop(self, key: str, default: typing.Any = None) -> typing.Any:
+        return self._cache.pop(key, default)
+
+
+class PostgresStateStore(StateStore):
+    """Записи в таблице state_store (миграция 9), value — jsonb"""
+
+    def __init__(
+            self, connection: typing.Callable, max_size: int,
+            purge_every: int = PURGE_EVERY) -> None:
+        self.connection = connection
+        self.max_size = max_size
+        self.purge_every = purge_every
+        self._writes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str, default: typing.Any = None) -> typing.Any:
+        with self.connection() as conn, conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT value FROM state_store
+                WHERE key = %s AND expires_at > now()
+            """, (key,))
+            row = cursor.fetchone()
+        return row[0] if row else default
+
+    def set(self, key: str, value: typing.Any, ttl: float) -> None:
+        with self.connection() as conn, conn.cursor() as cursor:
+            cursor.execute("""
+                INSERT INTO state_store (key, value, expires_at)
+                VALUES (%s, %s, now() + make_interval(secs => %s))
+                ON CONFLICT (key) DO UPDATE
+                SET value = EXCLUDED.value, expires_at = EXCLUDED.expires_at
+            """, (key, Json(value), ttl))
+        with self._lock:
+            self._writes += 1
+            purge = self._writes % self.purge_every == 0
+        if purge:
+            self.purge()
+
+    def delete(self, key: str) -> None:
+        with self.connection() as conn, conn.cursor() as cursor:
+            cursor.execute("DELETE FROM state_store WHERE key = %s", (key,))
+
+    def pop(self, key: str, default: typing.Any = None) -> typing.Any:
+        """Чтение с удалением одним запросом: шаг достанется одному процессу"""
+        with self.connection() as conn, conn.cursor() as cursor:
+            cursor.execute("""
+                DELETE FROM state_store WHERE key = %s
+                RETURNING value, expires_at > now()
+            """, (key,))
+            row = cursor.fetchone()
+        return row[0] if row and row[1] else default
+
+    def purge(self) -> None:
+        with self.connection() as conn, conn.cursor() as cursor:
+            cursor.execute("""
+                DELETE FROM state_store
+                WHERE expires_at <= now() OR key IN (
+                    SELECT key FROM state_store
+                    ORDER BY expires_at DESC OFFSET %s
+                )
+            """, (self.max_size,))
+
+
+def create_state_store(
+        backend: str, connection: typing.Callable,
+        max_size: int) -> StateStore:
+    if backend == 'postgres':
+        return PostgresStateStore(connection, max_size)
+    if backend == 'memory':
+        return MemoryStateStore(max_size)
+    raise ValueError(f'Неизвестное хранилище состояния: {backend}')
+
+
+class StoreStateStorage(StateStorageBase):
+    """
+    Хранилище состояний AsyncTeleBot поверх StateStore, чтобы шаги
+    асинхронного бота тоже были общими для всех процессов.
+    """
+
+    def __init__(
+            self, store: StateStore, ttl: float,
+            prefix: str = 'telebot', separator: str = ':') -> None:
+        self.store = store
+        self.ttl = ttl
+        self.prefix = prefix
+        self.separator = separator
+
+    def _key(
+            self, chat_id: int, user_id: int,
+            business_connection_id: str | None = None,
+            message_thread_id: int | None = None,
+            bot_id: int | None = None) -> str:
+        return self._get_key(
+            chat_id, user_id, self.prefix, self.separator,
+            business_connection_id, message_thread_id, bot_id,
+        )
+
+    async def _load(self, key: str) -> dict | None:
+        return await asyncio.to_thread(self.store.get, key)
+
+    async def _save(self, key: str, record: dict) -> None:
+        await asyncio.to_thread(self.store.set, key, record, self.ttl)
+
+    # Дополнительные аргументы telebot (business_connection_id,
+    # message_thread_id, bot_id) приходят то позиционно, то по имени
+    # и передаются как есть в _key
+    async def set_state(
+            self, chat_id, user_id, state, *args, **kwargs) -> bool:
+        if hasattr(state, 'name'):
+            state = state.name
+        key = self._key(chat_id, user_id, *args, **kwargs)
+        record = await self._load(key) or {'data': {}}
+        record['state'] = state
+        await self._save(key, record)
+        return True
+
+    async def get_state(
+            self, chat_id, user_id, *args, **kwargs) -> str | None:
+        key = self._key(chat_id, user_id, *args, **kwargs)
+        record = await self._load(key)
+        return record['state'] if record else None
+
+    async def delete_state(self, chat_id, user_id, *args, **kwargs) -> bool:
+        key = self._key(chat_id, user_id, *args, **kwargs)
+        return await asyncio.to_thread(self.store.pop, key) is not None
+
+    async def set_data(
+            self, chat_id, user_id, key, value, *args, **kwargs) -> bool:
+        record_key = self._key(chat_id, user_id, *args, **kwargs)
+        record = await self._load(record_key)
+        if record is None:
+            raise RuntimeError(f'StateStore: ключа {record_key} нет')
+        record['data'][key] = value
+        await self._save(record_key, record)
+        return True
+
+    async def get_data(self, chat_id, user_id, *args, **kwargs) -> dict:
+        key = self._key(chat_id, user_id, *args, **kwargs)
+        record = await self._load(key)
+        return record['data'] if record else {}
+
+    async def reset_data(self, chat_id, user_id, *args, **kwargs) -> bool:
+        return await self.save(chat_id, user_id, {}, *args, **kwargs)
+
+    def get_interactive_data(
+            self, chat_id, user_id, business_connection_id=None,
+            message_thread_id=None, bot_id=None) -> StateDataContext:
+        return StateDataContext(
+            self, chat_id=chat_id, user_id=user_id,
+            business_connection_id=business_connection_id,
+            message_thread_id=message_thread_id, bot_id=bot_id,
+        )
+
+    async def save(self, chat_id, user_id, data, *args, **kwargs) -> bool:
+        key = self._key(chat_id, user_id, *args, **kwargs)
+        record = await self._load(key)
+        if record is None:
+            return False
+        record['data'] = data
+        await self._save(key, record)
+        return True
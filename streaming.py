@@ -0,0 +1,93 @@
+import logging
+import time
+
+from bot_instance import bot
+from const import STREAM_EDIT_INTERVAL
+from utils import split_text, format_reply
+
+
+class StreamingReply:
+    """
+    Показывает ответ ассистента по мере генерации.
+
+    Первое сообщение — статус «Бот обрабатывает...», оно редактируется
+    по приходу токенов не чаще раза в edit_interval секунд. Когда текст
+    перерастает границу split_text, продолжение уходит новым сообщением.
+    Пока ответ не готов, текст показывается без разметки, в конце
+    сообщения заменяются на отформатированные части.
+    """
+
+    def __init__(
+            self,
+            user_id: int,
+            status_message_id: int,
+            edit_interval: float = STREAM_EDIT_INTERVAL,
+    ) -> None:
+        self.user_id = user_id
+        self.edit_interval = edit_interval
+        self.message_ids = [status_message_id]
+        self._shown = ['']
+        self._chunks: list[str] = []
+        self._last_render = 0.0
+        self._dirty = False
+
+    @property
+    def text(self) -> str:
+        return ''.join(self._chunks)
+
+    def feed(self, delta: str) -> None:
+        self._chunks.append(delta)
+        self._dirty = True
+        if time.monotonic() - self._last_render >= self.edit_interval:
+            self.render()
+
+    def render(self) -> None:
+        """Обновляет сообщения текущим (неформатированным) текстом"""
+        if not self._dirty:
+            return
+        self._dirty = False
+        self._last_render = time.monotonic()
+        parts = [part for part in split_text(self.text) if part.strip()]
+        self._show(parts, parse_mode=None)
+
+    def finish(self, final_text: str | None = None) -> list[str]:
+        """
+        Заменяет черновик отформатированным ответом.
+        Возвращает отправленные части для сохранения в историю.
+        """
+        parts = format_reply(final_text if final_text is not None
+                             else self.text)
+        self._show(parts, parse_mode='MarkdownV2')
+        for message_id in self.message_ids[len(parts):]:
+            try:
+                bot.delete_message(self.user_id, message_id)
+            except Exception as e:
+                logging.error(f"Ошибка при удалении сообщения: {e}")
+        del self.message_ids[len(parts):]
+        del self._shown[len(parts):]
+        return parts
+
+    def _show(self, parts: list[str], parse_mode: str | None) -> None:
+        for i, part in enumerate(parts):
+            if i < len(self.message_ids):
+                if self._shown[i] == part and parse_mode is None:
+                    continue
+                try:
+                    bot.edit_message_text(
+                        part,
+                        chat_id=self.user_id,
+                        message_id=self.message_ids[i],
+                        parse_mode=parse_mode,
+                    )
+                except Exception as e:
+                    if 'message is not modified' not in str(e):
+                        logging.error(
+                            f"Ошибка при редактировании сообщения: {e}"
+                        )
+                self._shown[i] = part
+            else:
+                msg = bot.send_message(
+                    self.user_id, part, parse_mode=parse_mode,
+                )
+                self.message_ids.append(msg.message_id)
+                self._shown.append(part)
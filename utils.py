@@ -1,23 +1,98 @@
+import hashlib
+import itertools
 import re
 from typing import List
 
 
-def clean_response(text: str) -> str:
+SUPERSCRIPT_MAP = {
+    '0': '⁰', '1': '¹', '2': '²', '3': '³',
+    '4': '⁴', '5': '⁵', '6': '⁶', '7': '⁷',
+    '8': '⁸', '9': '⁹', '+': '⁺', '-': '⁻',
+    '=': '⁼', '(': '⁽', ')': '⁾',
+    'n': 'ⁿ', 'i': 'ⁱ', 'x': 'ˣ', 'y': 'ʸ', 'a': 'ᵃ',
+    'b': 'ᵇ', 'c': 'ᶜ', 'd': 'ᵈ', 'e': 'ᵉ', 'f': 'ᶠ',
+    'g': 'ᵍ', 'h': 'ʰ', 'j': 'ʲ', 'k': 'ᵏ', 'l': 'ˡ',
+    'm': 'ᵐ', 'o': 'ᵒ', 'p': 'ᵖ', 'r': 'ʳ', 's': 'ˢ',
+    't': 'ᵗ', 'u': 'ᵘ', 'v': 'ᵛ', 'w': 'ʷ', 'z': 'ᶻ',
+}
+
+SUBSCRIPT_MAP = {
+    '0': '₀', '1': '₁', '2': '₂', '3': '₃',
+    '4': '₄', '5': '₅', '6': '₆', '7': '₇',
+    '8': '₈', '9': '₉', '+': '₊', '-': '₋',
+    '=': '₌', '(': '₍', ')': '₎',
+    'a': 'ₐ', 'e': 'ₑ', 'h': 'ₕ', 'i': 'ᵢ', 'j': 'ⱼ',
+    'k': 'ₖ', 'l': 'ₗ', 'm': 'ₘ', 'n': 'ₙ',
+    'o': 'ₒ', 'p': 'ₚ', 'r': 'ᵣ', 's': 'ₛ',
+    't': 'ₜ', 'u': 'ᵤ', 'v': 'ᵥ', 'x': 'ₓ'
+}
+
+FRACTION_MAP = {
+    '1/2': '½', '1/3': '⅓', '2/3': '⅔',
+    '1/4': '¼', '3/4': '¾',
+    '1/5': '⅕', '2/5': '⅖', '3/5': '⅗', '4/5': '⅘',
+    '1/6': '⅙', '5/6': '⅚',
+    '1/7': '⅐', '1/8': '⅛', '3/8': '⅜', '5/8': '⅝', '7/8': '⅞',
+    '1/9': '⅑', '1/10': '⅒',
+}
+
+MARKDOWN_ESCAPE_CHARS = r"\_*[]()~`>#+-=|{}.!"
+
+# Все шаблоны и таблицы собираются один раз при импорте: форматирование
+# выполняется для каждой части каждого ответа.
+_SUPERSCRIPT_TABLE = str.maketrans(SUPERSCRIPT_MAP)
+_SUBSCRIPT_TABLE = str.maketrans(SUBSCRIPT_MAP)
+_ESCAPE_TABLE = str.maketrans(
+    {char: '\\' + char for char in MARKDOWN_ESCAPE_CHARS}
+)
+# Внутри ``` Telegram требует экранировать только \ и `
+_CODE_ESCAPE_TABLE = str.maketrans({'\\': '\\\\', '`': '\\`'})
+
+_DISPLAY_MATH_RE = re.compile(r'\$\$(.*?)\$\$')
+_INLINE_MATH_RE = re.compile(r'\$(.*?)\$')
+_LATEX_COMMAND_ARG_RE = re.compile(r'\\[a-zA-Z]+\{([^}]*)\}')
+_LATEX_COMMAND_RE = re.compile(r'\\[a-zA-Z]+')
+
+# Длина группы в скобках ограничена: иначе каждая незакрытая «a^(»
+# просматривает текст до конца и разбор становится квадратичным.
+_POWER_GROUP_RE = re.compile(r'(\w)\^\(([^)]{1,100})\)')
+_POWER_RE = re.compile(r'(\w)\^([a-zA-Z0-9\+\-\=]+)')
+_SUBSCRIPT_GROUP_RE = re.compile(r'(\w)_\(([^)]{1,100})\)')
+_SUBSCRIPT_RE = re.compile(r'(\w)_([a-zA-Z0-9\+\-\=]+)')
+_SQUARE_ROOT_RE = re.compile(r'sqrt\(([^)]{1,100})\)')
+_FRACTION_RE = re.compile('|'.join(
+    re.escape(frac) for frac in sorted(FRACTION_MAP, key=len, reverse=True)
+))
+
+_CODE_BLOCK_RE = re.compile(r'```(.*?)```', flags=re.DOTALL)
+_BOLD_RE = re.compile(r'\*\*(.+?)\*\*')
+_UNESCAPE_RE = re.compile(r'\\(.)', flags=re.DOTALL)
+
+# Разметка уже экранированного MarkdownV2: экранированный символ,
+# граница блока кода, граница жирного.
+_MARKDOWN_TOKEN_RE = re.compile(r'\\.|```|\*', flags=re.DOTALL)
+_CODE_LANGUAGE_RE = re.compile(r'[\w+#-]{0,32}')
+_SPLIT_SEPARATORS = ('\n\n', '\n', ' ')
+# Запас под закрытие сущностей в конце части: "\n```" или "*"
+_CLOSE_RESERVE = 4
 
-    text = re.sub(r'\$\$(.*?)\$\$', r'\1', text)
-    text = re.sub(r'\$(.*?)\$', r'\1', text)
 
-    text = re.sub(r'\\[a-zA-Z]+\{([^}]*)\}', r'\1', text)
-    text = re.sub(r'\\[a-zA-Z]+', '', text)
+def clean_response(text: str) -> str:
 
-    text = re.sub(r'\s+', ' ', text).strip()
+    if '$' in text:
+        text = _DISPLAY_MATH_RE.sub(r'\1', text)
+        text = _INLINE_MATH_RE.sub(r'\1', text)
 
-    return text
+    if '\\' in text:
+        text = _LATEX_COMMAND_ARG_RE.sub(r'\1', text)
+        text = _LATEX_COMMAND_RE.sub('', text)
+
+    return ' '.join(text.split())
 
 
 def escape_markdown(text: str) -> str:
     """
-    Экранирует MarkdownV2-символы, обрабатывает **жирный**, `code`, > цитаты и списки.
+    Экранирует MarkdownV2-символы, обрабатывает **жирный** и ```блоки кода```.
     Также заменяет:
     - x^2 → x², x^(n+1) → x⁽ⁿ⁺¹⁾
     - x_2 → x₂, x_(n+1) → xₙ₊₁
@@ -26,26 +101,41 @@ def escape_markdown(text: str) -> str:
     """
 
     text = replace_math_symbols(text)
+    if '```' not in text:
+        return _escape_plain(text)
 
-    code_blocks = re.findall(r'```(.*?)```', text, flags=re.DOTALL)
-    for i, block in enumerate(code_blocks):
-        placeholder = f"<<CODE_BLOCK_{i}>>"
-        text = text.replace(f"```{block}```", placeholder)
-
-    text = re.sub(r'\*\*(.*?)\*\*', r'*\1*', text)
-
-    escape_chars = r"_*[]()~`>#+-=|{}.!"
-    text = re.sub(f"([{re.escape(escape_chars)}])", r'\\\1', text)
-
-    text = re.sub(r'^(\d+)\.', r'\1\\.', text, flags=re.MULTILINE)
-
-    for i, block in enumerate(code_blocks):
-        placeholder = f"<<CODE_BLOCK_{i}>>"
-        clean_block = block.replace('\\', '\\\\')
-        safe_code = f"```{clean_block}```"
-        text = text.replace(placeholder, safe_code)
-
-    return text
+    # Блоки кода и текст между ними экранируются по разным правилам,
+    # результат собирается за один проход без подстановок-заглушек.
+    parts = []
+    last = 0
+    for match in _CODE_BLOCK_RE.finditer(text):
+        parts.append(_escape_plain(text[last:match.start()]))
+        parts.append(
+            '```' + match.group(1).translate(_CODE_ESCAPE_TABLE) + '```'
+        )
+        last = match.end()
+    parts.append(_escape_plain(text[last:]))
+    return ''.join(parts)
+
+
+def unescape_markdown(text: str) -> str:
+    """Снимает экранирование MarkdownV2 (для истории, отправленной в Telegram)"""
+    if '\\' not in text:
+        return text
+    return _UNESCAPE_RE.sub(r'\1', text)
+
+
+def _escape_plain(text: str) -> str:
+    if '**' not in text:
+        return text.translate(_ESCAPE_TABLE)
+    parts = []
+    last = 0
+    for match in _BOLD_RE.finditer(text):
+        parts.append(text[last:match.start()].translate(_ESCAPE_TABLE))
+        parts.append('*' + match.group(1).translate(_ESCAPE_TABLE) + '*')
+        last = match.end()
+    parts.append(text[last:].translate(_ESCAPE_TABLE))
+    return ''.join(parts)
 
 
 def replace_math_symbols(text: str) -> str:
@@ -56,73 +146,175 @@ def replace_math_symbols(text: str) -> str:
     return text
 
 
+def _to_superscript(match: re.Match) -> str:
+    return match.group(1) + match.group(2).translate(_SUPERSCRIPT_TABLE)
+
+
+def _to_superscript_group(match: re.Match) -> str:
+    return match.group(1) + f'({match.group(2)})'.translate(_SUPERSCRIPT_TABLE)
+
+
+def _to_subscript(match: re.Match) -> str:
+    return match.group(1) + match.group(2).translate(_SUBSCRIPT_TABLE)
+
+
+def _to_fraction(match: re.Match) -> str:
+    return FRACTION_MAP[match.group(0)]
+
+
 def replace_powers(text: str) -> str:
-    superscript_map = {
-        '0': '⁰', '1': '¹', '2': '²', '3': '³',
-        '4': '⁴', '5': '⁵', '6': '⁶', '7': '⁷',
-        '8': '⁸', '9': '⁹', '+': '⁺', '-': '⁻',
-        '=': '⁼', '(': '⁽', ')': '⁾',
-        'n': 'ⁿ', 'i': 'ⁱ', 'x': 'ˣ', 'y': 'ʸ', 'a': 'ᵃ',
-        'b': 'ᵇ', 'c': 'ᶜ', 'd': 'ᵈ', 'e': 'ᵉ', 'f': 'ᶠ',
-        'g': 'ᵍ', 'h': 'ʰ', 'j': 'ʲ', 'k': 'ᵏ', 'l': 'ˡ',
-        'm': 'ᵐ', 'o': 'ᵒ', 'p': 'ᵖ', 'r': 'ʳ', 's': 'ˢ',
-        't': 'ᵗ', 'u': 'ᵘ', 'v': 'ᵛ', 'w': 'ʷ', 'z': 'ᶻ',
-    }
-
-    def to_superscript(s: str) -> str:
-        return ''.join(superscript_map.get(char, char) for char in s)
-
-    text = re.sub(r'(\w)\^\(([^)]+)\)', lambda m: m.group(1) + to_superscript('(' + m.group(2) + ')'), text)
-    text = re.sub(r'(\w)\^([a-zA-Z0-9\+\-\=]+)', lambda m: m.group(1) + to_superscript(m.group(2)), text)
-    return text
+    if '^' not in text:
+        return text
+    text = _POWER_GROUP_RE.sub(_to_superscript_group, text)
+    return _POWER_RE.sub(_to_superscript, text)
 
 
 def replace_subscripts(text: str) -> str:
-    subscript_map = {
-        '0': '₀', '1': '₁', '2': '₂', '3': '₃',
-        '4': '₄', '5': '₅', '6': '₆', '7': '₇',
-        '8': '₈', '9': '₉', '+': '₊', '-': '₋',
-        '=': '₌', '(': '₍', ')': '₎',
-        'a': 'ₐ', 'e': 'ₑ', 'h': 'ₕ', 'i': 'ᵢ', 'j': 'ⱼ',
-        'k': 'ₖ', 'l': 'ₗ', 'm': 'ₘ', 'n': 'ₙ',
-        'o': 'ₒ', 'p': 'ₚ', 'r': 'ᵣ', 's': 'ₛ',
-        't': 'ₜ', 'u': 'ᵤ', 'v': 'ᵥ', 'x': 'ₓ'
-    }
-
-    def to_subscript(s: str) -> str:
-        return ''.join(subscript_map.get(char, char) for char in s)
-
-    text = re.sub(r'(\w)_\(([^)]+)\)', lambda m: m.group(1) + to_subscript(m.group(2)), text)
-    text = re.sub(r'(\w)_([a-zA-Z0-9\+\-\=]+)', lambda m: m.group(1) + to_subscript(m.group(2)), text)
-    return text
+    if '_' not in text:
+        return text
+    text = _SUBSCRIPT_GROUP_RE.sub(_to_subscript, text)
+    return _SUBSCRIPT_RE.sub(_to_subscript, text)
 
 
 def replace_square_roots(text: str) -> str:
-    return re.sub(r'sqrt\(([^)]+)\)', r'√\1', text)
+    if 'sqrt(' not in text:
+        return text
+    return _SQUARE_ROOT_RE.sub(r'√\1', text)
 
 
 def replace_fractions(text: str) -> str:
-    fraction_map = {
-        '1/2': '½', '1/3': '⅓', '2/3': '⅔',
-        '1/4': '¼', '3/4': '¾',
-        '1/5': '⅕', '2/5': '⅖', '3/5': '⅗', '4/5': '⅘',
-        '1/6': '⅙', '5/6': '⅚',
-        '1/7': '⅐', '1/8': '⅛', '3/8': '⅜', '5/8': '⅝', '7/8': '⅞',
-        '1/9': '⅑', '1/10': '⅒',
-    }
-
-    for frac, symbol in fraction_map.items():
-        text = text.replace(frac, symbol)
-    return text
+    if '/' not in text:
+        return text
+    return _FRACTION_RE.sub(_to_fraction, text)
+
+
+def format_reply(text: str) -> List[str]:
+    """Готовит ответ ассистента к отправке: MarkdownV2 и разбивка"""
+    return split_markdown(escape_markdown(text))
 
 
 def split_text(text: str, max_len: int = 4096) -> List[str]:
+    """Разбивка простого текста по пробелам на части до max_len"""
+    if len(text) <= max_len:
+        return [text]
     parts = []
-    while len(text) > max_len:
-        split_pos = text.rfind(' ', 0, max_len)
+    start = 0
+    while len(text) - start > max_len:
+        split_pos = text.rfind(' ', start, start + max_len)
         if split_pos == -1:
-            split_pos = max_len
-        parts.append(text[:split_pos])
-        text = text[split_pos:].lstrip()
-    parts.append(text)
+            split_pos = start + max_len
+        parts.append(text[start:split_pos])
+        start = split_pos
+        while start < len(text) and text[start].isspace():
+            start += 1
+    parts.append(text[start:])
+    return parts
+
+
+def split_markdown(text: str, max_len: int = 4096) -> List[str]:
+    """
+    Разбивает уже экранированный MarkdownV2 на сообщения до max_len.
+
+    Граница ищется во второй половине окна: сначала пустая строка,
+    затем перевод строки, затем пробел, иначе жёсткий разрез, который
+    не рвёт экранирование и ```. Открытые на границе жирный или блок
+    кода закрываются в конце части и открываются заново в следующей.
+    Каждый символ просматривается константное число раз.
+    """
+    if len(text) <= max_len:
+        return [text]
+
+    tokens = _MARKDOWN_TOKEN_RE.finditer(text)
+    token = next(tokens, None)
+    parts = []
+    start = 0
+    # Открытая сущность: '```', '*' или None, её открывающий токен,
+    # начало содержимого и язык блока кода
+    entity = opener = None
+    content_pos = 0
+    language = ''
+
+    while start < len(text):
+        if entity == '```':
+            prefix = '```' + language + '\n'
+        else:
+            prefix = entity or ''
+        if len(text) - start + len(prefix) <= max_len:
+            parts.append(prefix + text[start:])
+            break
+
+        budget = max_len - len(prefix) - _CLOSE_RESERVE
+        end = start + budget
+        cut, skip = end, 0
+        for separator in _SPLIT_SEPARATORS:
+            pos = text.rfind(separator, start + budget // 2, end)
+            if pos != -1:
+                cut, skip = pos, len(separator)
+                break
+
+        while token and token.start() < cut:
+            if token.end() > cut:
+                cut, skip = token.start(), 0
+                break
+            value = token.group()
+            if value == '```' and entity in (None, '```'):
+                if entity:
+                    entity = None
+                else:
+                    entity, opener = '```', token
+                    language = _CODE_LANGUAGE_RE.match(text, token.end()).group()
+                    content_pos = token.end() + len(language)
+                    if text.startswith('\n', content_pos):
+                        content_pos += 1
+                    else:
+                        language = ''
+                        content_pos = token.end()
+            elif value == '*' and entity in (None, '*'):
+                if entity:
+                    entity = None
+                else:
+                    entity, opener = '*', token
+                    content_pos = token.end()
+            token = next(tokens, None)
+
+        # Не оставляем в конце части пустую сущность — переносим её целиком
+        # Между открывающим токеном и cut других токенов нет, поэтому
+        # достаточно вернуть его в очередь перед текущим.
+        if entity and cut <= content_pos and opener.start() > start:
+            if token:
+                tokens = itertools.chain((token,), tokens)
+            cut, skip, token, entity = opener.start(), 0, opener, None
+
+        part = prefix + text[start:cut]
+        if entity == '```':
+            # Блок кода кончается сразу за границей: закрываем его здесь,
+            # а не пустым блоком в следующей части.
+            if (token and token.group() == '```'
+                    and token.start() - cut <= 2
+                    and not text[cut:token.start()].strip()):
+                entity, skip = None, token.end() - cut
+                token = next(tokens, None)
+            part += '```' if part.endswith('\n') else '\n```'
+        elif entity:
+            part += entity
+        parts.append(part)
+        start = cut + skip
+
     return parts
+
+
+_SPACES_RE = re.compile(r'\s+')
+_OPERATOR_SPACES_RE = re.compile(r'\s*([-+*/^=<>()\[\],:])\s*')
+_TRAILING_RE = re.compile(r'[\s.!?…]+$')
+
+
+def normalize(text: str) -> str:
+    """Текст вопроса или промпта для сравнения: регистр, ё, пробелы"""
+    text = text.lower().replace('ё', 'е')
+    text = _SPACES_RE.sub(' ', text).strip()
+    text = _OPERATOR_SPACES_RE.sub(r'\1', text)
+    return _TRAILING_RE.sub('', text)
+
+
+def question_key(normalized: str) -> str:
+    return hashlib.sha1(normalized.encode()).hexdigest()
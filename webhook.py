@@ -0,0 +1,130 @@
+"""
+Приём обновлений Telegram через webhook (BOT_MODE=webhook).
+
+HTTP-сервер только проверяет секретный токен, ставит обновление в
+очередь и сразу отвечает 200, а обработчики telebot выполняются в
+шардах ShardedDispatcher (dispatcher.py). Очередь ограничена: когда
+она полна, сервер отвечает 503, и Telegram повторит доставку позже. Экземпляров бота
+может быть несколько за балансировщиком: общее состояние живёт в
+state_store, а не в памяти процесса.
+"""
+import hmac
+import logging
+import time
+import typing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telebot import TeleBot
+from telebot.types import Update
+
+from const import (WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_HOST, WEBHOOK_PORT,
+                   WEBHOOK_SECRET,
+                   )
+from dispatcher import ShardedDispatcher
+
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+# Обновление Telegram — это JSON на единицы килобайт
+MAX_BODY_SIZE = 1024 * 1024
+POLLING_TIMEOUT = 20
+POLLING_RETRY_DELAY = 3
+
+
+def check_secret(headers: typing.Mapping[str, str], secret: str) -> bool:
+    return hmac.compare_digest(
+        headers.get(SECRET_HEADER, '').encode(), secret.encode(),
+    )
+
+
+def make_handler(
+        path: str, secret: str,
+        dispatcher: ShardedDispatcher) -> type[BaseHTTPRequestHandler]:
+
+    class WebhookHandler(BaseHTTPRequestHandler):
+        def do_POST(self) -> None:
+            if self.path != path:
+                return self._reply(404)
+            if not check_secret(self.headers, secret):
+                return self._reply(403)
+            length = int(self.headers.get('Content-Length') or 0)
+            if length > MAX_BODY_SIZE:
+                return self._reply(413)
+            try:
+                update = Update.de_json(self.rfile.read(length).decode())
+            except Exception as e:
+                logging.warning("Некорректное обновление webhook: %s", e)
+                return self._reply(400)
+            if not dispatcher.submit(update):
+                logging.warning("Очередь обновлений полна, отвечаем 503")
+                return self._reply(503)
+            self._reply(200)
+
+        def _reply(self, status: int) -> None:
+            self.send_response(status)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def log_message(self, format: str, *args: typing.Any) -> None:
+            logging.debug("webhook: " + format, *args)
+
+    return WebhookHandler
+
+
+def dispatcher_for(bot: TeleBot) -> ShardedDispatcher:
+    # Обработчики выполняются в шардах, а не в пуле потоков telebot,
+    # который не сохраняет порядок обновлений одного чата
+    bot.threaded = False
+    return ShardedDispatcher(lambda update: bot.process_new_updates([update]))
+
+
+def run_webhook(bot: TeleBot) -> None:
+    """Регистрирует webhook в Telegram и обслуживает его до остановки"""
+    if not WEBHOOK_URL or not WEBHOOK_SECRET:
+        raise RuntimeError(
+            'Для BOT_MODE=webhook нужны WEBHOOK_URL и WEBHOOK_SECRET'
+        )
+
+    dispatcher = dispatcher_for(bot)
+    server = ThreadingHTTPServer(
+        (WEBHOOK_HOST, WEBHOOK_PORT),
+        make_handler(WEBHOOK_PATH, WEBHOOK_SECRET, dispatcher),
+    )
+    server.daemon_threads = True
+    bot.set_webhook(
+        url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET,
+    )
+    logging.info(
+        "Webhook слушает %s:%s%s", WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH,
+    )
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        dispatcher.shutdown()
+
+
+def run_polling(bot: TeleBot) -> None:
+    """
+    Long polling для разработки. getUpdates не работает при webhook.
+    Пока шард переполнен, новые обновления не запрашиваются.
+    """
+    bot.remove_webhook()
+    dispatcher = dispatcher_for(bot)
+    offset = None
+    try:
+        while True:
+            try:
+                updates = bot.get_updates(
+                    offset=offset, timeout=POLLING_TIMEOUT + 10,
+                    long_polling_timeout=POLLING_TIMEOUT,
+                )
+            except Exception as e:
+                logging.exception("Ошибка получения обновлений: %s", e)
+                time.sleep(POLLING_RETRY_DELAY)
+                continue
+            for update in updates:
+                dispatcher.submit(update, block=True)
+                offset = update.update_id + 1
+    finally:
+        dispatcher.shutdown()